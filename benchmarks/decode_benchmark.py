@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+# Decoding Microbenchmark
+#
+# Compares the events/second of the per-event handle_event callback and of the NumPy
+# BatchDecoder on synthetic ring-buffer records, and with --workers N [N ...] of the
+# decoding Pipeline for each worker count, until its workers have sent back all their
+# messages. The pipeline only speeds things up with at least N + 1 free cores, so the
+# CPU time of the main process (dispatching and forwarding) is reported too: it bounds
+# the throughput once every worker has a core of its own. Does not need BPF or root
+# privileges.
+#
+#   python3 -m benchmarks.decode_benchmark [--events N] [--untracked FRACTION] [--workers N [N ...]]
+
+import argparse
+import os
+import time
+
+from benchmarks.synthetic import EventGenerator, as_records
+from tracers.batch import BATCH_CAPACITY, BatchDecoder
+from tracers.common import PAGE_SIZE
+from tracers.event_cache import EventCache
+from tracers.events import handle_event, set_tracker_pid
+from utils.pipeline import Pipeline
+from utils.tracker import MemoryTracker
+
+
+PIPELINE_STARTUP = 2  # seconds left to the spawned workers to start, before the timing
+PIPELINE_TIMEOUT = 600  # seconds to wait for the workers
+
+
+class NullServer:
+    """Counts and drops the messages, so that only the decoding and the tracker are measured."""
+
+    def __init__(self):
+        self.messages = 0
+        self.request_handlers = {}
+
+    def notify_clients_threadsafe(self, event_message, save_event=True):
+        self.messages += 1
+
+
+def run_per_event(events, tracked_pids):
+    """Return the time taken, and the number of messages to expect from the other decoders."""
+    tracker = MemoryTracker(PAGE_SIZE, server=NullServer())
+    event_cache = EventCache()
+    start = time.perf_counter()
+    for raw_data, size, _ in events:
+        handle_event(0, raw_data, size, tracker, tracked_pids, event_cache)
+    return time.perf_counter() - start, tracker.server.messages
+
+
+def run_batch(events, tracked_pids, capacity):
+    tracker = MemoryTracker(PAGE_SIZE, server=NullServer())
+    decoder = BatchDecoder(tracker, tracked_pids, EventCache(), capacity=capacity)
+    start = time.perf_counter()
+    for raw_data, size, _ in events:
+        decoder.add(0, raw_data, size)
+    decoder.flush()
+    return time.perf_counter() - start
+
+
+def run_pipeline(events, tracked_pids, workers, messages):
+    """Return the time taken, and the CPU time of the main process meanwhile."""
+    tracker = MemoryTracker(PAGE_SIZE, server=NullServer())
+    pipeline = Pipeline(workers, tracker, tracked_pids, EventCache())
+    time.sleep(PIPELINE_STARTUP)
+    try:
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        for index, (raw_data, size, _) in enumerate(events):
+            pipeline.dispatch(0, raw_data, size)
+            if index % BATCH_CAPACITY == 0:
+                pipeline.flush()  # like after each ring-buffer poll
+        pipeline.flush()
+        while tracker.server.messages < messages:
+            if time.perf_counter() - start > PIPELINE_TIMEOUT:
+                raise TimeoutError(f"the workers sent {tracker.server.messages} of {messages} messages")
+            time.sleep(0.001)
+        return time.perf_counter() - start, time.process_time() - start_cpu
+    finally:
+        pipeline.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--untracked", type=float, default=0.5, help="fraction of events of untracked processes")
+    parser.add_argument("--capacity", type=int, default=BATCH_CAPACITY, help="records per batch")
+    parser.add_argument("--workers", type=int, nargs="+", default=[],
+                        help="also measure a Pipeline with each of these numbers of workers, to see it scale")
+    args = parser.parse_args()
+
+    generator = EventGenerator(pids=64, untracked=args.untracked)
+    events = as_records(generator.events(args.events))
+    set_tracker_pid(1)
+
+    per_event, messages = run_per_event(events, generator.tracked_pids())
+    batch = run_batch(events, generator.tracked_pids(), args.capacity)
+    print(f"{args.events} events, {args.untracked:.0%} untracked")
+    print(f"  handle_event:  {args.events / per_event:>12,.0f} events/s")
+    print(f"  BatchDecoder:  {args.events / batch:>12,.0f} events/s ({per_event / batch:.2f}x)")
+    for workers in args.workers:
+        pipeline, main_cpu = run_pipeline(events, generator.tracked_pids(), workers, messages)
+        print(f"  Pipeline ({workers}):  {args.events / pipeline:>12,.0f} events/s ({per_event / pipeline:.2f}x, "
+              f"{os.cpu_count()} CPUs), main process {args.events / main_cpu:,.0f} events/CPU second")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Synthetic ring-buffer event streams, using the struct layouts of tracers/common.py.
+#
+# Each process keeps a rough model of its address space (mappings handed out by a bump
+# allocator, and a heap break) so that the munmap, mremap and brk events refer to
+# memory that was actually mapped, like in a real trace.
+
+import random
+from ctypes import c_void_p, cast, pointer, sizeof
+
+from tracers.common import *
+from tracers.tracked_pids import TrackedPids
+
+FIRST_PID = 1_000
+FIRST_UNTRACKED_PID = 100_000
+MMAP_BASE = 0x7f0000000000
+HEAP_BASE = 0x5555_5555_0000
+MAP_SIZES_PAGES = [1, 1, 1, 2, 2, 4, 8, 16, 64, 256]  # skewed towards small mappings, like malloc arenas
+MREMAP_MAYMOVE = 1
+CLONE_FRACTION = 0.001  # of the events, while fewer processes than requested exist
+
+
+class SyntheticProcess:
+    def __init__(self, pid, comm):
+        self.pid = pid
+        self.comm = comm
+        self.mappings = []  # (start, size)
+        self.cursor = MMAP_BASE + (pid % 4096) * (1 << 32)
+        self.brk = HEAP_BASE
+        self.brk_initialized = False
+
+
+class EventGenerator:
+    """
+    Generates the events of a set of processes.
+
+    pids: number of processes, only the first one exists at the start, the others are
+          created by clone events
+    regions: number of live mappings per process the stream hovers around
+    fragmentation: probability that a mapping is separated from the previous one by a
+                   hole, and that an unmap only covers part of a mapping
+    churn: probability that an event frees memory once a process reached its regions,
+           at least half of them do so that the number of regions stays stable
+    untracked: fraction of the events coming from processes that are not tracked
+    """
+
+    def __init__(self, pids=16, regions=1_000, fragmentation=0.5, churn=0.5, untracked=0.0,
+                 page_size=PAGE_SIZE, seed=0):
+        self.target_pids = pids
+        self.regions = regions
+        self.fragmentation = fragmentation
+        self.churn = churn
+        self.untracked = untracked
+        self.page_size = page_size
+        self.rng = random.Random(seed)
+
+        self.timestamp = 1_000_000_000
+        self.next_pid = FIRST_PID + 1
+        self.processes = [SyntheticProcess(FIRST_PID, b"synthetic")]
+        self.untracked_processes = [SyntheticProcess(FIRST_UNTRACKED_PID + i, b"untracked") for i in range(4)]
+
+    def tracked_pids(self):
+        """PIDs tracked at the start of the stream, the others are added by the clone events."""
+        return TrackedPids([FIRST_PID])
+
+    def events(self, count):
+        """Return count ctypes event structures."""
+        events = []
+        while len(events) < count:
+            self.timestamp += self.rng.randrange(100, 2_000)
+            if self.rng.random() < self.untracked:
+                events.append(self._memory_event(self.rng.choice(self.untracked_processes)))
+            elif len(self.processes) < self.target_pids and self.rng.random() < CLONE_FRACTION:
+                events.extend(self._clone(self.rng.choice(self.processes)))
+            else:
+                events.append(self._memory_event(self.rng.choice(self.processes)))
+        return events[:count]
+
+    def _header(self, type, process):
+        return type, process.pid << 32 | process.pid, self.timestamp
+
+    def _memory_event(self, process):
+        kind = self.rng.random()
+        if kind < 0.1:
+            return self._brk(process)
+        if kind < 0.15 and process.mappings:
+            return self._mremap(process)
+        fill = len(process.mappings) / self.regions
+        # Processes grow towards their number of regions, then stay around it
+        free_probability = self.churn * fill if fill < 1 else max(self.churn, 0.5)
+        if process.mappings and self.rng.random() < free_probability:
+            return self._munmap(process)
+        return self._mmap(process)
+
+    def _mapping_size(self):
+        return self.rng.choice(MAP_SIZES_PAGES) * self.page_size
+
+    def _place(self, process, size):
+        start = process.cursor
+        process.cursor += size
+        if self.rng.random() < self.fragmentation:
+            process.cursor += self.rng.randrange(1, 16) * self.page_size
+        return start
+
+    def _mmap(self, process):
+        size = self._mapping_size()
+        start = self._place(process, size)
+        process.mappings.append((start, size))
+        return MmapEvent(*self._header(2, process), 0, size, start, process.comm, NO_STACK)
+
+    def _munmap(self, process):
+        index = self.rng.randrange(len(process.mappings))
+        start, size = process.mappings[index]
+        pages = size // self.page_size
+        if pages > 1 and self.rng.random() < self.fragmentation:
+            # Unmap the head or the tail of the mapping
+            unmapped = self.rng.randrange(1, pages) * self.page_size
+            if self.rng.random() < 0.5:
+                process.mappings[index] = (start + unmapped, size - unmapped)
+            else:
+                process.mappings[index] = (start, size - unmapped)
+                start += size - unmapped
+            size = unmapped
+        else:
+            process.mappings[index] = process.mappings[-1]
+            process.mappings.pop()
+        return MunmapEvent(*self._header(5, process), start, size, process.comm)
+
+    def _mremap(self, process):
+        index = self.rng.randrange(len(process.mappings))
+        old_addr, old_size = process.mappings[index]
+        new_size = old_size * 2
+        new_addr = self._place(process, new_size)
+        process.mappings[index] = (new_addr, new_size)
+        return MremapEvent(*self._header(4, process), old_addr, old_size, 0, new_size, MREMAP_MAYMOVE, new_addr,
+                           process.comm, NO_STACK)
+
+    def _brk(self, process):
+        if not process.brk_initialized:
+            process.brk_initialized = True
+        elif process.brk > HEAP_BASE and self.rng.random() < self.churn / 2:
+            process.brk -= self.rng.randrange(1, (process.brk - HEAP_BASE) // self.page_size + 1) * self.page_size
+        else:
+            process.brk += self.rng.randrange(1, 33) * self.page_size
+        return BrkEvent(*self._header(7, process), 0, process.brk, process.comm, NO_STACK)
+
+    def _clone(self, parent):
+        child = SyntheticProcess(self.next_pid, parent.comm)
+        self.next_pid += 1
+        self.processes.append(child)
+        return [
+            CloneEnterEvent(*self._header(8, parent), 0, parent.comm),
+            CloneExitEvent(*self._header(9, parent), child.pid),
+        ]
+
+
+def as_records(events):
+    """(raw_data, size, event) tuples, like the arguments of the ring-buffer callback."""
+    return [(cast(pointer(event), c_void_p), sizeof(event), event) for event in events]
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# Tracker Throughput Benchmark
+#
+# Drives synthetic event streams through handle_event (or the BatchDecoder) and the
+# MemoryTracker, without BPF or root privileges, and reports:
+#   - events/second over the whole stream
+#   - p50/p99 per-event latency (per-batch latency divided by its size with --batch)
+#   - peak RSS of the benchmark process, and its RSS once the events are generated
+#   - websocket bytes the server would send, as JSON and binary frames
+#
+# Results can be saved as JSON and compared with a previous run:
+#
+#   python3 -m benchmarks.tracker_benchmark --output before.json
+#   python3 -m benchmarks.tracker_benchmark --baseline before.json
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from array import array
+
+from benchmarks.synthetic import EventGenerator, as_records
+from tracers.batch import BATCH_CAPACITY, BatchDecoder
+from tracers.common import PAGE_SIZE
+from tracers.event_cache import EventCache
+from tracers.events import handle_event, set_tracker_pid
+from utils.server import Server
+from utils.tracker import MemoryTracker
+
+TRACKER_PID = 1
+
+# Metrics compared with --baseline, and whether higher values are better
+METRICS = {
+    "events_per_second": True,
+    "p50_latency_us": False,
+    "p99_latency_us": False,
+    "peak_rss_kb": False,
+    "websocket_json_bytes": False,
+    "websocket_binary_bytes": False,
+}
+
+
+class CountingServer(Server):
+    """
+    Server that is never started, and only measures the frames it would broadcast.
+    Batches are cut every batch_max_events messages, with the same cancellation of
+    short-lived allocations as the real server.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = 0
+        self.json_bytes = 0
+        self.binary_bytes = 0
+
+    def notify_clients_threadsafe(self, event_message, save_event=True):
+        self._pending.append((event_message, save_event))
+        if len(self._pending) >= self.batch_max_events:
+            self.flush()
+
+    def flush(self):
+        messages = [message for message, _ in self._take_batch()]
+        if not messages:
+            return
+        self.messages += len(messages)
+        self.json_bytes += len(json.dumps({"type": "batch", "messages": messages}).encode("utf-8"))
+        self.binary_bytes += len(self._encoder.encode(messages))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run(args):
+    generator = EventGenerator(pids=args.pids, regions=args.regions, fragmentation=args.fragmentation,
+                               churn=args.churn, untracked=args.untracked, seed=args.seed)
+    records = as_records(generator.events(args.events))
+    stream_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # the generated events are counted too
+
+    set_tracker_pid(TRACKER_PID)
+    server = CountingServer()
+    tracker = MemoryTracker(PAGE_SIZE, server=server)
+    tracked_pids = generator.tracked_pids()
+    event_cache = EventCache()
+
+    latencies = array("Q")  # nanoseconds
+    clock = time.perf_counter_ns
+    start = clock()
+    if args.batch:
+        decoder = BatchDecoder(tracker, tracked_pids, event_cache, capacity=args.batch)
+        for offset in range(0, len(records), args.batch):
+            batch_start = clock()
+            for raw_data, size, _ in records[offset:offset + args.batch]:
+                decoder.add(0, raw_data, size)
+            decoder.flush()
+            elapsed = clock() - batch_start
+            count = min(args.batch, len(records) - offset)
+            latencies.extend([elapsed // count] * count)
+    else:
+        for raw_data, size, _ in records:
+            event_start = clock()
+            handle_event(0, raw_data, size, tracker, tracked_pids, event_cache)
+            latencies.append(clock() - event_start)
+    duration = (clock() - start) / 1e9
+    server.flush()
+
+    latencies = sorted(latencies)
+    return {
+        "events": len(records),
+        "duration_s": round(duration, 3),
+        "events_per_second": round(len(records) / duration),
+        "p50_latency_us": round(percentile(latencies, 0.5) / 1000, 2),
+        "p99_latency_us": round(percentile(latencies, 0.99) / 1000, 2),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stream_rss_kb": stream_rss,
+        "messages": server.messages,
+        "websocket_json_bytes": server.json_bytes,
+        "websocket_binary_bytes": server.binary_bytes,
+        "live_regions": sum(len(regions) for regions in tracker.allocations.values()),
+        "processes": len(tracked_pids),
+    }
+
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_comparison(results, baseline):
+    print(f"Compared with {baseline.get('commit') or 'baseline'}:")
+    for metric, higher_is_better in METRICS.items():
+        before, after = baseline["results"].get(metric), results[metric]
+        if not before:
+            continue
+        change = (after - before) / before
+        better = change > 0 if higher_is_better else change < 0
+        print(f"  {metric:<24} {before:>14,} -> {after:>14,}  {change:+7.1%}"
+              f"{'' if abs(change) < 0.05 else ' (better)' if better else ' (worse)'}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--pids", type=int, default=16, help="number of processes, created by clone events")
+    parser.add_argument("--regions", type=int, default=1_000, help="live mappings per process")
+    parser.add_argument("--fragmentation", type=float, default=0.5,
+                        help="probability of holes between mappings and of partial unmaps")
+    parser.add_argument("--churn", type=float, default=0.5, help="probability that an event frees memory")
+    parser.add_argument("--untracked", type=float, default=0.0, help="fraction of events of untracked processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, nargs="?", const=BATCH_CAPACITY, default=0,
+                        help="decode the events with the BatchDecoder, in batches of this many records")
+    parser.add_argument("--output", metavar="FILE", help="write the parameters and results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with the results of a previous run")
+    args = parser.parse_args()
+
+    results = run(args)
+    parameters = {name: value for name, value in vars(args).items() if name not in ("output", "baseline")}
+
+    print(f"{results['events']} events ({results['processes']} processes, {results['live_regions']} live regions "
+          f"at the end) in {results['duration_s']} s")
+    print(f"  throughput:      {results['events_per_second']:>12,} events/s")
+    print(f"  latency:         {results['p50_latency_us']:>12} us p50, {results['p99_latency_us']} us p99")
+    print(f"  peak RSS:        {results['peak_rss_kb']:>12,} KB ({results['stream_rss_kb']:,} KB after generating "
+          f"the events)")
+    print(f"  websocket bytes: {results['websocket_json_bytes']:>12,} JSON, "
+          f"{results['websocket_binary_bytes']:,} binary ({results['messages']:,} messages)")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            print_comparison(results, json.load(file))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"commit": git_commit(), "python": sys.version.split()[0], "parameters": parameters,
+                       "results": results}, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,185 @@
 #include <linux/bpf.h>
 #include <linux/ptrace.h>
+#include <linux/sched/signal.h>
 
 
 // ==== map declarations ================================================================
 
 BPF_RINGBUF_OUTPUT(events, 1024);
 
+// Thread group ids of the tracked processes, filled from userspace for the initial
+// processes and by the sched_process_fork probe (and the clone/clone3/vfork exit
+// probes, should it miss one) for their children.
+#define TRACK_FULL 1            // report the memory events of the process
+#define TRACK_CHILDREN_ONLY 2   // only follow its children (e.g. the tracer itself)
+BPF_HASH(tracked_tgids, u32, u8, 65536);
+
+// Tracked threads that are currently inside a process-creating clone/clone3/vfork
+BPF_HASH(pending_clones, u32, u8, 65536);
+
+// Syscalls return -errno on failure, which is in the last page of the address space
+#define SYSCALL_FAILED(ret) ((u64)(ret) >= (u64)-4095)
+
+// Per-CPU counters of the events that never reached userspace, read by
+// utils/instrumentation.py (KERNEL_COUNTERS lists them in the same order)
+#define STAT_RINGBUF_DROPS 0      // ring buffer full
+#define STAT_UNMATCHED_EXITS 1    // exit of a tracked thread without the arguments of its enter
+#define STAT_UNMATCHED_ENTERS 2   // enter overwriting the arguments of an enter that never exited
+#define STAT_ARGS_MAP_FULL 3      // enter whose arguments could not be stored
+#define STAT_FAULTS_MAP_FULL 4    // page fault in a bucket that could not be added to page_faults
+#define STAT_STACK_ID_FAILED 5    // user stack that could not be walked or stored in stack_traces
+BPF_PERCPU_ARRAY(stats, u64, 6);
+
 // ======================================================================================
 
 
-// ==== brk =============================================================================
+// ==== instrumentation =================================================================
 
-struct brk_data_t {
-    u64 type;
-    u64 pid_and_tid;          // Process ID << 32 | Thread ID
-    u64 timestamp;
+static inline void count_stat(u32 index) {
+    u64 *value = stats.lookup(&index);
+    if (value != NULL) {
+        (*value)++;
+    }
+}
 
-    u64 requested_brk; // Requested new program break
-    char comm[16];    // Process name
+static inline void submit(void *data, u32 size) {
+    if (events.ringbuf_output(data, size, 0) != 0) {
+        count_stat(STAT_RINGBUF_DROPS);
+    }
+}
+
+// When compiled with -DCAPTURE_STACKS the mmap, mremap and brk enters record the user
+// stack of the call, symbolized by utils/symbols.py. The stack_id of the events is -1
+// otherwise, or when the stack could not be captured.
+#ifdef CAPTURE_STACKS
+BPF_STACK_TRACE(stack_traces, 16384);
+
+static inline s64 capture_stack(void *ctx) {
+    int id = stack_traces.get_stackid(ctx, BPF_F_USER_STACK);
+    if (id < 0) {
+        count_stat(STAT_STACK_ID_FAILED);
+        return -1;
+    }
+    return id;
+}
+#else
+static inline s64 capture_stack(void *ctx) {
+    return -1;
+}
+#endif
+
+// ======================================================================================
+
+
+// ==== pid filtering ===================================================================
+
+// When compiled with -DTRACE_ALL_PIDS every process is reported and children are not
+// followed, since there is nothing left to filter.
+
+static inline int is_tracked(u64 pid_and_tid) {
+#ifdef TRACE_ALL_PIDS
+    return 1;
+#else
+    u32 tgid = pid_and_tid >> 32;
+    u8 *mode = tracked_tgids.lookup(&tgid);
+    return mode != NULL && *mode == TRACK_FULL;
+#endif
+}
+
+static inline int follows_children(u64 pid_and_tid) {
+#ifdef TRACE_ALL_PIDS
+    return 0;
+#else
+    u32 tgid = pid_and_tid >> 32;
+    return tracked_tgids.lookup(&tgid) != NULL;
+#endif
+}
+
+static inline void start_clone(u64 pid_and_tid) {
+    u32 tid = pid_and_tid;
+    u8 one = 1;
+    pending_clones.update(&tid, &one);
+}
+
+// Returns whether the exiting clone was started by a tracked process, and if so
+// starts tracking the child, which trace_process_fork normally did already.
+static inline int finish_clone(u64 pid_and_tid, long ret) {
+    u32 tid = pid_and_tid;
+    if (pending_clones.lookup(&tid) == NULL) {
+        return 0;
+    }
+    pending_clones.delete(&tid);
+
+    if (ret > 0) {
+        u32 child = ret;
+        u8 mode = TRACK_FULL;
+        tracked_tgids.update(&child, &mode);
+    }
+    return 1;
+}
+
+// ======================================================================================
+
+
+// ==== brk =============================================================================
+
+// Arguments of sys_enter_brk, kept per thread until sys_exit_brk
+struct brk_args_t {
+    u64 requested_brk;
+    s64 stack_id;
 };
 
-struct brk_exit_data_t {
+BPF_HASH(brk_args, u64, struct brk_args_t, 10240);
+
+// Completed brk call, emitted from sys_exit_brk
+struct brk_data_t {
     u64 type;
     u64 pid_and_tid;          // Process ID << 32 | Thread ID
     u64 timestamp;
 
+    u64 requested_brk; // Requested new program break
     u64 actual_brk;    // Actual program break after the call
     char comm[16];    // Process name
+    s64 stack_id;      // User stack of the call in stack_traces, or -1
 };
 
 int trace_brk_enter(struct tracepoint__syscalls__sys_enter_brk *ctx) {
-    struct brk_data_t data = {};
-    data.type = 6;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
-    data.timestamp = bpf_ktime_get_ns();
-
-    data.requested_brk = ctx->brk;
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
-
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    if (!is_tracked(pid_and_tid)) {
+        return 0;
+    }
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    struct brk_args_t args = {};
+    args.requested_brk = ctx->brk;
+    args.stack_id = capture_stack(ctx);
+    if (brk_args.insert(&pid_and_tid, &args) != 0) {
+        count_stat(brk_args.update(&pid_and_tid, &args) == 0 ? STAT_UNMATCHED_ENTERS : STAT_ARGS_MAP_FULL);
+    }
     return 0;
 }
 
 int trace_brk_exit(struct tracepoint__syscalls__sys_exit_brk *ctx) {
-    struct brk_exit_data_t data = {};
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    struct brk_args_t *args = brk_args.lookup(&pid_and_tid);
+    if (args == NULL) {
+        if (is_tracked(pid_and_tid)) {
+            count_stat(STAT_UNMATCHED_EXITS);
+        }
+        return 0;
+    }
+
+    struct brk_data_t data = {};
     data.type = 7;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
+    data.pid_and_tid = pid_and_tid;
     data.timestamp = bpf_ktime_get_ns();
 
+    data.requested_brk = args->requested_brk;
     data.actual_brk = ctx->ret; // The return value of brk()
+    data.stack_id = args->stack_id;
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    brk_args.delete(&pid_and_tid);
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -61,7 +188,16 @@ int trace_brk_exit(struct tracepoint__syscalls__sys_exit_brk *ctx) {
 
 // ==== mmap ============================================================================
 
-// Structure for sys_enter_mmap events
+// Arguments of sys_enter_mmap, kept per thread until sys_exit_mmap
+struct mmap_args_t {
+    u64 requested_addr;
+    u64 size;
+    s64 stack_id;
+};
+
+BPF_HASH(mmap_args, u64, struct mmap_args_t, 10240);
+
+// Completed mmap call, emitted from sys_exit_mmap
 struct mmap_data_t {
     u64 type;
     u64 pid_and_tid;            // Process ID << 32 | Thread ID
@@ -69,41 +205,54 @@ struct mmap_data_t {
 
     u64 requested_addr;         // Address passed to mmap (could be 0)
     u64 size;                   // Requested memory size
+    u64 actual_addr;            // Address returned by mmap
     char comm[16];              // Process name
-};
-
-// Structure for sys_exit_mmap events
-struct mmap_exit_data_t {
-    u64 type;
-    u64 pid_and_tid;          // Process ID << 32 | Thread ID
-    u64 timestamp;
-
-    u64 actual_addr;    // Address returned by mmap
+    s64 stack_id;               // User stack of the call in stack_traces, or -1
 };
 
 int trace_mmap_enter(struct tracepoint__syscalls__sys_enter_mmap *ctx) {
-    struct mmap_data_t data = {};
-    data.type = 1;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
-    data.timestamp = bpf_ktime_get_ns();
-
-    data.requested_addr = ctx->addr;
-    data.size = ctx->len;
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    if (!is_tracked(pid_and_tid)) {
+        return 0;
+    }
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    struct mmap_args_t args = {};
+    args.requested_addr = ctx->addr;
+    args.size = ctx->len;
+    args.stack_id = capture_stack(ctx);
+    if (mmap_args.insert(&pid_and_tid, &args) != 0) {
+        count_stat(mmap_args.update(&pid_and_tid, &args) == 0 ? STAT_UNMATCHED_ENTERS : STAT_ARGS_MAP_FULL);
+    }
     return 0;
 }
 
 int trace_mmap_exit(struct tracepoint__syscalls__sys_exit_mmap *ctx) {
-    struct mmap_exit_data_t data = {};
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    struct mmap_args_t *args = mmap_args.lookup(&pid_and_tid);
+    if (args == NULL) {
+        if (is_tracked(pid_and_tid)) {
+            count_stat(STAT_UNMATCHED_EXITS);
+        }
+        return 0;
+    }
+
+    struct mmap_data_t data = {};
     data.type = 2;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
+    data.pid_and_tid = pid_and_tid;
     data.timestamp = bpf_ktime_get_ns();
 
+    data.requested_addr = args->requested_addr;
+    data.size = args->size;
     data.actual_addr = ctx->ret;
+    data.stack_id = args->stack_id;
+    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    mmap_args.delete(&pid_and_tid);
+
+    if (SYSCALL_FAILED(ctx->ret)) {
+        return 0;
+    }
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -112,6 +261,19 @@ int trace_mmap_exit(struct tracepoint__syscalls__sys_exit_mmap *ctx) {
 
 // ==== mremap ==========================================================================
 
+// Arguments of sys_enter_mremap, kept per thread until sys_exit_mremap
+struct mremap_args_t {
+    u64 old_addr;
+    u64 old_size;
+    u64 new_addr;
+    u64 new_size;
+    u64 flags;
+    s64 stack_id;
+};
+
+BPF_HASH(mremap_args, u64, struct mremap_args_t, 10240);
+
+// Completed mremap call, emitted from sys_exit_mremap
 struct mremap_data_t {
     u64 type;
     u64 pid_and_tid;           // Process ID << 32 | Thread ID
@@ -119,46 +281,63 @@ struct mremap_data_t {
 
     u64 old_addr;               // Original address of the memory region
     u64 old_size;               // Original size of the memory region
-    u64 new_addr;               // New address of the memory region
+    u64 new_addr;               // Requested new address of the memory region
     u64 new_size;               // New size of the memory region
     u64 flags;                  // flags
+    u64 actual_addr;            // New address returned by mremap
     char comm[16];              // Process name
-};
-
-struct mremap_exit_data_t {
-    u64 type;
-    u64 pid_and_tid;           // Process ID << 32 | Thread ID
-    u64 timestamp;
-
-    u64 new_addr;               // New address of the memory region
+    s64 stack_id;               // User stack of the call in stack_traces, or -1
 };
 
 int trace_mremap_enter(struct tracepoint__syscalls__sys_enter_mremap *ctx) {
-    struct mremap_data_t data = {};
-    data.type = 3;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
-    data.timestamp = bpf_ktime_get_ns();
-
-    data.old_addr = ctx->addr;
-    data.old_size = ctx->old_len;
-    data.new_size = ctx->new_len;
-    data.new_addr = ctx->new_addr;
-    data.flags = ctx->flags;
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    if (!is_tracked(pid_and_tid)) {
+        return 0;
+    }
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    struct mremap_args_t args = {};
+    args.old_addr = ctx->addr;
+    args.old_size = ctx->old_len;
+    args.new_size = ctx->new_len;
+    args.new_addr = ctx->new_addr;
+    args.flags = ctx->flags;
+    args.stack_id = capture_stack(ctx);
+    if (mremap_args.insert(&pid_and_tid, &args) != 0) {
+        count_stat(mremap_args.update(&pid_and_tid, &args) == 0 ? STAT_UNMATCHED_ENTERS : STAT_ARGS_MAP_FULL);
+    }
     return 0;
 }
 
 int trace_mremap_exit(struct tracepoint__syscalls__sys_exit_mremap *ctx) {
-    struct mremap_exit_data_t data = {};
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    struct mremap_args_t *args = mremap_args.lookup(&pid_and_tid);
+    if (args == NULL) {
+        if (is_tracked(pid_and_tid)) {
+            count_stat(STAT_UNMATCHED_EXITS);
+        }
+        return 0;
+    }
+
+    struct mremap_data_t data = {};
     data.type = 4;
-    data.pid_and_tid = bpf_get_current_pid_tgid();
+    data.pid_and_tid = pid_and_tid;
     data.timestamp = bpf_ktime_get_ns();
 
-    data.new_addr = ctx->ret; // New address returned by mremap
+    data.old_addr = args->old_addr;
+    data.old_size = args->old_size;
+    data.new_addr = args->new_addr;
+    data.new_size = args->new_size;
+    data.flags = args->flags;
+    data.actual_addr = ctx->ret; // New address returned by mremap
+    data.stack_id = args->stack_id;
+    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+    mremap_args.delete(&pid_and_tid);
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    if (SYSCALL_FAILED(ctx->ret)) {
+        return 0;
+    }
+
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -183,6 +362,9 @@ int trace_munmap(struct tracepoint__syscalls__sys_enter_munmap *ctx) {
     struct munmap_data_t data = {};
     data.type = 5;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!is_tracked(data.pid_and_tid)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     data.start_addr = ctx->addr;
@@ -190,7 +372,46 @@ int trace_munmap(struct tracepoint__syscalls__sys_enter_munmap *ctx) {
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
 
     // Submit the munmap event
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
+    return 0;
+}
+
+// ======================================================================================
+
+
+// ==== page faults =====================================================================
+
+// Page faults of the tracked processes, counted in-kernel per 2 MB bucket of address
+// space instead of being sent one by one, and drained periodically by usage/faults.py
+#define FAULT_BUCKET_SHIFT 21
+
+struct fault_key_t {
+    u32 tgid;
+    u32 padding;
+    u64 bucket;                 // Faulting address >> FAULT_BUCKET_SHIFT
+};
+
+BPF_HASH(page_faults, struct fault_key_t, u64, 65536);
+
+// Attached to handle_mm_fault(vma, address, flags, regs), which every architecture
+// calls for the faults on user addresses
+int trace_page_fault(struct pt_regs *ctx) {
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    if (!is_tracked(pid_and_tid)) {
+        return 0;
+    }
+
+    struct fault_key_t key = {};
+    key.tgid = pid_and_tid >> 32;
+    key.bucket = PT_REGS_PARM2(ctx) >> FAULT_BUCKET_SHIFT;
+
+    u64 zero = 0;
+    u64 *count = page_faults.lookup_or_try_init(&key, &zero);
+    if (count == NULL) {
+        count_stat(STAT_FAULTS_MAP_FULL);
+        return 0;
+    }
+    __sync_fetch_and_add(count, 1);
     return 0;
 }
 
@@ -221,6 +442,9 @@ int trace_clone_enter(struct tracepoint__syscalls__sys_enter_clone *ctx) {
     struct clone_enter_data_t data = {};
     data.type = 8;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!follows_children(data.pid_and_tid)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     data.flags = ctx->clone_flags;
@@ -230,9 +454,10 @@ int trace_clone_enter(struct tracepoint__syscalls__sys_enter_clone *ctx) {
         return 0;
     }
 
+    start_clone(data.pid_and_tid);
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -240,11 +465,14 @@ int trace_clone_exit(struct tracepoint__syscalls__sys_exit_clone *ctx) {
     struct clone_exit_data_t data = {};
     data.type = 9;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!finish_clone(data.pid_and_tid, ctx->ret)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     data.child_pid = ctx->ret;
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -275,8 +503,11 @@ int trace_clone3_enter(struct tracepoint__syscalls__sys_enter_clone3 *ctx) {
     struct clone3_enter_data_t data = {};
     struct clone_args args = {};
     
-    data.type = 10; 
+    data.type = 10;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!follows_children(data.pid_and_tid)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     bpf_probe_read_user(&args, sizeof(args), ctx->uargs);
@@ -286,21 +517,30 @@ int trace_clone3_enter(struct tracepoint__syscalls__sys_enter_clone3 *ctx) {
     data.child_tid = args.child_tid;
     data.parent_tid = args.parent_tid;
 
+    if ((data.flags & 0x00010000) == 0x00010000) {
+        // skip, the thread is being created, not the process
+        return 0;
+    }
+
+    start_clone(data.pid_and_tid);
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
 int trace_clone3_exit(struct tracepoint__syscalls__sys_exit_clone3 *ctx) {
     struct clone3_exit_data_t data = {};
-    data.type = 11; 
+    data.type = 11;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!finish_clone(data.pid_and_tid, ctx->ret)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     data.child_pid = ctx->ret;
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
@@ -330,28 +570,108 @@ struct vfork_exit_data_t {
 #ifdef tracepoint__syscalls__sys_enter_vfork
 int trace_vfork_enter(struct tracepoint__syscalls__sys_enter_vfork *ctx) {
     struct vfork_enter_data_t data = {};
-    data.type = 12; 
+    data.type = 12;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!follows_children(data.pid_and_tid)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
+    start_clone(data.pid_and_tid);
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 
 int trace_vfork_exit(struct tracepoint__syscalls__sys_exit_vfork *ctx) {
     struct vfork_exit_data_t data = {};
-    data.type = 13; 
+    data.type = 13;
     data.pid_and_tid = bpf_get_current_pid_tgid();
+    if (!finish_clone(data.pid_and_tid, ctx->ret)) {
+        return 0;
+    }
     data.timestamp = bpf_ktime_get_ns();
 
     data.child_pid = ctx->ret;
 
-    events.ringbuf_output(&data, sizeof(data), 0);
+    submit(&data, sizeof(data));
     return 0;
 }
 #endif
 
 // ======================================================================================
 
+
+
+// ==== process fork ====================================================================
+
+// sched_process_fork fires in the parent once the child is created, but before it is
+// first scheduled. Tracking the child there, rather than on the clone exit of its
+// parent, keeps the events of its first steps (e.g. the mappings of an exec) from
+// being filtered out: they reach userspace, where the event cache holds them until the
+// clone exit. Only clones marked by start_clone create a process, the others are
+// threads or belong to untracked processes.
+int trace_process_fork(struct tracepoint__sched__sched_process_fork *ctx) {
+    u32 tid = bpf_get_current_pid_tgid();
+    if (pending_clones.lookup(&tid) == NULL) {
+        return 0;
+    }
+    u32 child = ctx->child_pid;
+    u8 mode = TRACK_FULL;
+    tracked_tgids.update(&child, &mode);
+    return 0;
+}
+
+// ======================================================================================
+
+
+
+// ==== process exit ====================================================================
+
+struct exit_data_t {
+    u64 type;
+    u64 pid_and_tid;
+    u64 timestamp;
+
+    char comm[16];
+};
+
+// sched_process_exit fires for every exiting thread, once its address space is
+// released. The arguments the thread left behind (e.g. killed inside an mmap) are
+// dropped, and the process is reported and untracked when its last thread exits.
+// Concurrently exiting threads may both see the last one leave, userspace ignores
+// the second event.
+int trace_process_exit(struct tracepoint__sched__sched_process_exit *ctx) {
+    u64 pid_and_tid = bpf_get_current_pid_tgid();
+    u32 tid = pid_and_tid;
+    brk_args.delete(&pid_and_tid);
+    mmap_args.delete(&pid_and_tid);
+    mremap_args.delete(&pid_and_tid);
+    pending_clones.delete(&tid);
+
+    struct task_struct *task = (struct task_struct *)bpf_get_current_task();
+    if (task->signal->live.counter != 0) {
+        return 0;
+    }
+
+    int tracked = is_tracked(pid_and_tid);
+#ifndef TRACE_ALL_PIDS
+    u32 tgid = pid_and_tid >> 32;
+    tracked_tgids.delete(&tgid);
+#endif
+    if (!tracked) {
+        return 0;
+    }
+
+    struct exit_data_t data = {};
+    data.type = 14;
+    data.pid_and_tid = pid_and_tid;
+    data.timestamp = bpf_ktime_get_ns();
+    bpf_get_current_comm(&data.comm, sizeof(data.comm));
+
+    submit(&data, sizeof(data));
+    return 0;
+}
+
+// ======================================================================================
@@ -0,0 +1,101 @@
+import { useEffect, useRef, useState } from "react";
+
+/** Reply to a heatmap request, see utils/heatmap.py */
+export type HeatmapReply = {
+  id: number | null;
+  pid: number | null;
+  bins: number;
+  /** Address of each bin boundary, bins + 1 of them */
+  addresses: number[];
+  /** Fraction of each bin occupied by allocations */
+  occupancy: number[];
+  /** Address ranges drawn compressed */
+  gaps: [number, number][];
+};
+
+const HEATMAP_COLOR = [38, 150, 207];
+const GAP_COLOR = "#6f6f72";
+
+/** Index of the bin holding address */
+function binOf(addresses: number[], address: number): number {
+  let lo = 0;
+  let hi = addresses.length - 1;
+  while (hi - lo > 1) {
+    const mid = (lo + hi) >> 1;
+    if (addresses[mid] <= address) {
+      lo = mid;
+    } else {
+      hi = mid;
+    }
+  }
+  return lo;
+}
+
+function formatAddress(address: number): string {
+  return "0x" + address.toString(16).toUpperCase();
+}
+
+/**
+ * Occupancy of the address space, one canvas column per bin. The bins are computed by
+ * the server for the width of the strip, so drawing does not depend on the number of
+ * allocations.
+ */
+export function AddressHeatmap({ heatmap }: { heatmap: HeatmapReply | null }) {
+  const canvasRef = useRef<HTMLCanvasElement>(null);
+  const [hovered, setHovered] = useState<number | null>(null);
+
+  useEffect(() => {
+    const canvas = canvasRef.current;
+    const context = canvas?.getContext("2d");
+    if (!canvas || !context) {
+      return;
+    }
+    const { occupancy = [], addresses = [], gaps = [] } = heatmap ?? {};
+    canvas.width = Math.max(occupancy.length, 1);
+    context.clearRect(0, 0, canvas.width, canvas.height);
+
+    const [r, g, b] = HEATMAP_COLOR;
+    occupancy.forEach((value, i) => {
+      if (value > 0) {
+        // Nearly empty bins stay visible
+        context.fillStyle = `rgba(${r}, ${g}, ${b}, ${0.15 + 0.85 * value})`;
+        context.fillRect(i, 0, 1, canvas.height);
+      }
+    });
+
+    context.fillStyle = GAP_COLOR;
+    for (const [start] of gaps) {
+      context.fillRect(binOf(addresses, start), 0, 1, canvas.height);
+    }
+  }, [heatmap]);
+
+  if (!heatmap || heatmap.occupancy.length === 0) {
+    return null;
+  }
+
+  const title =
+    hovered !== null && hovered < heatmap.occupancy.length
+      ? `${formatAddress(heatmap.addresses[hovered])} – ${formatAddress(
+          heatmap.addresses[hovered + 1]
+        )}: ${(heatmap.occupancy[hovered] * 100).toFixed(1)}% allocated`
+      : undefined;
+
+  return (
+    <canvas
+      ref={canvasRef}
+      className="address-heatmap"
+      height={1}
+      title={title}
+      onMouseMove={(e) => {
+        const bounds = e.currentTarget.getBoundingClientRect();
+        setHovered(
+          Math.floor(
+            ((e.clientX - bounds.left) / bounds.width) *
+              heatmap.occupancy.length
+          )
+        );
+      }}
+      onMouseLeave={() => setHovered(null)}
+    />
+  );
+}
@@ -4,7 +4,14 @@ import Visualizer, {
   MemoryUsageDataPoint,
   ByteAddressUnit,
 } from "./Visualizer";
+import { AddressHeatmap, HeatmapReply } from "./AddressHeatmap";
+import { CallSite, CallSitesTable } from "./CallSitesTable";
 import { COLORS } from "./util/colors";
+import {
+  BINARY_PROTOCOL,
+  JSON_PROTOCOL,
+  createBinaryDecoder,
+} from "./util/protocol";
 
 export type AllocationId = number;
 type Time = number;
@@ -15,15 +22,89 @@ function getQueryParam(key: string): string | null {
   return params.get(key);
 }
 
-type IncomingMessage =
+/** Self-instrumentation of the tracer, see utils/instrumentation.py */
+type TracerStats = {
+  uptime_s: number;
+  events: Record<string, number>;
+  unknown_events: number;
+  kernel: Record<string, number>;
+  counters: Record<string, number>;
+  stages: Record<
+    string,
+    {
+      count: number;
+      mean_us: number;
+      p50_us: number;
+      p99_us: number;
+      max_us: number;
+    }
+  >;
+};
+
+type Totals = { bytes: number; pages: number; regions: number };
+
+/** Running totals of the live allocations, see utils/aggregates.py */
+type Summary = {
+  total: Totals;
+  processes: ({ pid: ProcessId } & Totals)[];
+  commands: ({ comm: string } & Totals)[];
+};
+
+/** Buckets of a timeline series: start times, and the last and peak value of each field */
+type TimelineSeries = { time: Time[] } & Record<string, number[]>;
+
+/** Reply to a timeline request, see utils/timeline.py */
+type TimelineReply = {
+  id: number | null;
+  resolution: number;
+  total: TimelineSeries;
+  usage: TimelineSeries;
+  processes: Record<ProcessId, TimelineSeries>;
+};
+
+/** Buckets requested per timeline query, about one per pixel of the usage chart */
+const TIMELINE_POINTS = Math.max(100, Math.round(window.innerWidth));
+/** Milliseconds between two timeline queries */
+const TIMELINE_REFRESH_INTERVAL = 1000;
+/** Bins requested per heatmap query, one per pixel of the heatmap strip */
+const HEATMAP_BINS = Math.max(100, Math.round(window.innerWidth));
+
+/** Log2 histogram, [bucket, count] pairs where bucket i counts the values in [2^(i-1), 2^i) */
+type Log2Histogram = [number, number][];
+
+/** Fragmentation and churn of a process, see utils/analytics.py */
+type ProcessAnalytics = {
+  pid: ProcessId;
+  sizes: Log2Histogram;
+  gaps: Log2Histogram;
+  lifetimes: Log2Histogram;
+  largest_hole: { start: number; size: number } | null;
+  map_rate: number;
+  mapped_rate: number;
+  unmap_rate: number;
+  unmapped_rate: number;
+};
+
+/** Resident pages of a sampled allocation, see usage/residency.py */
+type Residency = {
+  id: AllocationId;
+  pid: ProcessId;
+  pages: number;
+  resident: number;
+  bits: number;
+  bitmap: string;
+};
+
+export type IncomingMessage =
   | {
       type: "add";
       time: Time;
       allocation: {
         id: AllocationId;
         pid: ProcessId;
-        startAddr: number;
-        endAddr: number;
+        /** bigint in binary frames, number (rounded above 2^53) in JSON ones */
+        startAddr: bigint | number;
+        endAddr: bigint | number;
         size: number;
         pages: number;
         comm: string;
@@ -35,6 +116,7 @@ type IncomingMessage =
       id: AllocationId;
       pid: ProcessId;
     }
+  | { type: "pid_exit"; time: Time; pid: ProcessId }
   | {
       type: "usage";
       time: Time;
@@ -42,7 +124,30 @@ type IncomingMessage =
       vm: number;
     }
   | { type: "time"; time: Time }
-  | { type: "catchup"; messages: IncomingMessage[] };
+  | { type: "stats"; stats: TracerStats }
+  | ({ type: "summary"; time: Time } & Summary)
+  | { type: "residency"; time: Time; regions: Residency[] }
+  | {
+      type: "faults";
+      time: Time;
+      regions: { id: AllocationId; pid: ProcessId; faults: number }[];
+      processes: { pid: ProcessId; faults: number; untracked: number }[];
+    }
+  | { type: "callsites"; time: Time; sites: CallSite[] }
+  | { type: "analytics"; time: Time; processes: ProcessAnalytics[] }
+  | ({ type: "timeline" } & TimelineReply)
+  | ({ type: "heatmap" } & HeatmapReply)
+  | { type: "error"; id: number | null; error: string }
+  | { type: "catchup"; messages: IncomingMessage[] }
+  | { type: "batch"; messages: IncomingMessage[] };
+
+/** Bits of a hex-encoded bitmap, most significant bit of each byte first */
+function decodeBitmap(bitmap: string, bits: number): boolean[] {
+  return Array.from(
+    { length: bits },
+    (_, i) => (parseInt(bitmap[i >> 2], 16) & (8 >> (i & 3))) !== 0
+  );
+}
 
 export default function App() {
   const [allocations, setAllocations] = useState<
@@ -60,7 +165,14 @@ export default function App() {
   );
 
   const [maxTime, setMaxTime] = useState<Time>(1);
-  const [usages, addUsage] = useState<MemoryUsageDataPoint[]>([]);
+  const [usages, setUsages] = useState<MemoryUsageDataPoint[]>([]);
+  const [tracerStats, setTracerStats] = useState<TracerStats | null>(null);
+  const [summary, setSummary] = useState<Summary | null>(null);
+  const [heatmap, setHeatmap] = useState<HeatmapReply | null>(null);
+  const [callSites, setCallSites] = useState<CallSite[]>([]);
+  // Read by the heatmap requests, sent from the websocket effect
+  const selectedProcessRef = useRef(selectedProcess);
+  selectedProcessRef.current = selectedProcess;
 
   const initialized = useRef(false);
   useEffect(() => {
@@ -71,27 +183,42 @@ export default function App() {
 
     const port =
       getQueryParam("port") || import.meta.env.REACT_APP_PORT || "8080";
-    const socket = new WebSocket(`ws://localhost:${port}`);
+    const socket = new WebSocket(`ws://localhost:${port}`, [
+      BINARY_PROTOCOL,
+      JSON_PROTOCOL,
+    ]);
+    socket.binaryType = "arraybuffer";
+    const decodeBinaryFrame = createBinaryDecoder();
+    let latestTime = 1;
+    let requestId = 0;
     console.log(`Connecting to WebSocket server at ws://localhost:${port}`);
 
     function handleMessage(message: IncomingMessage) {
       const { type } = message;
 
-      if (type !== "catchup") {
+      if (
+        type !== "catchup" &&
+        type !== "batch" &&
+        type !== "stats" &&
+        type !== "timeline" &&
+        type !== "heatmap" &&
+        type !== "error"
+      ) {
         setMaxTime((t) => Math.max(t, message.time));
+        latestTime = Math.max(latestTime, message.time);
       }
 
       switch (type) {
         case "add":
           setMinAddress((min) =>
             min === null
-              ? message.allocation.startAddr
-              : Math.min(min, message.allocation.startAddr)
+              ? Number(message.allocation.startAddr)
+              : Math.min(min, Number(message.allocation.startAddr))
           );
           setMaxAddress((max) =>
             max === null
-              ? message.allocation.endAddr
-              : Math.max(max, message.allocation.endAddr)
+              ? Number(message.allocation.endAddr)
+              : Math.max(max, Number(message.allocation.endAddr))
           );
 
           setProcessNames((previousNames) => ({
@@ -110,9 +237,9 @@ export default function App() {
               [pid]: {
                 ...(previousAllocations[pid] ?? {}),
                 [id]: {
-                  startAddress: message.allocation.startAddr,
-                  size:
-                    message.allocation.endAddr - message.allocation.startAddr,
+                  startAddress: Number(message.allocation.startAddr),
+                  address: BigInt(message.allocation.startAddr),
+                  size: message.allocation.size,
                   allocatedAt: message.time,
                   freedAt: null,
                   fill: COLORS[Math.floor(Math.random() * COLORS.length)],
@@ -137,20 +264,93 @@ export default function App() {
             };
           });
           break;
+        case "pid_exit":
+          // Frees all the allocations still live in the process
+          setAllocations((previousAllocations) => {
+            const { pid } = message;
+            const allocations = { ...previousAllocations[pid] };
+            for (const [id, allocation] of Object.entries(allocations)) {
+              if (allocation.freedAt === null) {
+                allocations[Number(id)] = {
+                  ...allocation,
+                  freedAt: message.time,
+                };
+              }
+            }
+            return { ...previousAllocations, [pid]: allocations };
+          });
+          break;
         case "usage":
-          addUsage((usages) => [
-            ...usages,
-            {
-              time: message.time,
-              virtualMemoryUsage: message.vm,
-              physicalMemoryUsage: message.rss,
-            },
-          ]);
+          // The usage chart is drawn from the timeline, see requestTimeline
           break;
         case "time":
           setMaxTime((t) => Math.max(t, message.time));
           break;
+        case "stats":
+          setTracerStats(message.stats);
+          break;
+        case "summary":
+          setSummary(message);
+          break;
+        case "residency":
+          setAllocations((previousAllocations) => {
+            const nextAllocations = { ...previousAllocations };
+            for (const { id, pid, resident, bits, bitmap } of message.regions) {
+              const allocation = nextAllocations[pid]?.[id];
+              if (!allocation) {
+                continue;
+              }
+              nextAllocations[pid] = {
+                ...nextAllocations[pid],
+                [id]: {
+                  ...allocation,
+                  residentPages: resident,
+                  residency: decodeBitmap(bitmap, bits),
+                },
+              };
+            }
+            return nextAllocations;
+          });
+          break;
+        case "faults":
+          setAllocations((previousAllocations) => {
+            const nextAllocations = { ...previousAllocations };
+            for (const { id, pid, faults } of message.regions) {
+              const allocation = nextAllocations[pid]?.[id];
+              if (!allocation) {
+                continue;
+              }
+              nextAllocations[pid] = {
+                ...nextAllocations[pid],
+                [id]: { ...allocation, faults },
+              };
+            }
+            return nextAllocations;
+          });
+          break;
+        case "callsites":
+          setCallSites(message.sites);
+          break;
+        case "analytics":
+          // Not displayed, sent with --analytics for the clients that chart it
+          break;
+        case "timeline":
+          setUsages(
+            message.usage.time.map((time, i) => ({
+              time,
+              virtualMemoryUsage: message.usage.vm[i],
+              physicalMemoryUsage: message.usage.rss[i],
+            }))
+          );
+          break;
+        case "heatmap":
+          setHeatmap(message);
+          break;
+        case "error":
+          console.warn(`Request ${message.id} failed: ${message.error}`);
+          break;
         case "catchup":
+        case "batch":
           message.messages.forEach(handleMessage);
           break;
         default:
@@ -159,13 +359,75 @@ export default function App() {
       }
     }
 
+    // The whole trace at about one bucket per pixel, whatever its length
+    function requestTimeline() {
+      if (socket.readyState !== WebSocket.OPEN) {
+        return;
+      }
+      socket.send(
+        JSON.stringify({
+          type: "timeline",
+          id: requestId++,
+          start: 0,
+          end: latestTime,
+          points: TIMELINE_POINTS,
+        })
+      );
+    }
+
+    // Occupancy of the address space of the selected process, binned by the server
+    function requestHeatmap() {
+      if (socket.readyState !== WebSocket.OPEN) {
+        return;
+      }
+      const pid = selectedProcessRef.current;
+      socket.send(
+        JSON.stringify({
+          type: "heatmap",
+          id: requestId++,
+          pid: pid === "all" ? null : pid,
+          bins: HEATMAP_BINS,
+        })
+      );
+    }
+    setInterval(() => {
+      requestTimeline();
+      requestHeatmap();
+    }, TIMELINE_REFRESH_INTERVAL);
+
     socket.onmessage = (event) => {
-      handleMessage(JSON.parse(event.data));
+      if (event.data instanceof ArrayBuffer) {
+        decodeBinaryFrame(event.data).forEach(handleMessage);
+      } else {
+        handleMessage(JSON.parse(event.data));
+      }
     };
   }, []);
+  const lostEvents = tracerStats
+    ? tracerStats.kernel.ringbuf_drops +
+      tracerStats.kernel.unmatched_exits +
+      tracerStats.counters.unmatched_clone_exits
+    : 0;
+
   return (
     <div className="app">
       <nav className="nav">
+        <p className="tracer-status">
+          {summary &&
+            `${summary.total.regions} allocations, ${(
+              summary.total.bytes /
+              1024 /
+              1024
+            ).toFixed(1)} MB in ${summary.processes.length} processes`}
+          {lostEvents > 0 && (
+            <span
+              className="tracer-warning"
+              title="Events dropped by the kernel or missing their syscall enter, the allocations may be incomplete"
+            >
+              {lostEvents} events lost
+            </span>
+          )}
+        </p>
         <h1>Memory Allocation Visualizer</h1>
 
         <label className="process-selector">
@@ -186,6 +448,8 @@ export default function App() {
             ))}
           </select>
         </label>
+
+        <AddressHeatmap heatmap={heatmap} />
       </nav>
 
       <Visualizer
@@ -203,6 +467,14 @@ export default function App() {
         maxTime={maxTime}
         usage={usages}
       />
+
+      <CallSitesTable
+        sites={
+          selectedProcess === "all"
+            ? callSites
+            : callSites.filter((site) => site.pid === selectedProcess)
+        }
+      />
     </div>
   );
 }
@@ -0,0 +1,86 @@
+import { useState } from "react";
+import { humanFileSize } from "./Visualizer";
+
+/** Row of a "callsites" message, see utils/callsites.py */
+export type CallSite = {
+  pid: number;
+  stack: number;
+  /** Innermost frame first */
+  frames: string[];
+  bytes: number;
+  regions: number;
+  /** Per second, over the last interval */
+  allocated_rate: number;
+  allocation_rate: number;
+  freed_rate: number;
+};
+
+/** Rows shown, the server sends the top call sites by live bytes and by allocation rate */
+const CALL_SITES_SHOWN = 10;
+
+/** Frames of the allocation functions themselves, skipped to name a call site */
+const ALLOCATOR_FRAME =
+  /^(mmap|mmap64|__mmap|mremap|__mremap|brk|__brk|sbrk|__sbrk|__libc_|_int_|sysmalloc|malloc|calloc|realloc)/;
+
+function callSiteName(frames: string[]): string {
+  return (
+    frames.find((frame) => !ALLOCATOR_FRAME.test(frame)) ??
+    frames[0] ??
+    "unknown"
+  );
+}
+
+export function CallSitesTable({ sites }: { sites: CallSite[] }) {
+  const [sortByChurn, setSortByChurn] = useState(false);
+  if (sites.length === 0) {
+    return null;
+  }
+
+  const shown = [...sites]
+    .sort((a, b) =>
+      sortByChurn ? b.allocated_rate - a.allocated_rate : b.bytes - a.bytes
+    )
+    .slice(0, CALL_SITES_SHOWN);
+
+  return (
+    <table className="call-sites">
+      <thead>
+        <tr>
+          <th>Call site</th>
+          <th>PID</th>
+          <th
+            className={sortByChurn ? "" : "sorted"}
+            onClick={() => setSortByChurn(false)}
+          >
+            Live
+          </th>
+          <th
+            className={sortByChurn ? "sorted" : ""}
+            onClick={() => setSortByChurn(true)}
+          >
+            Allocated/s
+          </th>
+          <th>Freed/s</th>
+        </tr>
+      </thead>
+      <tbody>
+        {shown.map((site) => (
+          <tr
+            key={`${site.pid}-${site.stack}`}
+            title={site.frames.join("\n")}
+          >
+            <td>{callSiteName(site.frames)}</td>
+            <td>{site.pid}</td>
+            <td>
+              {humanFileSize(site.bytes)} ({site.regions})
+            </td>
+            <td>
+              {humanFileSize(site.allocated_rate)} ({site.allocation_rate})
+            </td>
+            <td>{humanFileSize(site.freed_rate)}</td>
+          </tr>
+        ))}
+      </tbody>
+    </table>
+  );
+}
@@ -20,6 +20,8 @@ const ADDRESS_MAX: ByteAddressUnit = 2 ** 48 - 1;
 
 export type Allocation = {
   startAddress: ByteAddressUnit;
+  /** Exact start address, startAddress is only used for drawing */
+  address: bigint;
   size: ByteAddressUnit;
 
   allocatedAt: Time;
@@ -27,6 +29,12 @@ export type Allocation = {
 
   fill: string;
   command: string;
+
+  /** Sampled with --residency: resident pages, and which parts of the allocation are mostly resident */
+  residentPages?: number;
+  residency?: boolean[];
+  /** Counted with --faults: page faults in the allocation so far */
+  faults?: number;
 };
 
 export type MemoryUsageDataPoint = {
@@ -406,12 +414,12 @@ function AllocationRect({
           >
             <h3 className="tooltip-address">
               0x
-              {allocation.startAddress
+              {allocation.address
                 .toString(16)
                 .toUpperCase()
                 .padStart(12, "0")}{" "}
               – 0x
-              {(allocation.startAddress + allocation.size)
+              {(allocation.address + BigInt(allocation.size))
                 .toString(16)
                 .toUpperCase()
                 .padStart(12, "0")}
@@ -430,7 +438,31 @@ function AllocationRect({
                 <h4>Command</h4>
                 <p>{allocation.command}</p>
               </div>
+              {allocation.residentPages !== undefined && (
+                <div>
+                  <h4>Resident</h4>
+                  <p>{allocation.residentPages.toLocaleString()}</p>
+                </div>
+              )}
+              {allocation.faults !== undefined && (
+                <div>
+                  <h4>Faults</h4>
+                  <p>{allocation.faults.toLocaleString()}</p>
+                </div>
+              )}
             </div>
+            {allocation.residency && (
+              <div className="tooltip-residency">
+                {allocation.residency.map((resident, i) => (
+                  <span
+                    key={i}
+                    style={{
+                      background: resident ? allocation.fill : "transparent",
+                    }}
+                  />
+                ))}
+              </div>
+            )}
           </div>,
           document.body
         )}
@@ -517,7 +549,7 @@ function clamp(min: number, value: number, max: number): number {
  *
  * @return Formatted string.
  */
-function humanFileSize(bytes: number, si = false, dp = 1) {
+export function humanFileSize(bytes: number, si = false, dp = 1) {
   const thresh = si ? 1000 : 1024;
 
   if (Math.abs(bytes) < thresh) {
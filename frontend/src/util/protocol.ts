@@ -0,0 +1,107 @@
+import { IncomingMessage } from "../App";
+
+/**
+ * Websocket subprotocols understood by the server, in order of preference.
+ * The record layouts below mirror utils/protocol.py.
+ */
+export const BINARY_PROTOCOL = "smv.binary.v1";
+export const JSON_PROTOCOL = "smv.json";
+
+const TAG_COMM = 0;
+const TAG_ADD = 1;
+const TAG_REMOVE = 2;
+const TAG_USAGE = 3;
+const TAG_TIME = 4;
+const TAG_JSON = 255;
+
+const textDecoder = new TextDecoder();
+
+/**
+ * Creates a decoder for the binary frames of one connection. The command
+ * table is sent once per connection, so the decoder keeps it between frames.
+ *
+ * Addresses are kept as bigints, since numbers are only exact up to 2^53.
+ * Sizes and page counts are converted to numbers.
+ */
+export function createBinaryDecoder() {
+  const comms: string[] = [];
+
+  return function decode(buffer: ArrayBuffer): IncomingMessage[] {
+    const view = new DataView(buffer);
+    const messages: IncomingMessage[] = [];
+    let offset = 0;
+
+    while (offset < view.byteLength) {
+      const tag = view.getUint8(offset);
+      switch (tag) {
+        case TAG_COMM: {
+          const index = view.getUint32(offset + 1, true);
+          const length = view.getUint8(offset + 5);
+          comms[index] = textDecoder.decode(
+            new Uint8Array(buffer, offset + 6, length)
+          );
+          offset += 6 + length;
+          break;
+        }
+        case TAG_ADD: {
+          const startAddr = view.getBigUint64(offset + 25, true);
+          const endAddr = view.getBigUint64(offset + 33, true);
+          messages.push({
+            type: "add",
+            time: Number(view.getBigInt64(offset + 1, true)),
+            allocation: {
+              id: Number(view.getBigUint64(offset + 9, true)),
+              pid: view.getUint32(offset + 17, true),
+              comm: comms[view.getUint32(offset + 21, true)],
+              startAddr,
+              endAddr,
+              size: Number(endAddr - startAddr),
+              pages: Number(view.getBigUint64(offset + 41, true)),
+            },
+          });
+          offset += 49;
+          break;
+        }
+        case TAG_REMOVE:
+          messages.push({
+            type: "remove",
+            time: Number(view.getBigInt64(offset + 1, true)),
+            id: Number(view.getBigUint64(offset + 9, true)),
+            pid: view.getUint32(offset + 17, true),
+          });
+          offset += 21;
+          break;
+        case TAG_USAGE:
+          messages.push({
+            type: "usage",
+            time: Number(view.getBigInt64(offset + 1, true)),
+            rss: Number(view.getBigUint64(offset + 9, true)),
+            vm: Number(view.getBigUint64(offset + 17, true)),
+          });
+          offset += 25;
+          break;
+        case TAG_TIME:
+          messages.push({
+            type: "time",
+            time: Number(view.getBigInt64(offset + 1, true)),
+          });
+          offset += 9;
+          break;
+        case TAG_JSON: {
+          const length = view.getUint32(offset + 1, true);
+          messages.push(
+            JSON.parse(
+              textDecoder.decode(new Uint8Array(buffer, offset + 5, length))
+            )
+          );
+          offset += 5 + length;
+          break;
+        }
+        default:
+          throw new Error("Invalid record tag: " + tag);
+      }
+    }
+
+    return messages;
+  };
+}
@@ -1,29 +1,36 @@
 #!/usr/bin/python3
 
-from bcc import BPF
 from tracers.event_cache import EventCache
-from tracers.events import handle_event, set_tracker_pid
+from tracers.events import handle_event, replay_cached_events, set_tracker_pid
 from utils.tracker import MemoryTracker
-from usage.usage import USAGE_INTERVAL, fetch_usage_loop
+from usage.usage import USAGE_INTERVAL, fetch_usage_loop, fetch_total_usage_loop, list_pids
+from usage.maps import RECONCILE_INTERVAL, reconcile_loop, reconcile_pid
+from usage.residency import RESIDENCY_BUDGET, fetch_residency_loop
+from usage.faults import FAULT_INTERVAL, fetch_faults_loop
 from utils.runner import Runner
 from tracers.common import PAGE_SIZE
+from tracers.tracked_pids import TrackedPids, AllPids
+from tracers.attach import CGROUP_ROOT, cgroup_path, cgroup_pids, process_tree
+from utils.recording import TraceReader, TraceWriter, replay
+from utils.pipeline import Pipeline
+from utils.callsites import CALL_SITES_INTERVAL, publish_call_sites_loop
+from utils.analytics import ANALYTICS_INTERVAL, publish_analytics_loop
+from utils.symbols import Symbolizer
+from tracers.batch import BatchDecoder
+from utils.instrumentation import KERNEL_COUNTERS, start_text_endpoint, stats
+from utils.server import HISTORY_RETENTION, KEYFRAME_INTERVAL
+from ctypes import c_int
 import threading
 import time
 import subprocess
 import os
 import re
 import atexit
+import argparse
 
 
-# Initialize Runner
-runner = Runner()
-# Initialize MemoryTracker
-tracker = MemoryTracker(PAGE_SIZE)
-# Create event cache
-event_cache = EventCache()
-# Create tracked PID set
-tracked_pids_lock = threading.Lock()
-tracked_pids = set()
+# Interval at which the tracked PID set is synced from the in-kernel filter
+PID_SYNC_INTERVAL_MS = 1000
 
 
 import threading, sys, traceback
@@ -126,56 +133,6 @@ def run_web_gui():
             os.killpg(os.getpgid(process.pid), signal.SIGTERM)
 
 
-if len(sys.argv) < 2:
-    print("Usage: sudo ./main.py <command | all>")
-    sys.exit(1)
-
-print(f"Page size: {PAGE_SIZE} bytes")
-
-
-# Start the usage thread
-print(f"Starting usage thread with sleep interval of {USAGE_INTERVAL} seconds")
-usage_thread = threading.Thread(target=fetch_usage_loop, args=[tracker, tracked_pids_lock, tracked_pids], daemon=True)
-usage_thread.start()
-print("Started usage thread")
-
-print("Tracing and reporting events... Ctrl-C to stop.")
-
-# Start the web GUI
-web_gui_thread = threading.Thread(target=run_web_gui, daemon=True)
-web_gui_thread.start()
-
-
-print("Initializing BPF programs...")
-
-bpf_file = BPF(src_file="bpf.c")
-print("\t Loaded BPF program successfully")
-
-# Attach tracepoints
-print("Attaching tracepoints...")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_mmap", fn_name="trace_mmap_enter")
-print("\t Attached to sys_enter_mmap")
-bpf_file.attach_tracepoint(tp="syscalls:sys_exit_mmap", fn_name="trace_mmap_exit")
-print("\t Attached to sys_exit_mmap")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_munmap", fn_name="trace_munmap")
-print("\t Attached to sys_enter_munmap")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_mremap", fn_name="trace_mremap_enter")
-print("\t Attached to sys_enter_mremap")
-bpf_file.attach_tracepoint(tp="syscalls:sys_exit_mremap", fn_name="trace_mremap_exit")
-print("\t Attached to sys_exit_mremap")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_brk", fn_name="trace_brk_enter")
-print("\t Attached to sys_enter_brk")
-bpf_file.attach_tracepoint(tp="syscalls:sys_exit_brk", fn_name="trace_brk_exit")
-print("\t Attached to sys_exit_brk")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_clone", fn_name="trace_clone_enter")
-print("\t Attached to sys_enter_clone")
-bpf_file.attach_tracepoint(tp="syscalls:sys_exit_clone", fn_name="trace_clone_exit")
-print("\t Attached to sys_exit_clone")
-bpf_file.attach_tracepoint(tp="syscalls:sys_enter_clone3", fn_name="trace_clone3_enter")
-print("\t Attached to sys_enter_clone3")
-bpf_file.attach_tracepoint(tp="syscalls:sys_exit_clone3", fn_name="trace_clone3_exit")
-print("\t Attached to sys_exit_clone3")
-
 def attach_tracepoint_if_exists(bpf, tp, fn_name):
     try:
         bpf.attach_tracepoint(tp=tp, fn_name=fn_name)
@@ -183,25 +140,325 @@ def attach_tracepoint_if_exists(bpf, tp, fn_name):
     except Exception as e:
         print(f"\t Ignoring tracepoint {tp}: {e}")
 
-attach_tracepoint_if_exists(bpf_file, "syscalls:sys_enter_vfork", "trace_vfork_enter")
-attach_tracepoint_if_exists(bpf_file, "syscalls:sys_exit_vfork", "trace_vfork_exit")
 
-pid = os.getpid()
-set_tracker_pid(pid)
-print("Tracker PID set to", pid)
+def run_live(args):
+    from bcc import BPF
+
+    # In "all" mode every process is traced and the in-kernel PID filter is compiled out
+    trace_all = args.command == ["all"]
+    attach = bool(args.pid or args.cgroup)
+
+    # Create tracked PID set
+    tracked_pids = AllPids() if trace_all else TrackedPids()
+
+    # Decode the events in worker processes, or inline on the polling thread
+    pipeline = None
+    if args.workers > 0:
+        pipeline = Pipeline(args.workers, tracker, tracked_pids, event_cache)
+        print(f"Started {args.workers} decoding workers")
+        if args.workers >= os.cpu_count():
+            print(f"Warning: the {args.workers} workers and the polling thread share {os.cpu_count()} CPUs, "
+                  f"decoding on the polling thread is faster")
+    usage_tracker = pipeline if pipeline is not None else tracker
+
+    # Or decode them in bulk after each poll
+    decoder = BatchDecoder(tracker, tracked_pids, event_cache) if args.batch else None
+
+    # Start the usage thread
+    print(f"Starting usage thread with sleep interval of {args.usage_interval} seconds")
+    if trace_all:
+        usage_thread = threading.Thread(target=fetch_total_usage_loop,
+                                        args=[usage_tracker, args.usage_interval, args.usage_threads], daemon=True)
+    else:
+        usage_thread = threading.Thread(target=fetch_usage_loop,
+                                        args=[usage_tracker, tracked_pids, args.usage_interval, args.usage_threads],
+                                        daemon=True)
+    usage_thread.start()
+    print("Started usage thread")
+
+    if args.residency is not None:
+        residency_thread = threading.Thread(target=fetch_residency_loop, args=[usage_tracker, args.residency],
+                                            daemon=True)
+        residency_thread.start()
+        print(f"Sampling resident pages, up to {args.residency} pages per second")
+
+    if args.analytics is not None:
+        threading.Thread(target=publish_analytics_loop, args=[usage_tracker, args.analytics], daemon=True).start()
+        print(f"Sending the fragmentation and churn analytics every {args.analytics} seconds")
+
+    print("Tracing and reporting events... Ctrl-C to stop.")
+
+    # Start the web GUI
+    web_gui_thread = threading.Thread(target=run_web_gui, daemon=True)
+    web_gui_thread.start()
+
+
+    print("Initializing BPF programs...")
+
+    cflags = []
+    if trace_all:
+        cflags.append("-DTRACE_ALL_PIDS")
+    if args.stacks is not None:
+        cflags.append("-DCAPTURE_STACKS")
+    bpf_file = BPF(src_file="bpf.c", cflags=cflags)
+    print("\t Loaded BPF program successfully")
+
+    # Events lost in the kernel are counted per CPU
+    kernel_stats = bpf_file["stats"]
+    stats.set_kernel_counters(lambda: [kernel_stats.sum(c_int(i)).value for i in range(len(KERNEL_COUNTERS))])
+
+    # Attach tracepoints
+    print("Attaching tracepoints...")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_mmap", fn_name="trace_mmap_enter")
+    print("\t Attached to sys_enter_mmap")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_exit_mmap", fn_name="trace_mmap_exit")
+    print("\t Attached to sys_exit_mmap")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_munmap", fn_name="trace_munmap")
+    print("\t Attached to sys_enter_munmap")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_mremap", fn_name="trace_mremap_enter")
+    print("\t Attached to sys_enter_mremap")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_exit_mremap", fn_name="trace_mremap_exit")
+    print("\t Attached to sys_exit_mremap")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_brk", fn_name="trace_brk_enter")
+    print("\t Attached to sys_enter_brk")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_exit_brk", fn_name="trace_brk_exit")
+    print("\t Attached to sys_exit_brk")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_clone", fn_name="trace_clone_enter")
+    print("\t Attached to sys_enter_clone")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_exit_clone", fn_name="trace_clone_exit")
+    print("\t Attached to sys_exit_clone")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_enter_clone3", fn_name="trace_clone3_enter")
+    print("\t Attached to sys_enter_clone3")
+    bpf_file.attach_tracepoint(tp="syscalls:sys_exit_clone3", fn_name="trace_clone3_exit")
+    print("\t Attached to sys_exit_clone3")
+
+    if not trace_all:
+        bpf_file.attach_tracepoint(tp="sched:sched_process_fork", fn_name="trace_process_fork")
+        print("\t Attached to sched_process_fork")
+    bpf_file.attach_tracepoint(tp="sched:sched_process_exit", fn_name="trace_process_exit")
+    print("\t Attached to sched_process_exit")
+
+    attach_tracepoint_if_exists(bpf_file, "syscalls:sys_enter_vfork", "trace_vfork_enter")
+    attach_tracepoint_if_exists(bpf_file, "syscalls:sys_exit_vfork", "trace_vfork_exit")
+
+    if args.stacks is not None:
+        symbolizer = Symbolizer(bpf_file["stack_traces"])
+        threading.Thread(target=publish_call_sites_loop, args=[usage_tracker, symbolizer, args.stacks],
+                         daemon=True).start()
+        print(f"Capturing the user stacks of the allocations, top call sites sent every {args.stacks} seconds")
+
+    if args.faults is not None:
+        bpf_file.attach_kprobe(event="handle_mm_fault", fn_name="trace_page_fault")
+        print("\t Attached to handle_mm_fault")
+        threading.Thread(target=fetch_faults_loop, args=[usage_tracker, bpf_file["page_faults"], args.faults],
+                         daemon=True).start()
+        print(f"Counting page faults, drained every {args.faults} seconds")
+
+    pid = os.getpid()
+    set_tracker_pid(pid)
+    print("Tracker PID set to", pid)
+
+    attached_pids = set()
+    if args.pid:
+        attached_pids = process_tree(args.pid)
+    elif args.cgroup:
+        attached_pids = cgroup_pids(args.cgroup)
+    attached_pids.discard(pid)
+
+    if not trace_all:
+        tracked_pids.attach(bpf_file["tracked_tgids"])
+        if attach:
+            # Running processes, their new children are added to the filter in-kernel
+            for attached_pid in attached_pids:
+                tracked_pids.add(attached_pid)
+            print(f"Attached to {len(attached_pids)} processes: {sorted(attached_pids)}")
+        else:
+            # Children of the tracker (the traced command) are added to the filter in-kernel
+            tracked_pids.follow_children(pid)
+
+    recorder = None
+    if args.record:
+        recorder = TraceWriter(args.record, {
+            "tracker_pid": pid,
+            "trace_all": trace_all,
+            "tracked_pids": sorted(tracked_pids.copy()),
+            "page_size": PAGE_SIZE,
+        })
+        print(f"Recording events to {args.record}")
+
+    def handle_ring_buffer_event(cpu, raw_data, size):
+        if recorder is not None:
+            recorder.record(raw_data, size)
+        if pipeline is not None:
+            pipeline.dispatch(cpu, raw_data, size)
+        elif decoder is not None:
+            decoder.add(cpu, raw_data, size)
+        else:
+            handle_event(cpu, raw_data, size, tracker, tracked_pids, event_cache)
+
+    bpf_file["events"].open_ring_buffer(handle_ring_buffer_event)
+
+    if pipeline is not None:
+        reconcile = pipeline.reconcile_pid
+    else:
+        reconcile = lambda pid: reconcile_pid(tracker, pid)
 
-bpf_file["events"].open_ring_buffer(
-    lambda cpu, raw_data, size: handle_event(cpu, raw_data, size, tracker, tracked_pids, event_cache)
-)
+    if args.reconcile is not None:
+        # Started once the events flow, so that the first pass seeds the processes already running
+        if trace_all:
+            reconcile_pids = lambda: [pid for pid in list_pids() if pid != os.getpid()]
+        else:
+            reconcile_pids = tracked_pids.copy
+        threading.Thread(target=reconcile_loop, args=[reconcile, reconcile_pids, args.reconcile], daemon=True).start()
+        print(f"Reconciling the allocations with /proc/<pid>/maps every {args.reconcile} seconds")
+    else:
+        # The existing mappings of the attached processes, now that their events flow
+        for attached_pid in attached_pids:
+            reconcile(attached_pid)
+
+    if not trace_all and not attach:
+        runner.run_command(args.command)
+
+    # Handle exit and cleanup
+    try:
+        next_pid_sync = time.time()
+        while True:
+            bpf_file.ring_buffer_poll(PID_SYNC_INTERVAL_MS)
+            if pipeline is not None:
+                pipeline.flush()
+            if decoder is not None:
+                decoder.flush()
+            if time.time() >= next_pid_sync:
+                # Children inserted by sched_process_fork before their clone exit arrived, whose
+                # cached events must be applied before any later one
+                tracked_pids.sync(lambda pid: replay_cached_events(pid, tracked_pids, tracker, event_cache))
+                if args.cgroup:
+                    # Processes moved into the cgroup, rather than forked by one of its members
+                    for joined_pid in cgroup_pids(args.cgroup) - tracked_pids.copy():
+                        tracked_pids.add(joined_pid)
+                        reconcile(joined_pid)
+                next_pid_sync = time.time() + PID_SYNC_INTERVAL_MS / 1000
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        runner.cleanup()
+        if recorder is not None:
+            recorder.close()
+        if pipeline is not None:
+            pipeline.close()
 
-command = sys.argv[1:]
-parent_pid = runner.run_command(command)
 
-# Handle exit and cleanup
-try:
-    while True:
-        bpf_file.ring_buffer_poll()
-except KeyboardInterrupt:
-    print("Exiting...")
-finally:
-    runner.cleanup()
+def run_replay(args):
+    """Feed a recorded trace through the tracker, without BPF or root privileges."""
+    reader = TraceReader(args.replay)
+    metadata = reader.metadata
+    first_ts, last_ts = reader.time_range()
+    print(f"Replaying {args.replay}: {len(reader.index)} chunks, {(last_ts - first_ts) / 1e9:.2f} seconds "
+          f"at speed {args.speed if args.speed > 0 else 'max'}")
+
+    set_tracker_pid(metadata["tracker_pid"])
+    tracked_pids = AllPids() if metadata["trace_all"] else TrackedPids(metadata["tracked_pids"])
+
+    web_gui_thread = threading.Thread(target=run_web_gui, daemon=True)
+    web_gui_thread.start()
+
+    if args.analytics is not None:
+        threading.Thread(target=publish_analytics_loop, args=[tracker, args.analytics], daemon=True).start()
+
+    try:
+        if args.batch:
+            decoder = BatchDecoder(tracker, tracked_pids, event_cache)
+            replay(reader, args.speed, decoder.add, before_sleep=decoder.flush)
+            decoder.flush()
+        else:
+            replay(reader, args.speed,
+                   lambda cpu, raw_data, size: handle_event(cpu, raw_data, size, tracker, tracked_pids, event_cache))
+        print("Replay finished, Ctrl-C to stop.")
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        reader.close()
+
+
+# The decoding workers are spawned processes that import this module again, so
+# nothing below may run in them
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="sudo ./main.py [--record FILE] [--workers N | --batch] <command | all>\n"
+                                           "       sudo ./main.py [options] --pid N[,M...] | --cgroup PATH\n"
+                                           "       ./main.py --replay FILE [--speed X] [--batch]")
+    parser.add_argument("--record", metavar="FILE", help="also append the raw events to a trace file")
+    parser.add_argument("--replay", metavar="FILE", help="replay a recorded trace instead of tracing live")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to the recording, 0 replays as fast as possible")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of processes decoding the events, 0 decodes on the polling thread")
+    parser.add_argument("--batch", action="store_true",
+                        help="decode the events of each poll in bulk with NumPy instead of one at a time "
+                             "(only speeds up decoding, off by default)")
+    parser.add_argument("--stats-port", type=int, metavar="PORT",
+                        help="serve the tracer statistics as plain text on this local port (0 picks one)")
+    parser.add_argument("--usage-interval", type=float, default=USAGE_INTERVAL, metavar="SECONDS",
+                        help="interval between two samples of the memory usage of the processes")
+    parser.add_argument("--usage-threads", type=int, default=0, metavar="N",
+                        help="threads reading the memory usage when many processes are sampled")
+    parser.add_argument("--residency", type=int, nargs="?", const=RESIDENCY_BUDGET, metavar="PAGES",
+                        help="sample the resident pages of the allocations, reading at most PAGES pages per second")
+    parser.add_argument("--stacks", type=float, nargs="?", const=CALL_SITES_INTERVAL, metavar="SECONDS",
+                        help="capture the user stack of each allocation and send the top call sites every SECONDS")
+    parser.add_argument("--faults", type=float, nargs="?", const=FAULT_INTERVAL, metavar="SECONDS",
+                        help="count the page faults of the allocations in-kernel, drained every SECONDS")
+    parser.add_argument("--activity", action="store_true",
+                        help="count the live bytes and the map and unmap rates of each thread and command")
+    parser.add_argument("--analytics", type=float, nargs="?", const=ANALYTICS_INTERVAL, metavar="SECONDS",
+                        help="send the fragmentation and churn histograms of each process every SECONDS")
+    parser.add_argument("--reconcile", type=float, nargs="?", const=RECONCILE_INTERVAL, metavar="SECONDS",
+                        help="correct the allocations from /proc/<pid>/maps, on start and then every SECONDS")
+    parser.add_argument("--history", type=float, default=HISTORY_RETENTION, metavar="SECONDS",
+                        help="seconds of events kept to be replayed to new web GUI clients")
+    parser.add_argument("--keyframe-interval", type=float, default=KEYFRAME_INTERVAL, metavar="SECONDS",
+                        help="interval between two snapshots of the live allocations, from which new clients start")
+    parser.add_argument("--pid", type=lambda value: [int(pid) for pid in value.split(",")], metavar="N[,M...]",
+                        help="attach to running processes and their descendants instead of running a command")
+    parser.add_argument("--cgroup", metavar="PATH",
+                        help="attach to the processes of a cgroup, absolute or relative to " + CGROUP_ROOT)
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="command to trace, or 'all'")
+    args = parser.parse_args()
+
+    if not args.command and not args.replay and not args.pid and not args.cgroup:
+        parser.print_usage()
+        sys.exit(1)
+    if (args.pid or args.cgroup) and (args.command or args.replay):
+        parser.error("--pid and --cgroup attach to running processes, without a command to trace")
+    if args.pid and args.cgroup:
+        parser.error("--pid and --cgroup are alternative ways of choosing the processes")
+    if args.cgroup:
+        try:
+            args.cgroup = cgroup_path(args.cgroup)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.batch and args.workers > 0:
+        parser.error("--batch and --workers are alternative ways of decoding the events")
+    if args.history < 0 or args.keyframe_interval <= 0:
+        parser.error("--history cannot be negative and --keyframe-interval must be positive")
+
+    if args.stats_port is not None:
+        port = start_text_endpoint(args.stats_port)
+        print(f"Tracer statistics available at http://127.0.0.1:{port}/")
+
+    # Initialize Runner
+    runner = Runner()
+    # Initialize MemoryTracker
+    tracker = MemoryTracker(PAGE_SIZE, activity=args.activity, analytics=args.analytics is not None,
+                            server_options={"keyframe_interval": args.keyframe_interval,
+                                            "history_retention": args.history})
+    # Create event cache
+    event_cache = EventCache()
+
+    print(f"Page size: {PAGE_SIZE} bytes")
+
+    if args.replay:
+        run_replay(args)
+    else:
+        run_live(args)
@@ -0,0 +1,58 @@
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def parent_pids():
+    """Return {pid: parent pid} for every process, from /proc/<pid>/stat."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isnumeric():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as file:
+                stat = file.read()
+        except OSError:
+            continue  # exited meanwhile
+        # The command name is in parentheses and may contain spaces and parentheses
+        fields = stat[stat.rindex(b")") + 2:].split()
+        parents[int(entry)] = int(fields[1])
+    return parents
+
+
+def process_tree(pids):
+    """Return the given PIDs and all their descendants that are still running."""
+    children = {}
+    for pid, parent in parent_pids().items():
+        children.setdefault(parent, []).append(pid)
+
+    tree = set()
+    pending = [pid for pid in pids if os.path.exists(f"/proc/{pid}")]
+    while pending:
+        pid = pending.pop()
+        if pid not in tree:
+            tree.add(pid)
+            pending.extend(children.get(pid, ()))
+    return tree
+
+
+def cgroup_path(path):
+    """Resolve a cgroup given as a directory, or relative to the cgroup mount point."""
+    for candidate in (path, os.path.join(CGROUP_ROOT, path.lstrip("/"))):
+        if os.path.isfile(os.path.join(candidate, "cgroup.procs")):
+            return candidate
+    raise ValueError(f"{path} is not a cgroup directory")
+
+
+def cgroup_pids(path):
+    """Return the PIDs of the processes in the cgroup at path and its descendant cgroups."""
+    pids = set()
+    for directory, _, files in os.walk(path):
+        if "cgroup.procs" not in files:
+            continue
+        try:
+            with open(os.path.join(directory, "cgroup.procs")) as file:
+                pids.update(int(line) for line in file if line.strip())
+        except OSError:
+            continue  # removed meanwhile
+    return pids
@@ -0,0 +1,214 @@
+from ctypes import addressof, c_char, c_void_p, memmove, sizeof
+
+from time import perf_counter_ns
+
+import numpy as np
+
+from tracers.common import *
+from tracers.events import handle_event
+from tracers.mremap import apply_mremap
+from tracers.tracked_pids import AllPids
+from utils.instrumentation import stats
+from utils.tracker import MemoryTracker
+
+BATCH_CAPACITY = 4096  # records decoded at once, more trigger an early flush
+
+# Records are copied into fixed-size slots so that a whole batch can be viewed as one
+# NumPy array per event type, whatever the order of the types
+EVENT_STRUCTURES = {
+    2: MmapEvent,
+    4: MremapEvent,
+    5: MunmapEvent,
+    7: BrkEvent,
+    8: CloneEnterEvent,
+    9: CloneExitEvent,
+    10: Clone3EnterEvent,
+    11: Clone3ExitEvent,
+    12: VforkEnterEvent,
+    13: VforkExitEvent,
+    14: ProcessExitEvent,
+}
+RECORD_STRIDE = (max(sizeof(structure) for structure in EVENT_STRUCTURES.values()) + 7) & ~7
+
+MEMORY_EVENT_TYPES = [2, 4, 5, 7]
+
+
+def _strided_dtype(structure):
+    """NumPy dtype with the layout of a ctypes structure, padded to the slot size."""
+    dtype = np.dtype(structure)
+    formats = []
+    for name in dtype.names:
+        format = dtype.fields[name][0]
+        if format.subdtype is not None and format.subdtype[0] == np.dtype("S1"):
+            format = np.dtype(f"S{format.subdtype[1][0]}")  # c_char arrays as byte strings
+        formats.append(format)
+    return np.dtype({
+        "names": list(dtype.names),
+        "formats": formats,
+        "offsets": [dtype.fields[name][1] for name in dtype.names],
+        "itemsize": RECORD_STRIDE,
+    })
+
+
+HEADER_DTYPE = _strided_dtype(Event)
+EVENT_DTYPES = {type: _strided_dtype(structure) for type, structure in EVENT_STRUCTURES.items()}
+
+
+class BatchDecoder:
+    """
+    Alternative to calling handle_event for every ring-buffer record.
+
+    The ring-buffer callback only copies the records into a buffer. flush(), called
+    after each poll, then decodes the whole batch with NumPy: the tracked PIDs are
+    selected with np.isin and the fields of each event type are converted in bulk,
+    before the events are applied to the tracker in their original order.
+
+    Clone and exit events are rare and still go through handle_event, as does any
+    other record that is not a memory event. Since they change the tracked PIDs, the
+    batch is decoded in segments of memory events separated by those records.
+    """
+
+    def __init__(self, tracker: MemoryTracker, tracked_pids, event_cache=None, capacity=BATCH_CAPACITY):
+        self.tracker = tracker
+        self.tracked_pids = tracked_pids
+        self.event_cache = event_cache
+        self.capacity = capacity
+
+        self._buffer = bytearray(capacity * RECORD_STRIDE)
+        self._slots = (c_char * len(self._buffer)).from_buffer(self._buffer)
+        self._address = addressof(self._slots)
+        self._sizes = []
+        self._cpus = []
+        self._comms = {}  # raw comm bytes to decoded strings
+        # The tracked PIDs as an array for np.isin, rebuilt when the version of the set changes
+        self._tracked_array = None
+        self._tracked_version = None
+
+    def add(self, cpu, raw_data, size):
+        """Ring-buffer callback."""
+        if size > RECORD_STRIDE:
+            # Not an event of bpf.c, let handle_event report it
+            self.flush()
+            handle_event(cpu, raw_data, size, self.tracker, self.tracked_pids, self.event_cache)
+            return
+
+        memmove(self._address + len(self._sizes) * RECORD_STRIDE, raw_data, size)
+        self._sizes.append(size)
+        self._cpus.append(cpu)
+        if len(self._sizes) == self.capacity:
+            self.flush()
+
+    def flush(self):
+        count = len(self._sizes)
+        if count == 0:
+            return
+
+        data = memoryview(self._buffer)[:count * RECORD_STRIDE]
+        types = np.frombuffer(data, dtype=HEADER_DTYPE)["type"]
+
+        # Split the batch at the records that are not memory events, which are handled one by one
+        others = np.flatnonzero(~np.isin(types, MEMORY_EVENT_TYPES)).tolist()
+        start = 0
+        for other in others + [count]:
+            if start < other:
+                self._decode_segment(data, types, start, other)
+            if other < count:
+                handle_event(self._cpus[other], c_void_p(self._address + other * RECORD_STRIDE), self._sizes[other],
+                             self.tracker, self.tracked_pids, self.event_cache)
+            start = other + 1
+
+        self._sizes = []
+        self._cpus = []
+
+    def _decode_segment(self, data, types, start, end):
+        if not stats.sample():
+            self._apply_segment(data, types, start, end)
+            return
+
+        started = perf_counter_ns()
+        tracker_update_ns = stats.tracker_update_ns
+        stats.timing = True
+        self._apply_segment(data, types, start, end)
+        stats.timing = False
+        # Recorded as the average decode time of the events of the segment
+        elapsed = perf_counter_ns() - started - (stats.tracker_update_ns - tracker_update_ns)
+        stats.stages["decode"].record(max(elapsed, 0) // (end - start), end - start)
+
+    def _apply_segment(self, data, types, start, end):
+        segment = data[start * RECORD_STRIDE:end * RECORD_STRIDE]
+        types = types[start:end]
+        for type, count in enumerate(np.bincount(types.astype(np.int64), minlength=8).tolist()):
+            if count > 0:
+                stats.count_event(type, count)
+        pids = np.frombuffer(segment, dtype=HEADER_DTYPE)["pid_and_tid"] >> 32
+
+        # Segments only hold memory events
+        if isinstance(self.tracked_pids, AllPids):
+            tracked = np.ones(len(types), dtype=bool)
+        else:
+            version = self.tracked_pids.version
+            if version != self._tracked_version:
+                self._tracked_array = np.fromiter(self.tracked_pids.copy(), dtype=np.uint64)
+                self._tracked_version = version
+            tracked = np.isin(pids, self._tracked_array)
+
+            if self.event_cache is not None and self.event_cache.should_cache():
+                for index in np.flatnonzero(~tracked).tolist():
+                    self._cache_event(start + index, int(pids[index]))
+
+        order = np.flatnonzero(tracked)
+        if len(order) == 0:
+            return
+
+        # Convert the fields of each event type to Python values in bulk
+        rows = {}
+        for type in MEMORY_EVENT_TYPES:
+            selected = order[types[order] == type]
+            if len(selected) > 0:
+                rows[type] = self._rows(type, np.frombuffer(segment, dtype=EVENT_DTYPES[type])[selected])
+
+        tracker = self.tracker
+        for type in types[order].tolist():
+            if type == 2:
+                pid_and_tid, ts, size, actual_addr, comm, stack = next(rows[2])
+                tracker.add_allocation(pid_and_tid >> 32, ts, actual_addr, size, comm, stack, pid_and_tid & 0xffffffff)
+            elif type == 5:
+                pid_and_tid, ts, start_addr, size, comm = next(rows[5])
+                tracker.remove_allocation(pid_and_tid >> 32, ts, start_addr, size, pid_and_tid & 0xffffffff, comm)
+            elif type == 4:
+                (pid_and_tid, ts, old_addr, old_size, new_addr, new_size, flags, actual_addr, comm,
+                 stack) = next(rows[4])
+                apply_mremap(tracker, pid_and_tid >> 32, ts, old_addr, old_size, new_addr, new_size, flags,
+                             actual_addr, comm, stack, pid_and_tid & 0xffffffff)
+            else:
+                pid_and_tid, ts, actual_brk, comm, stack = next(rows[7])
+                tracker.handle_brk(pid_and_tid >> 32, ts, pid_and_tid & 0xffffffff, actual_brk, comm, stack)
+
+    def _rows(self, type, events):
+        """Iterator over the fields the handlers of a type need, as Python values."""
+        columns = [events["pid_and_tid"].tolist(), events["timestamp"].tolist()]
+        if type == 2:
+            columns += [events["size"].tolist(), events["actual_addr"].tolist()]
+        elif type == 5:
+            columns += [events["start_addr"].tolist(), events["size"].tolist()]
+        elif type == 4:
+            columns += [events[name].tolist() for name in
+                        ("old_addr", "old_size", "new_addr", "new_size", "flags", "actual_addr")]
+        else:
+            columns += [events["actual_brk"].tolist()]
+
+        columns.append([self._decode_comm(comm) for comm in events["comm"].tolist()])
+        if type != 5:
+            columns.append(events["stack_id"].tolist())
+        return zip(*columns)
+
+    def _decode_comm(self, raw):
+        comm = self._comms.get(raw)
+        if comm is None:
+            comm = raw.split(b"\0", 1)[0].decode("utf-8", "replace")
+            self._comms[raw] = comm
+        return comm
+
+    def _cache_event(self, index, pid):
+        # The event cache copies the record out of the slot
+        self.event_cache.add(pid, self._cpus[index], c_void_p(self._address + index * RECORD_STRIDE), self._sizes[index])
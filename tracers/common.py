@@ -1,4 +1,4 @@
-from ctypes import Structure, c_ulonglong, c_char
+from ctypes import Structure, c_longlong, c_ulonglong, c_char
 from os import sysconf
 
 WITH_LOGGER = False
@@ -10,6 +10,8 @@ GREEN = "\033[92m"
 YELLOW = "\033[93m"
 END = "\033[0m"
 
+NO_STACK = -1  # stack_id of the events without a captured stack, see bpf.c
+
 
 class Event(Structure):
     _fields_ = [
@@ -18,22 +20,16 @@ class Event(Structure):
         ("timestamp", c_ulonglong),
     ]
 
-class MmapEnterEvent(Structure):
+class MmapEvent(Structure):
     _fields_ = [
         ("type", c_ulonglong),
         ("pid_and_tid", c_ulonglong),
         ("timestamp", c_ulonglong),
         ("requested_addr", c_ulonglong),
         ("size", c_ulonglong),
-        ("comm", c_char * 16),
-    ]
-
-class MmapExitEvent(Structure):
-    _fields_ = [
-        ("type", c_ulonglong),
-        ("pid_and_tid", c_ulonglong),
-        ("timestamp", c_ulonglong),
         ("actual_addr", c_ulonglong),
+        ("comm", c_char * 16),
+        ("stack_id", c_longlong),  # User stack of the call, or NO_STACK
     ]
 
 class MunmapEvent(Structure):
@@ -46,8 +42,7 @@ class MunmapEvent(Structure):
         ("comm", c_char * 16),
     ]
 
-MremapEnterEvent = 56
-class MremapEnterEvent(Structure):
+class MremapEvent(Structure):
     _fields_ = [
         ("type", c_ulonglong),
         ("pid_and_tid", c_ulonglong),
@@ -57,35 +52,20 @@ class MremapEnterEvent(Structure):
         ("new_addr", c_ulonglong),
         ("new_size", c_ulonglong),
         ("flags", c_ulonglong),
+        ("actual_addr", c_ulonglong),  # New address: https://man7.org/linux/man-pages/man2/mremap.2.html
         ("comm", c_char * 16),
+        ("stack_id", c_longlong),  # User stack of the call, or NO_STACK
     ]
 
-MremapExitEventSize = 18
-class MremapExitEvent(Structure):
-    _fields_ = [
-        ("type", c_ulonglong),
-        ("pid_and_tid", c_ulonglong),
-        ("timestamp", c_ulonglong),
-        ("new_addr", c_ulonglong), # New address or -1 if failed: https://man7.org/linux/man-pages/man2/mremap.2.html
-    ]
-
-BrkEnterEventSize = 32
-class BrkEnterEvent(Structure):
-    _fields_ = [
-        ("type", c_ulonglong),
-        ("pid_and_tid", c_ulonglong),
-        ("timestamp", c_ulonglong),
-        ("requested_brk", c_ulonglong),  # For enter events, requested break address
-        ("comm", c_char * 16),
-    ]
-
-class BrkExitEvent(Structure):
+class BrkEvent(Structure):
     _fields_ = [
         ("type", c_ulonglong),
         ("pid_and_tid", c_ulonglong),
         ("timestamp", c_ulonglong),
-        ("actual_brk", c_ulonglong),  # For exit events, actual break address
+        ("requested_brk", c_ulonglong),  # Requested break address
+        ("actual_brk", c_ulonglong),  # Actual break address after the call
         ("comm", c_char * 16),
+        ("stack_id", c_longlong),  # User stack of the call, or NO_STACK
     ]
 
 class CloneEnterEvent(Structure):
@@ -139,4 +119,12 @@ class VforkExitEvent(Structure):
         ("pid_and_tid", c_ulonglong),
         ("timestamp", c_ulonglong),
         ("child_pid", c_ulonglong),  # PID of the child process
+    ]
+
+class ProcessExitEvent(Structure):
+    _fields_ = [
+        ("type", c_ulonglong),
+        ("pid_and_tid", c_ulonglong),  # Of the last thread of the process to exit
+        ("timestamp", c_ulonglong),
+        ("comm", c_char * 16),
     ]
\ No newline at end of file
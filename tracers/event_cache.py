@@ -1,16 +1,69 @@
-from collections import defaultdict
+import time
+from collections import OrderedDict
+from ctypes import string_at
+
+from utils.instrumentation import stats
+
+EVENT_CACHE_MAX_EVENTS = 16_384  # events buffered at once, about 2 MB
+EVENT_CACHE_TTL = 1.0  # seconds the events of a PID are kept waiting for the clone exit that tracks it
 
 
 class EventCache:
-    def __init__(self):
-        self.first = True
+    """
+    Memory events of untracked PIDs, received while a tracked process is cloning.
+
+    The child of a clone may run, and its events reach userspace, before the clone
+    exit of its parent adds it to the tracked PIDs. Those events, and its exit event if
+    it is that short-lived, are buffered per PID and replayed in order once the clone
+    exit is handled, see take(). The events of
+    PIDs that are not claimed within EVENT_CACHE_TTL seconds are dropped.
+
+    The records are copied when buffered, since the ring-buffer memory they point to
+    is reused after the callback returns. At most max_events are kept, later events
+    are dropped until the buffered ones are replayed or expire.
+    """
+
+    def __init__(self, max_events=EVENT_CACHE_MAX_EVENTS, ttl=EVENT_CACHE_TTL):
+        self.max_events = max_events
+        self.ttl = ttl
         self.tracked_tids_that_cloned = set()
-        self.new_pids = set()
-        self.cached_events = defaultdict(list)
+        self.cached_events = OrderedDict()  # pid -> (time of the first event, [(cpu, record)]), oldest first
+        self.size = 0
+        # Receives the replayed events instead of the tracker when set, e.g. by the pipeline
+        self.forward = None
 
     def should_cache(self) -> bool:
         return len(self.tracked_tids_that_cloned) > 0
 
     def add(self, pid, cpu, raw_data, size):
-        self.cached_events[pid].append((cpu, raw_data, size))
+        now = time.monotonic()
+        self._expire(now)
+        if self.size >= self.max_events:
+            stats.counters["event_cache_dropped"] += 1
+            return
+
+        entry = self.cached_events.get(pid)
+        if entry is None:
+            entry = self.cached_events[pid] = (now, [])
+        entry[1].append((cpu, string_at(raw_data, size)))
+        self.size += 1
+
+    def take(self, pid):
+        """Remove and return the buffered (cpu, record) events of pid, in order."""
+        self._expire(time.monotonic())
+        entry = self.cached_events.pop(pid, None)
+        if entry is None:
+            return []
+        events = entry[1]
+        self.size -= len(events)
+        stats.counters["event_cache_replayed"] += len(events)
+        return events
 
+    def _expire(self, now):
+        while self.cached_events:
+            pid, (first, events) = next(iter(self.cached_events.items()))
+            if now - first < self.ttl:
+                return
+            del self.cached_events[pid]
+            self.size -= len(events)
+            stats.counters["event_cache_expired"] += len(events)
@@ -1,43 +1,47 @@
 from ctypes import cast, POINTER
+from time import perf_counter_ns
 
-from tracers.brk import handle_brk_enter_event, handle_brk_exit_event
+from tracers.brk import handle_brk_event
 from tracers.event_cache import EventCache
 from tracers.mmap import *
 from tracers.mremap import *
 from tracers.munmap import handle_munmap_exit_event
+from utils.instrumentation import MAX_EVENT_TYPE, stats
 from utils.tracker import MemoryTracker
 
 
 def handle_event(cpu, raw_data, size, tracker: MemoryTracker, tracked_pids, event_cache=None):
+    if not stats.sample():
+        _dispatch_event(cpu, raw_data, size, tracker, tracked_pids, event_cache)
+        return
+
+    start = perf_counter_ns()
+    tracker_update_ns = stats.tracker_update_ns
+    stats.timing = True
+    _dispatch_event(cpu, raw_data, size, tracker, tracked_pids, event_cache)
+    stats.timing = False
+    elapsed = perf_counter_ns() - start - (stats.tracker_update_ns - tracker_update_ns)
+    stats.stages["decode"].record(max(elapsed, 0))
+
+
+def _dispatch_event(cpu, raw_data, size, tracker: MemoryTracker, tracked_pids, event_cache=None):
     event = cast(raw_data, POINTER(Event)).contents
     type = event.type
     pid = event.pid_and_tid >> 32
+    if type <= MAX_EVENT_TYPE:
+        stats.events[type] += 1
 
-    if type == 1:
-        event = cast(raw_data, POINTER(MmapEnterEvent)).contents
-        if pid in tracked_pids:
-            handle_mmap_enter_event(event)
-        elif event_cache is not None and event_cache.should_cache():
-            event_cache.add(pid, cpu, raw_data, size)
-
-    elif type == 2:
-        event = cast(raw_data, POINTER(MmapExitEvent)).contents
-        if pid in tracked_pids:
-            handle_mmap_exit_event(event, tracker)
-        elif event_cache is not None and event_cache.should_cache():
-            event_cache.add(pid, cpu, raw_data, size)
-
-    elif type == 3:
-        event = cast(raw_data, POINTER(MremapEnterEvent)).contents
+    if type == 2:
+        event = cast(raw_data, POINTER(MmapEvent)).contents
         if pid in tracked_pids:
-            handle_mremap_enter_event(event)
+            handle_mmap_event(event, tracker)
         elif event_cache is not None and event_cache.should_cache():
             event_cache.add(pid, cpu, raw_data, size)
 
     elif type == 4:
-        event = cast(raw_data, POINTER(MremapExitEvent)).contents
+        event = cast(raw_data, POINTER(MremapEvent)).contents
         if pid in tracked_pids:
-            handle_mremap_exit_event(event, tracker)
+            handle_mremap_event(event, tracker)
         elif event_cache is not None and event_cache.should_cache():
             event_cache.add(pid, cpu, raw_data, size)
 
@@ -48,17 +52,10 @@ def handle_event(cpu, raw_data, size, tracker: MemoryTracker, tracked_pids, even
         elif event_cache is not None and event_cache.should_cache():
             event_cache.add(pid, cpu, raw_data, size)
 
-    elif type == 6:
-        event = cast(raw_data, POINTER(BrkEnterEvent)).contents
-        if pid in tracked_pids:
-            handle_brk_enter_event(event)
-        # elif event_cache.should_cache():
-        #     event_cache.add(cpu, raw_data, size)
-
     elif type == 7:
-        event = cast(raw_data, POINTER(BrkExitEvent)).contents
+        event = cast(raw_data, POINTER(BrkEvent)).contents
         if pid in tracked_pids:
-            handle_brk_exit_event(event, tracker)
+            handle_brk_event(event, tracker)
         elif event_cache is not None and event_cache.should_cache():
             event_cache.add(pid, cpu, raw_data, size)
 
@@ -86,8 +83,17 @@ def handle_event(cpu, raw_data, size, tracker: MemoryTracker, tracked_pids, even
         event = cast(raw_data, POINTER(VforkExitEvent)).contents
         handle_vfork_exit_event(event, tracked_pids, tracker, event_cache)
 
+    elif type == 14:
+        event = cast(raw_data, POINTER(ProcessExitEvent)).contents
+        if pid in tracked_pids or event_cache is None or not event_cache.should_cache():
+            handle_process_exit_event(event, tracked_pids, tracker, event_cache)
+        else:
+            # A child exiting before the clone exit of its parent, applied after its buffered events
+            event_cache.add(pid, cpu, raw_data, size)
+
     else:
-        print(f'size not recognized: {size}')
+        stats.unknown_events += 1
+
 
 
 tracker_pid = 0
@@ -98,11 +104,35 @@ def set_tracker_pid(pid):
 
 WITH_LOGGER = False
 
+# Memory events that can be buffered in the event cache, see replay_cached_events
+MEMORY_EVENT_HANDLERS = {
+    2: (MmapEvent, handle_mmap_event),
+    4: (MremapEvent, handle_mremap_event),
+    5: (MunmapEvent, handle_munmap_exit_event),
+    7: (BrkEvent, handle_brk_event),
+}
+
+
+def replay_cached_events(pid, tracked_pids, tracker: MemoryTracker, event_cache: EventCache):
+    """Apply the events of pid that arrived before the clone exit that started tracking it."""
+    for cpu, record in event_cache.take(pid):
+        if event_cache.forward is not None:
+            event_cache.forward(cpu, record, len(record))
+            continue
+        # Already counted in stats.events when they were cached
+        type = cast(record, POINTER(Event)).contents.type
+        if type == 14:
+            handle_process_exit_event(cast(record, POINTER(ProcessExitEvent)).contents, tracked_pids, tracker,
+                                      event_cache)
+            continue
+        structure, handler = MEMORY_EVENT_HANDLERS[type]
+        handler(cast(record, POINTER(structure)).contents, tracker)
+
 def debug_state(event_cache, tracked_pids):
     if not WITH_LOGGER:
         return
     print(f"DEBUG: tracked_pids: {tracked_pids}")
-    print(f"DEBUG: event_cache.new_pids: {event_cache.new_pids}")
+    print(f"DEBUG: event_cache.cached_events: {len(event_cache.cached_events)} PIDs, {event_cache.size} events")
     print(f"DEBUG: event_cache.tracked_tids_that_cloned: {event_cache.tracked_tids_that_cloned}")
 
 def handle_clone_enter_events(event, tracked_pids, event_cache: EventCache):
@@ -122,6 +152,7 @@ def handle_clone_enter_events(event, tracked_pids, event_cache: EventCache):
 
 def handle_clone_exit_events(event, tracked_pids: set, tracker: MemoryTracker, event_cache: EventCache):
     if event.pid_and_tid not in event_cache.tracked_tids_that_cloned:
+        stats.counters["unmatched_clone_exits"] += 1
         return
 
     pid = event.pid_and_tid >> 32
@@ -131,6 +162,7 @@ def handle_clone_exit_events(event, tracked_pids: set, tracker: MemoryTracker, e
     # Add the child PID only if the parent is tracker_pid or a descendant
     if pid in tracked_pids or pid == tracker_pid:
         tracked_pids.add(event.child_pid)
+        replay_cached_events(event.child_pid, tracked_pids, tracker, event_cache)
 
     event_cache.tracked_tids_that_cloned.remove(event.pid_and_tid)
     debug_state(event_cache, tracked_pids)
@@ -148,6 +180,7 @@ def handle_clone3_enter_events(event, tracked_pids, event_cache: EventCache):
 
 def handle_clone3_exit_events(event, tracked_pids: set, tracker: MemoryTracker, event_cache: EventCache):
     if event.pid_and_tid not in event_cache.tracked_tids_that_cloned:
+        stats.counters["unmatched_clone_exits"] += 1
         return
 
     pid = event.pid_and_tid >> 32
@@ -156,6 +189,7 @@ def handle_clone3_exit_events(event, tracked_pids: set, tracker: MemoryTracker,
 
     if pid in tracked_pids or pid == tracker_pid:
         tracked_pids.add(event.child_pid)
+        replay_cached_events(event.child_pid, tracked_pids, tracker, event_cache)
 
     event_cache.tracked_tids_that_cloned.remove(event.pid_and_tid)
     debug_state(event_cache, tracked_pids)
@@ -173,6 +207,7 @@ def handle_vfork_enter_event(event, tracked_pids, event_cache: EventCache):
 
 def handle_vfork_exit_event(event, tracked_pids: set, tracker: MemoryTracker, event_cache: EventCache):
     if event.pid_and_tid not in event_cache.tracked_tids_that_cloned:
+        stats.counters["unmatched_clone_exits"] += 1
         return
 
     pid = event.pid_and_tid >> 32
@@ -181,6 +216,24 @@ def handle_vfork_exit_event(event, tracked_pids: set, tracker: MemoryTracker, ev
 
     if pid in tracked_pids or pid == tracker_pid:
         tracked_pids.add(event.child_pid)
+        replay_cached_events(event.child_pid, tracked_pids, tracker, event_cache)
 
     event_cache.tracked_tids_that_cloned.remove(event.pid_and_tid)
-    debug_state(event_cache, tracked_pids)
\ No newline at end of file
+    debug_state(event_cache, tracked_pids)
+
+def handle_process_exit_event(event, tracked_pids, tracker: MemoryTracker, event_cache: EventCache = None):
+    pid = event.pid_and_tid >> 32
+    if WITH_LOGGER:
+        print(f"Process exited (pid={pid})")
+
+    forget_process(pid, tracked_pids, event_cache)
+    tracker.remove_process(pid, event.timestamp)
+
+def forget_process(pid, tracked_pids, event_cache: EventCache = None):
+    """Stop following an exited process, the kernel already did, see trace_process_exit in bpf.c."""
+    tracked_pids.discard(pid)
+    if event_cache is not None and event_cache.tracked_tids_that_cloned:
+        # Clones of its threads that will never exit
+        event_cache.tracked_tids_that_cloned = {
+            pid_and_tid for pid_and_tid in event_cache.tracked_tids_that_cloned if pid_and_tid >> 32 != pid
+        }
@@ -0,0 +1,110 @@
+import threading
+from ctypes import c_uint, c_ubyte
+
+# Values of the tracked_tgids BPF map, see bpf.c
+TRACK_FULL = 1
+TRACK_CHILDREN_ONLY = 2
+
+
+class TrackedPids:
+    """
+    Set of tracked PIDs, mirrored into the `tracked_tgids` BPF map.
+
+    The kernel probes drop the events of untracked processes before they reach the
+    ring buffer, and add the children of tracked processes to the map themselves.
+    `sync` pulls those children back into the set in case their clone exit event
+    was lost, or has not been received yet.
+    """
+
+    def __init__(self, pids=()):
+        self._pids = set(pids)
+        self._map = None
+        self._lock = threading.Lock()
+        self.version = 0  # bumped on every change, so that copies of the set can be cached
+
+    def attach(self, bpf_map):
+        """Start mirroring the set into the given BPF map."""
+        with self._lock:
+            self._map = bpf_map
+            for pid in self._pids:
+                self._map[c_uint(pid)] = c_ubyte(TRACK_FULL)
+
+    def add(self, pid):
+        with self._lock:
+            self._pids.add(pid)
+            self.version += 1
+            if self._map is not None:
+                self._map[c_uint(pid)] = c_ubyte(TRACK_FULL)
+
+    def follow_children(self, pid):
+        """Track the children of pid without reporting the memory events of pid itself."""
+        if self._map is not None:
+            self._map[c_uint(pid)] = c_ubyte(TRACK_CHILDREN_ONLY)
+
+    def discard(self, pid):
+        with self._lock:
+            self._pids.discard(pid)
+            self.version += 1
+            if self._map is not None:
+                try:
+                    del self._map[c_uint(pid)]
+                except KeyError:
+                    pass
+
+    def sync(self, on_added=None):
+        """
+        Add the PIDs that the kernel started tracking on its own, calling on_added(pid)
+        for each of them, e.g. to replay the events cached while their clone exit was
+        still on its way.
+        """
+        if self._map is None:
+            return
+        pids = [key.value for key, mode in self._map.items() if mode.value == TRACK_FULL]
+        with self._lock:
+            added = [pid for pid in pids if pid not in self._pids]
+            if added:
+                self._pids.update(added)
+                self.version += 1
+        if on_added is not None:
+            for pid in added:
+                on_added(pid)
+
+    def copy(self):
+        with self._lock:
+            return self._pids.copy()
+
+    def __contains__(self, pid):
+        return pid in self._pids
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return len(self._pids)
+
+
+class AllPids:
+    """Stand-in for TrackedPids when every process on the system is traced."""
+
+    version = 0
+
+    def add(self, pid):
+        pass
+
+    def discard(self, pid):
+        pass
+
+    def sync(self, on_added=None):
+        pass
+
+    def copy(self):
+        return set()
+
+    def __contains__(self, pid):
+        return True
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
@@ -0,0 +1,116 @@
+import time
+
+from utils.instrumentation import stats
+
+FAULT_INTERVAL = 1  # default seconds between two drains of the in-kernel counts
+FAULT_BUCKET_SHIFT = 21  # FAULT_BUCKET_SHIFT of bpf.c, 2 MB buckets
+
+
+class FaultCounter:
+    """
+    Drains the page faults counted in-kernel per (tgid, 2 MB bucket) by bpf.c, and
+    attributes them to the tracked regions.
+
+    The counts are read and deleted in one BPF_MAP_LOOKUP_AND_DELETE_BATCH syscall per
+    chunk of entries. Kernels before 5.6 lack it, the entries are then read and deleted
+    one by one, losing the faults counted in between.
+
+    The faults of a bucket are split between the regions overlapping it, in proportion
+    to the overlap: the exact addresses are not kept. The totals of each region are
+    kept until it goes away (or gets a new id, after a split or merge).
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._batch = True
+        self._region_faults = {}  # pid -> region id -> faults attributed so far
+        self._pid_faults = {}  # pid -> [faults, of which untracked]
+
+    def drain(self):
+        """Return {pid: {bucket: faults}} counted since the last drain."""
+        if self._batch:
+            try:
+                items = list(self.table.items_lookup_and_delete_batch())
+            except Exception:
+                # Raised by the kernels (or BCC versions) without batch operations
+                self._batch = False
+        if not self._batch:
+            items = list(self.table.items())
+            for key, _ in items:
+                try:
+                    del self.table[key]
+                except KeyError:
+                    pass
+
+        faults = {}
+        for key, count in items:
+            buckets = faults.setdefault(key.tgid, {})
+            buckets[key.bucket] = buckets.get(key.bucket, 0) + count.value
+        return faults
+
+    def attribute(self, faults, live_regions):
+        """
+        Split faults ({pid: {bucket: faults}}) between the live regions ({pid: RegionSet}),
+        returning the entries of a "faults" message: the totals of the regions that
+        faulted, and of their processes. Only the processes that faulted are visited.
+        """
+        changed = {}
+        for pid, buckets in faults.items():
+            stats.counters["page_faults"] += sum(buckets.values())
+            totals = self._pid_faults.setdefault(pid, [0, 0])
+            regions = live_regions.get(pid)
+            for bucket, count in buckets.items():
+                bucket_start = bucket << FAULT_BUCKET_SHIFT
+                bucket_end = (bucket + 1) << FAULT_BUCKET_SHIFT
+                overlaps = []
+                if regions is not None:
+                    lo, hi = regions.overlapping(bucket_start, bucket_end)
+                    for i in range(lo, hi):
+                        region = regions[i]
+                        overlaps.append((min(region.end_addr, bucket_end) - max(region.start_addr, bucket_start),
+                                         region))
+
+                totals[0] += count
+                if not overlaps:
+                    totals[1] += count
+                    stats.counters["page_faults_untracked"] += count
+                    continue
+
+                # In proportion to the overlaps, the rounding left to the largest one
+                covered = sum(overlap for overlap, _ in overlaps)
+                shares = [count * overlap // covered for overlap, _ in overlaps]
+                largest = max(range(len(overlaps)), key=lambda j: overlaps[j][0])
+                shares[largest] += count - sum(shares)
+                region_faults = self._region_faults.setdefault(pid, {})
+                for share, (_, region) in zip(shares, overlaps):
+                    if share:
+                        region_faults[region.id] = region_faults.get(region.id, 0) + share
+                        changed[region.id] = pid
+
+        # Forget the processes that are gone, and the regions gone from those that faulted
+        for pid in list(self._region_faults):
+            if pid not in live_regions:
+                del self._region_faults[pid]
+            elif pid in faults:
+                region_faults = self._region_faults[pid]
+                for id in region_faults.keys() - set(live_regions[pid].ids()):
+                    del region_faults[id]
+        for pid in self._pid_faults.keys() - live_regions.keys() - faults.keys():
+            del self._pid_faults[pid]
+
+        return {
+            "regions": [{"id": id, "pid": pid, "faults": self._region_faults[pid][id]} for id, pid in changed.items()],
+            "processes": [{"pid": pid, "faults": faults, "untracked": untracked}
+                          for pid, (faults, untracked) in self._pid_faults.items()],
+        }
+
+
+def fetch_faults_loop(tracker, table, interval=FAULT_INTERVAL):
+    """Drain the page_faults table of bpf.c into tracker (a MemoryTracker or Pipeline) every interval."""
+    counter = FaultCounter(table)
+    while True:
+        start = time.monotonic()
+        faults = counter.drain()
+        if faults:
+            tracker.send_faults(counter.attribute(faults, tracker.live_regions()))
+        time.sleep(max(0, interval - (time.monotonic() - start)))
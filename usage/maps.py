@@ -0,0 +1,57 @@
+import time
+
+from utils.instrumentation import stats
+
+RECONCILE_INTERVAL = 10  # default seconds between two reconciliations of the tracked processes
+SKIPPED_MAPPINGS = (b"[vsyscall]",)  # mapped in every process by the kernel, outside of the user address space
+
+
+def read_maps(pid):
+    """
+    Return the sorted (start, end) ranges mapped by pid, with adjacent mappings
+    coalesced like the regions of the tracker. /proc/<pid>/maps is parsed line by
+    line as it is read.
+    """
+    ranges = []
+    with open(f"/proc/{pid}/maps", "rb") as file:
+        for line in file:
+            addresses, _, rest = line.partition(b" ")
+            if rest.rstrip().endswith(SKIPPED_MAPPINGS):
+                continue
+            start, _, end = addresses.partition(b"-")
+            start, end = int(start, 16), int(end, 16)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    return ranges
+
+
+def read_comm(pid):
+    with open(f"/proc/{pid}/comm", "r") as file:
+        return file.read().rstrip("\n")
+
+
+def reconcile_pid(tracker, pid):
+    """
+    Correct the regions tracker holds for pid from /proc/<pid>/maps. The time taken
+    and the corrections are recorded in the stats. Returns False if the process is gone.
+    """
+    start = time.perf_counter_ns()
+    try:
+        added, removed = tracker.reconcile(pid, lambda: (read_maps(pid), read_comm(pid)))
+    except OSError:
+        return False
+    stats.stages["reconcile"].record(time.perf_counter_ns() - start)
+    stats.counters["reconcile_added"] += added
+    stats.counters["reconcile_removed"] += removed
+    return True
+
+
+def reconcile_loop(reconcile, pids, interval=RECONCILE_INTERVAL):
+    """Call reconcile(pid) for the PIDs returned by pids(), starting now and then every interval."""
+    while True:
+        start = time.monotonic()
+        for pid in pids():
+            reconcile(pid)
+        time.sleep(max(0, interval - (time.monotonic() - start)))
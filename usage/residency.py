@@ -0,0 +1,188 @@
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from tracers.common import PAGE_SIZE
+from utils.instrumentation import stats
+
+RESIDENCY_INTERVAL = 1  # seconds between two sampling rounds
+RESIDENCY_BUDGET = 1 << 20  # default number of pages read per second, 8 MB of pagemap entries
+RESIDENCY_BITS = 64  # buckets of the downsampled residency bitmap of a region
+PAGEMAP_CHUNK_PAGES = 1 << 16  # pagemap entries read at once, 512 KB
+PAGEMAP_PRESENT = np.uint64(63)  # bit of a pagemap entry set when the page is in RAM
+
+
+class _PartialSample:
+    """A region being sampled, possibly over several rounds."""
+
+    def __init__(self, id, pid, start_addr, end_addr, page_size, bits):
+        self.id = id
+        self.pid = pid
+        self.start_addr = start_addr
+        self.end_addr = end_addr
+        self.pages = -(-(end_addr - start_addr) // page_size)
+        self.next_page = 0  # pages before it were read
+        self.resident = 0  # or None if the pagemap could not be read
+        self.bucket_resident = np.zeros(min(bits, self.pages), dtype=np.int64)
+
+    def done(self):
+        return self.next_page >= self.pages
+
+
+class ResidencySampler:
+    """
+    Counts the resident pages of the tracked regions from /proc/<pid>/pagemap.
+
+    Each round reads at most `budget` pages worth of pagemap entries: first the rest of
+    a region left unfinished by the previous round, then the regions never sampled
+    (new, or changed since a split or merge gives them a new id), then the ones
+    sampled the longest ago. A region larger than what is left of the budget is read
+    up to it and resumed from there in the next rounds, and only reported once read
+    in full.
+
+    Rather than sorting all the regions every round, the sampler keeps them in
+    queues and only compares the ids of each process with the ones it already knows,
+    to queue the new regions and drop the gone ones.
+
+    The entries are read in chunks of PAGEMAP_CHUNK_PAGES with pread() and decoded with
+    NumPy, one vectorized pass per chunk.
+    """
+
+    def __init__(self, budget=RESIDENCY_BUDGET, page_size=PAGE_SIZE, bits=RESIDENCY_BITS):
+        self.budget = budget
+        self.page_size = page_size
+        self.bits = bits
+        self._known = {}  # pid -> ids of its regions, queued or in progress
+        self._fresh = OrderedDict()  # region id -> (pid, start, end), never sampled
+        self._sampled = OrderedDict()  # region id -> (pid, start, end, round), oldest sample first
+        self._partial = None  # _PartialSample left unfinished by the previous round
+        self._round = 0
+        self._fds = {}  # pid -> pagemap file descriptor
+
+    def sample(self, live_regions):
+        """
+        Sample the regions of live_regions ({pid: RegionSet}) within the budget,
+        returning the entries of a "residency" message.
+        """
+        self._round += 1
+        self._update(live_regions)
+
+        results = []
+        remaining = self.budget
+        while remaining > 0:
+            partial = self._partial or self._next()
+            if partial is None:
+                break
+            remaining -= self._read(partial, remaining)
+            if not partial.done():
+                self._partial = partial  # Resumed in the next round
+                break
+            self._partial = None
+            self._sampled[partial.id] = (partial.pid, partial.start_addr, partial.end_addr, self._round)
+            if partial.resident is not None:
+                results.append(self._result(partial))
+        return results
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def _update(self, live_regions):
+        """Queue the new regions and forget the regions and processes that are gone."""
+        for pid in self._known.keys() - live_regions.keys():
+            self._forget(self._known.pop(pid))
+            if pid in self._fds:
+                os.close(self._fds.pop(pid))
+
+        for pid, regions in live_regions.items():
+            known = self._known.get(pid, set())
+            ids = regions.ids()
+            current = set(ids)
+            if current == known:
+                continue
+            self._forget(known - current)
+            for i, id in enumerate(ids):
+                if id not in known:
+                    region = regions[i]
+                    self._fresh[id] = (pid, region.start_addr, region.end_addr)
+            self._known[pid] = current
+
+    def _forget(self, ids):
+        for id in ids:
+            self._fresh.pop(id, None)
+            self._sampled.pop(id, None)
+        if self._partial is not None and self._partial.id in ids:
+            self._partial = None
+
+    def _next(self):
+        """Return the next region to sample, or None once all of them were sampled this round."""
+        if self._fresh:
+            id, (pid, start, end) = self._fresh.popitem(last=False)
+        elif self._sampled and next(iter(self._sampled.values()))[3] < self._round:
+            id, (pid, start, end, _) = self._sampled.popitem(last=False)
+        else:
+            return None
+        return _PartialSample(id, pid, start, end, self.page_size, self.bits)
+
+    def _read(self, partial, budget):
+        """Read up to budget more pages of the region, returning the number of pages accounted for."""
+        count = min(budget, partial.pages - partial.next_page)
+        stats.counters["residency_pages"] += count
+
+        fd = self._fds.get(partial.pid)
+        if fd is None:
+            try:
+                fd = os.open(f"/proc/{partial.pid}/pagemap", os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                partial.next_page, partial.resident = partial.pages, None
+                return count
+            self._fds[partial.pid] = fd
+
+        bits = len(partial.bucket_resident)
+        first_page = partial.start_addr // self.page_size
+        end = partial.next_page + count
+        for offset in range(partial.next_page, end, PAGEMAP_CHUNK_PAGES):
+            chunk = min(PAGEMAP_CHUNK_PAGES, end - offset)
+            try:
+                data = os.pread(fd, chunk * 8, (first_page + offset) * 8)
+            except OSError:
+                # The process exited
+                os.close(self._fds.pop(partial.pid))
+                partial.next_page, partial.resident = partial.pages, None
+                return count
+            entries = np.frombuffer(data, dtype="<u8")
+            present = np.flatnonzero(entries >> PAGEMAP_PRESENT) + offset
+            partial.resident += len(present)
+            if len(present):
+                partial.bucket_resident += np.bincount(present * bits // partial.pages, minlength=bits)
+        partial.next_page = end
+        return count
+
+    def _result(self, partial):
+        pages, bits = partial.pages, len(partial.bucket_resident)
+        # Page i of the region falls in bucket i * bits // pages
+        boundaries = -(-np.arange(bits + 1, dtype=np.int64) * pages // bits)
+        # A bucket is set when at least half of its pages are resident
+        bitmap = np.packbits(2 * partial.bucket_resident >= np.diff(boundaries))
+        return {
+            "id": partial.id,
+            "pid": partial.pid,
+            "pages": pages,
+            "resident": partial.resident,
+            "bits": bits,
+            "bitmap": bitmap.tobytes().hex(),
+        }
+
+
+def fetch_residency_loop(tracker, budget=RESIDENCY_BUDGET, interval=RESIDENCY_INTERVAL):
+    """Sample the regions of tracker (a MemoryTracker or Pipeline) every interval, budget in pages/second."""
+    sampler = ResidencySampler(int(budget * interval))
+    while True:
+        start = time.monotonic()
+        regions = sampler.sample(tracker.live_regions())
+        if regions:
+            tracker.send_residency(regions)
+        time.sleep(max(0, interval - (time.monotonic() - start)))
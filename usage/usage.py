@@ -1,10 +1,15 @@
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from tracers.tracked_pids import TrackedPids
 from utils.tracker import MemoryTracker
 from time import sleep
+import resource
 import os
 import time
 
 USAGE_INTERVAL = 1
+STATM_READ_SIZE = 128  # statm is 7 decimal numbers, well below this
+POOL_THRESHOLD = 256  # PIDs per sample above which the reads are spread over the thread pool
 
 
 def parse_statm(pid):
@@ -21,35 +26,140 @@ def parse_statm(pid):
     return 0, 0
 
 
-
-def fetch_usage_loop(tracker: MemoryTracker, target_pids_lock: threading.Lock, target_pids: set):
+class StatmSampler:
+    """
+    Reads /proc/<pid>/statm of many processes, keeping one file descriptor open per PID.
+
+    Each sample is a single pread() at offset 0 instead of an open, read and close.
+    A descriptor keeps referring to the process it was opened for: once that process
+    is reaped its reads fail, the descriptor is closed and the PID is left out of the
+    sample, so a reused PID gets a fresh descriptor.
+
+    With threads > 0, samples of more than POOL_THRESHOLD PIDs are read in chunks on a
+    thread pool, pread() releases the GIL.
+    """
+
+    def __init__(self, threads=0, max_open=None):
+        self._fds = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="statm") if threads > 0 else None
+        self._threads = threads
+        if max_open is None:
+            # Leave room for the sockets, the BPF maps and the trace file
+            max_open = resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+        self.max_open = max_open
+
+    def sample(self, pids):
+        """
+        Return {pid: (vm, rss)} in pages for the given PIDs, leaving out those that
+        exited (zombies read as zeros). Descriptors of PIDs that are not sampled
+        anymore are closed.
+        """
+        pids = list(pids)
+        self._drop_stale(pids)
+
+        if self._pool is None or len(pids) <= POOL_THRESHOLD:
+            return self._read_batch(pids)
+
+        chunk_size = -(-len(pids) // self._threads)
+        usage = {}
+        chunks = [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+        for result in self._pool.map(self._read_batch, chunks):
+            usage.update(result)
+        return usage
+
+    def close(self):
+        with self._lock:
+            fds, self._fds = self._fds, {}
+        for fd in fds.values():
+            os.close(fd)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def _read_batch(self, pids):
+        usage = {}
+        for pid in pids:
+            values = self._read(pid)
+            if values is not None:
+                usage[pid] = values
+        return usage
+
+    def _read(self, pid):
+        fd = self._fds.get(pid)
+        if fd is None:
+            fd = self._open(pid)
+        try:
+            if fd is None:
+                # Over the descriptor budget, open the file for this read only
+                with open(f"/proc/{pid}/statm", "rb") as file:
+                    fields = file.read(STATM_READ_SIZE).split()
+            else:
+                fields = os.pread(fd, STATM_READ_SIZE, 0).split()
+        except OSError:
+            # Exited (or could never be opened)
+            self._close(pid)
+            return None
+        # Zeros for kernel threads and zombies, whose memory is already released
+        return int(fields[0]), int(fields[1])
+
+    def _open(self, pid):
+        with self._lock:
+            if len(self._fds) >= self.max_open:
+                return None
+            try:
+                fd = os.open(f"/proc/{pid}/statm", os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                return None
+            self._fds[pid] = fd
+            return fd
+
+    def _close(self, pid):
+        with self._lock:
+            fd = self._fds.pop(pid, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _drop_stale(self, pids):
+        for pid in self._fds.keys() - set(pids):
+            self._close(pid)
+
+
+def list_pids():
+    # Check if the directory name is a PID
+    return [int(entry) for entry in os.listdir('/proc') if entry.isnumeric()]
+
+
+def fetch_usage_loop(tracker: MemoryTracker, target_pids: TrackedPids, interval=USAGE_INTERVAL, threads=0):
+    sampler = StatmSampler(threads)
     t = time.time()
     while True:
-        vm, rss = 0, 0
+        start = time.monotonic()
 
-        with target_pids_lock:
-            target_pids_local = target_pids.copy()
+        target_pids_local = target_pids.copy()
 
-        for pid in target_pids_local:
-            _vm, _rss = parse_statm(pid)
-            if _vm == 0 and time.time() - t > 0.5:
-                tracker.clear_allocations_for_pid(pid) # wait for 0.5 seconds so that measurements are stable, otherwise will clear allocations at the start
-            vm += _vm
-            rss += _rss
+        usage = sampler.sample(target_pids_local)
+        if time.time() - t > 0.5:
+            # wait for 0.5 seconds so that measurements are stable, otherwise will clear allocations at the start
+            for pid in target_pids_local:
+                if usage.get(pid, (0, 0))[0] == 0:
+                    # Exited without its exit event reaching us, see handle_process_exit_event
+                    target_pids.discard(pid)
+                    tracker.clear_allocations_for_pid(pid)
 
+        vm = sum(_vm for _vm, _ in usage.values())
+        rss = sum(_rss for _, _rss in usage.values())
         tracker.send_usage(rss, vm)
-        sleep(USAGE_INTERVAL)
+        sleep(max(0, interval - (time.monotonic() - start)))
 
 
-def fetch_total_usage_loop(tracker: MemoryTracker):
+def fetch_total_usage_loop(tracker: MemoryTracker, interval=USAGE_INTERVAL, threads=0):
+    sampler = StatmSampler(threads)
     while True:
-        vm, rss = 0, 0
+        start = time.monotonic()
 
-        for entry in os.listdir('/proc'):
-            if entry.isnumeric():  # Check if the directory name is a PID
-                _vm, _rss = parse_statm(entry)
-                vm += _vm
-                rss += _rss
+        usage = sampler.sample(list_pids())
 
+        vm = sum(_vm for _vm, _ in usage.values())
+        rss = sum(_rss for _, _rss in usage.values())
         tracker.send_usage(rss, vm)
-        sleep(USAGE_INTERVAL)
+        sleep(max(0, interval - (time.monotonic() - start)))
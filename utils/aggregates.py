@@ -0,0 +1,232 @@
+import heapq
+from collections import defaultdict
+
+
+class Totals:
+    __slots__ = ("bytes", "pages", "regions")
+
+    def __init__(self):
+        self.bytes = 0
+        self.pages = 0
+        self.regions = 0
+
+    def as_dict(self):
+        return {"bytes": self.bytes, "pages": self.pages, "regions": self.regions}
+
+
+class Aggregates:
+    """
+    Running totals of the live regions: global, per PID and per command.
+
+    Updated for every region added or removed, so that a summary costs one entry
+    per process and command instead of a pass over all the regions.
+    """
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.total = Totals()
+        self.pids = defaultdict(Totals)
+        self.comms = defaultdict(Totals)
+
+    def add(self, pid, comm, size):
+        pages = -(-size // self.page_size)
+        for totals in (self.total, self.pids[pid], self.comms[comm]):
+            totals.bytes += size
+            totals.pages += pages
+            totals.regions += 1
+
+    def remove(self, pid, comm, size):
+        pages = -(-size // self.page_size)
+        for totals in (self.total, self.pids[pid], self.comms[comm]):
+            totals.bytes -= size
+            totals.pages -= pages
+            totals.regions -= 1
+
+        # Only keep the processes and commands that still have regions
+        if self.pids[pid].regions == 0:
+            del self.pids[pid]
+        if self.comms[comm].regions == 0:
+            del self.comms[comm]
+
+    def snapshot(self):
+        """Copy of the totals, as plain dictionaries."""
+        return {
+            "total": self.total.as_dict(),
+            "processes": [{"pid": pid, **totals.as_dict()} for pid, totals in self.pids.items()],
+            "commands": [{"comm": comm, **totals.as_dict()} for comm, totals in self.comms.items()],
+        }
+
+
+def merge_summaries(summaries):
+    """Add up Aggregates snapshots of disjoint sets of PIDs (e.g. of pipeline workers) into one."""
+    total = {"bytes": 0, "pages": 0, "regions": 0}
+    processes = []
+    commands = {}
+    for summary in summaries:
+        for field in total:
+            total[field] += summary["total"][field]
+        processes += summary["processes"]
+        for row in summary["commands"]:
+            merged = commands.get(row["comm"])
+            if merged is None:
+                commands[row["comm"]] = dict(row)
+            else:
+                for field in total:
+                    merged[field] += row[field]
+    return {"total": total, "processes": processes, "commands": list(commands.values())}
+
+
+ACTIVITY_WINDOW = 1_000_000_000  # ns, the rates are the counts of the last complete window
+ACTIVITY_TOP = 20  # rows returned by an activity request that does not give k
+ACTIVITY_FIELDS = ("bytes", "regions", "maps", "mapped", "unmaps", "unmapped")
+
+
+class Activity:
+    __slots__ = ("bytes", "regions", "window", "current", "previous")
+
+    def __init__(self):
+        self.bytes = 0
+        self.regions = 0
+        self.window = 0
+        self.current = [0, 0, 0, 0]  # maps, bytes mapped, unmaps, bytes unmapped in the window
+        self.previous = [0, 0, 0, 0]  # the same in the window before, if it was the previous one
+
+    def roll(self, window):
+        if window != self.window:
+            self.previous = self.current if window == self.window + 1 else [0, 0, 0, 0]
+            self.current = [0, 0, 0, 0]
+            self.window = window
+
+    def rates(self, window):
+        """Counts of the last complete window before the given one."""
+        if window == self.window:
+            return self.previous
+        if window == self.window + 1:
+            return self.current
+        return [0, 0, 0, 0]
+
+
+class ThreadActivity:
+    """
+    Live bytes and regions, and map and unmap rates, per thread and per command.
+
+    The live totals follow the regions like Aggregates, by the thread that mapped them
+    (a merged region keeps the thread of its leftmost part, like its command). The
+    maps and unmaps are counted for the thread making the system call, in windows of
+    ACTIVITY_WINDOW rolled over when the thread is next updated or read, so that the
+    counters never need a pass over all the threads.
+    """
+
+    def __init__(self, window=ACTIVITY_WINDOW):
+        self.window = window
+        self.threads = {}  # pid -> tid -> Activity
+        self.comms = {}  # comm -> Activity
+
+    def _entries(self, pid, tid, comm):
+        threads = self.threads.get(pid)
+        if threads is None:
+            threads = self.threads[pid] = {}
+        thread = threads.get(tid)
+        if thread is None:
+            thread = threads[tid] = Activity()
+        command = self.comms.get(comm)
+        if command is None:
+            command = self.comms[comm] = Activity()
+        return thread, command
+
+    # Called for every region and system call, hence unrolled
+    def add(self, pid, tid, comm, size):
+        thread, command = self._entries(pid, tid, comm)
+        thread.bytes += size
+        thread.regions += 1
+        command.bytes += size
+        command.regions += 1
+
+    def remove(self, pid, tid, comm, size):
+        thread, command = self._entries(pid, tid, comm)
+        thread.bytes -= size
+        thread.regions -= 1
+        command.bytes -= size
+        command.regions -= 1
+
+    def mapped(self, pid, tid, comm, size, time):
+        window = time // self.window
+        for entry in self._entries(pid, tid, comm):
+            if entry.window != window:
+                entry.roll(window)
+            current = entry.current
+            current[0] += 1
+            current[1] += size
+
+    def unmapped(self, pid, tid, comm, size, time):
+        window = time // self.window
+        for entry in self._entries(pid, tid, comm):
+            if entry.window != window:
+                entry.roll(window)
+            current = entry.current
+            current[2] += 1
+            current[3] += size
+
+    def forget(self, pid):
+        """Drop the threads of an exited process, whose regions were all removed already."""
+        self.threads.pop(pid, None)
+
+    def rows(self, view, now):
+        """
+        {key: values in the order of ACTIVITY_FIELDS} of the "threads" ((pid, tid) keys)
+        or "comms" view, with the rates per second. Entries without regions nor recent
+        calls are dropped.
+        """
+        window = now // self.window
+        per_second = 1_000_000_000 / self.window
+        if view != "threads":
+            return dict(self._rows(self.comms, window, per_second))
+        rows = {}
+        for pid, threads in list(self.threads.items()):
+            for tid, values in self._rows(threads, window, per_second):
+                rows[(pid, tid)] = values
+            if not threads:
+                del self.threads[pid]
+        return rows
+
+    @staticmethod
+    def _rows(table, window, per_second):
+        for key, entry in list(table.items()):
+            rates = entry.rates(window)
+            if entry.regions == 0 and window > entry.window + 1:
+                del table[key]
+                continue
+            yield key, (entry.bytes, entry.regions, *(round(rate * per_second) for rate in rates))
+
+
+def top_activity(rows, view, sort="bytes", k=ACTIVITY_TOP, pid=None):
+    """The k rows with the largest value of the sort field, as dictionaries."""
+    field = ACTIVITY_FIELDS.index(sort)
+    items = rows.items()
+    if pid is not None and view == "threads":
+        items = [(key, values) for key, values in items if key[0] == pid]
+    result = []
+    for key, values in heapq.nlargest(k, items, key=lambda item: item[1][field]):
+        row = {"pid": key[0], "tid": key[1]} if view == "threads" else {"comm": key}
+        row.update(zip(ACTIVITY_FIELDS, values))
+        result.append(row)
+    return result
+
+
+def activity_request(read_rows, request):
+    """
+    {"view": "threads" or "comms", "sort": one of ACTIVITY_FIELDS, "k": rows, "pid": only
+    the threads of this process}. read_rows(view) returns the rows of a view.
+    """
+    view = request.get("view", "threads")
+    if view not in ("threads", "comms"):
+        raise ValueError(f"unknown view {view!r}")
+    sort = request.get("sort", "bytes")
+    if sort not in ACTIVITY_FIELDS:
+        raise ValueError(f"unknown sort field {sort!r}")
+    k = max(int(request.get("k", ACTIVITY_TOP)), 1)
+    pid = request.get("pid")
+    pid = int(pid) if pid is not None else None
+
+    rows = read_rows(view)
+    return {"view": view, "sort": sort, "count": len(rows), "rows": top_activity(rows, view, sort, k, pid)}
@@ -0,0 +1,171 @@
+import time
+
+ANALYTICS_INTERVAL = 1  # seconds between two "analytics" messages
+LOG2_BUCKETS = 65  # bucket i counts the values in [2**(i-1), 2**i), bucket 0 the zeros
+
+
+class Log2Histogram:
+    """Counts of non-negative integers per power of two, with O(1) updates in both directions."""
+
+    __slots__ = ("counts",)
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * LOG2_BUCKETS
+
+    def add(self, value, count=1):
+        self.counts[value.bit_length()] += count
+
+    def remove(self, value):
+        self.counts[value.bit_length()] -= 1
+
+    def pairs(self):
+        """The non-empty buckets, as [bucket, count] pairs."""
+        return [[i, count] for i, count in enumerate(self.counts) if count]
+
+
+class ProcessAnalytics:
+    __slots__ = ("sizes", "gaps", "lifetimes", "churn")
+
+    def __init__(self):
+        self.sizes = Log2Histogram()  # sizes of the live regions, in bytes
+        self.gaps = Log2Histogram()  # non-empty gaps between consecutive live regions, in bytes
+        self.lifetimes = Log2Histogram()  # add-to-remove times of the regions that were removed, in ns
+        self.churn = [0, 0, 0, 0]  # maps, bytes mapped, unmaps, bytes unmapped since the last snapshot
+
+
+class Analytics:
+    """
+    Fragmentation and churn of the regions of each process.
+
+    The histograms are kept up to date by MemoryTracker._replace_regions, through
+    which every add, remove, split and merge goes: only the replaced regions and their
+    two neighbours are visited. The birth time of a region is inherited by the pieces
+    left by a partial unmap and by the region it is merged into (the earliest one
+    wins), and its lifetime is recorded when part of it is actually removed. The churn
+    is only counted for system calls, like the activity of utils/aggregates.py.
+    """
+
+    def __init__(self):
+        self.processes = {}  # pid -> ProcessAnalytics
+        self.births = {}  # region id -> time it was added
+
+    def _process(self, pid):
+        process = self.processes.get(pid)
+        if process is None:
+            process = self.processes[pid] = ProcessAnalytics()
+        return process
+
+    def replace(self, pid, before, removed, new_regions, after, time):
+        """
+        Account for the removed regions being replaced by new_regions, both sorted.
+        before and after are the end of the region preceding them and the start of the
+        one following them, or None.
+        """
+        process = self._process(pid)
+        sizes, gaps, births = process.sizes, process.gaps, self.births
+
+        for bounds, update in ((removed, gaps.remove), (new_regions, gaps.add)):
+            previous_end = before
+            for region in bounds:
+                if previous_end is not None and region.start_addr > previous_end:
+                    update(region.start_addr - previous_end)
+                previous_end = region.end_addr
+            if previous_end is not None and after is not None and after > previous_end:
+                update(after - previous_end)
+
+        removed_births = []
+        for region in removed:
+            sizes.remove(region.end_addr - region.start_addr)
+            removed_births.append(births.pop(region.id, time))
+
+        # Both lists are sorted and disjoint, so a single sweep finds the overlaps
+        covered = [0] * len(removed)
+        j = 0
+        for region in new_regions:
+            sizes.add(region.end_addr - region.start_addr)
+            while j < len(removed) and removed[j].end_addr <= region.start_addr:
+                j += 1
+            birth = time
+            k = j
+            while k < len(removed) and removed[k].start_addr < region.end_addr:
+                covered[k] += (min(removed[k].end_addr, region.end_addr)
+                               - max(removed[k].start_addr, region.start_addr))
+                birth = min(birth, removed_births[k])
+                k += 1
+            births[region.id] = birth
+
+        lifetimes = process.lifetimes
+        for region, birth, kept in zip(removed, removed_births, covered):
+            if kept < region.end_addr - region.start_addr:
+                lifetimes.add(max(time - birth, 0))
+
+    def mapped(self, pid, size):
+        churn = self._process(pid).churn
+        churn[0] += 1
+        churn[1] += size
+
+    def unmapped(self, pid, size):
+        churn = self._process(pid).churn
+        churn[2] += 1
+        churn[3] += size
+
+    def forget(self, pid):
+        """Drop an exited process, whose regions were all replaced already."""
+        self.processes.pop(pid, None)
+
+    def snapshot(self, live_pids):
+        """
+        Return {pid: (sizes, gaps, lifetimes, churn)} as lists, with the churn since the
+        previous snapshot, and reset the churn. The processes not in live_pids are
+        reported one last time and dropped.
+        """
+        processes = {}
+        for pid, process in list(self.processes.items()):
+            processes[pid] = (list(process.sizes.counts), list(process.gaps.counts), list(process.lifetimes.counts),
+                              process.churn)
+            if pid in live_pids:
+                process.churn = [0, 0, 0, 0]
+            else:
+                del self.processes[pid]
+        return processes
+
+    def merge(self, processes):
+        """Add a snapshot of another Analytics, e.g. of a pipeline worker, owning the PIDs of its processes."""
+        for pid, (sizes, gaps, lifetimes, churn) in processes.items():
+            process = self._process(pid)
+            process.sizes = Log2Histogram(sizes)
+            process.gaps = Log2Histogram(gaps)
+            process.lifetimes = Log2Histogram(lifetimes)
+            process.churn = [total + count for total, count in zip(process.churn, churn)]
+
+
+def analytics_rows(processes, holes, elapsed):
+    """Rows of an "analytics" message, from a snapshot of Analytics and the largest hole of each process."""
+    rows = []
+    for pid, (sizes, gaps, lifetimes, churn) in processes.items():
+        maps, mapped, unmaps, unmapped = churn
+        hole = holes.get(pid)
+        rows.append({
+            "pid": pid,
+            "sizes": Log2Histogram(sizes).pairs(),
+            "gaps": Log2Histogram(gaps).pairs(),
+            "lifetimes": Log2Histogram(lifetimes).pairs(),
+            "largest_hole": {"start": hole[0], "size": hole[1]} if hole is not None else None,
+            "map_rate": round(maps / elapsed, 1),
+            "mapped_rate": round(mapped / elapsed),
+            "unmap_rate": round(unmaps / elapsed, 1),
+            "unmapped_rate": round(unmapped / elapsed),
+        })
+    return rows
+
+
+def publish_analytics_loop(tracker, interval=ANALYTICS_INTERVAL):
+    """Send the analytics of tracker (a MemoryTracker or Pipeline) every interval."""
+    last = time.monotonic()
+    while True:
+        time.sleep(max(0, interval - (time.monotonic() - last)))
+        processes, holes = tracker.analytics_snapshot()
+        now = time.monotonic()
+        elapsed, last = now - last, now
+        if processes:
+            tracker.send_analytics(analytics_rows(processes, holes, elapsed))
@@ -0,0 +1,103 @@
+import time
+
+CALL_SITES_INTERVAL = 1  # seconds between two "callsites" messages
+CALL_SITES_TOP = 20  # call sites sent per message, by live bytes and by allocation rate
+
+
+class CallSites:
+    """
+    Live bytes and churn per call site, a (pid, stack id) pair.
+
+    The live bytes and regions are updated like the aggregates, for every region added
+    or removed, including the pieces left by a partial unmap. The churn (bytes and
+    allocations made, bytes freed) is only counted for the system calls themselves,
+    so splitting a region does not count as churn. Regions without a stack are left
+    out.
+    """
+
+    def __init__(self):
+        self.sites = {}  # (pid, stack) -> [live bytes, live regions, allocated bytes, allocations, freed bytes]
+
+    def _site(self, pid, stack):
+        site = self.sites.get((pid, stack))
+        if site is None:
+            site = self.sites[(pid, stack)] = [0, 0, 0, 0, 0]
+        return site
+
+    def add(self, pid, stack, size):
+        site = self._site(pid, stack)
+        site[0] += size
+        site[1] += 1
+
+    def remove(self, pid, stack, size):
+        site = self._site(pid, stack)
+        site[0] -= size
+        site[1] -= 1
+
+    def allocated(self, pid, stack, size):
+        site = self._site(pid, stack)
+        site[2] += size
+        site[3] += 1
+
+    def freed(self, pid, stack, size):
+        self._site(pid, stack)[4] += size
+
+    def snapshot(self):
+        """
+        Return the call sites, with the churn since the previous snapshot, and reset the
+        churn. The call sites without live regions are reported one last time and dropped.
+        """
+        sites = {key: tuple(site) for key, site in self.sites.items()}
+        for key, site in list(self.sites.items()):
+            if site[1] == 0:
+                del self.sites[key]
+            else:
+                site[2] = site[3] = site[4] = 0
+        return sites
+
+    def merge(self, sites):
+        """Add a snapshot of another CallSites, e.g. of a pipeline worker, owning the PIDs of its call sites."""
+        for key, (live_bytes, live_regions, allocated, allocations, freed) in sites.items():
+            site = self._site(*key)
+            site[0] = live_bytes
+            site[1] = live_regions
+            site[2] += allocated
+            site[3] += allocations
+            site[4] += freed
+
+
+def top_call_sites(sites, symbolizer, elapsed, top=CALL_SITES_TOP):
+    """
+    Rows of a "callsites" message for the top call sites of a snapshot, by live bytes
+    and by allocation rate. Only those are symbolized.
+    """
+    by_live = sorted(sites, key=lambda key: sites[key][0], reverse=True)[:top]
+    by_churn = sorted(sites, key=lambda key: sites[key][2], reverse=True)[:top]
+    rows = []
+    for pid, stack in dict.fromkeys(by_live + by_churn):
+        live_bytes, live_regions, allocated, allocations, freed = sites[(pid, stack)]
+        if live_regions == 0 and allocated == 0 and freed == 0:
+            continue
+        rows.append({
+            "pid": pid,
+            "stack": stack,
+            "frames": symbolizer.frames(pid, stack) if symbolizer is not None else [],
+            "bytes": live_bytes,
+            "regions": live_regions,
+            "allocated_rate": round(allocated / elapsed),
+            "allocation_rate": round(allocations / elapsed, 1),
+            "freed_rate": round(freed / elapsed),
+        })
+    return rows
+
+
+def publish_call_sites_loop(tracker, symbolizer, interval=CALL_SITES_INTERVAL, top=CALL_SITES_TOP):
+    """Send the top call sites of tracker (a MemoryTracker or Pipeline) every interval, symbolized off the event path."""
+    last = time.monotonic()
+    while True:
+        time.sleep(max(0, interval - (time.monotonic() - last)))
+        sites = tracker.call_sites_snapshot()
+        now = time.monotonic()
+        elapsed, last = now - last, now
+        if sites:
+            tracker.send_call_sites(top_call_sites(sites, symbolizer, elapsed, top))
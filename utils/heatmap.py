@@ -0,0 +1,182 @@
+import math
+
+HEATMAP_CHUNK_SHIFT = 21  # address space granularity of the heatmap, 2 MB
+HEATMAP_CHUNK_SIZE = 1 << HEATMAP_CHUNK_SHIFT
+HEATMAP_DEFAULT_BINS = 1_000
+HEATMAP_MAX_BINS = 16_384
+
+
+class AddressHeatmap:
+    """
+    Bytes occupied by the live regions of each PID, per 2 MB chunk of address space.
+
+    Only the chunks partially covered by a region are counted one by one. The chunks
+    a region covers fully are kept as a run, in a difference map with +1 at its first
+    chunk and -1 after its last one, so that an update costs the same however large
+    the region is. The runs are only laid out when a heatmap is requested.
+    """
+
+    def __init__(self):
+        self._edges = {}  # pid -> {chunk index: occupied bytes}, of the partially covered chunks
+        self._runs = {}  # pid -> {chunk index: change in the number of regions covering the chunk fully}
+
+    def add(self, pid, start_addr, end_addr):
+        edges = self._edges.get(pid)
+        if edges is None:
+            edges = self._edges[pid] = {}
+            self._runs[pid] = {}
+        runs = self._runs[pid]
+        pieces, first, end = _split(start_addr, end_addr)
+        for chunk, overlap in pieces:
+            edges[chunk] = edges.get(chunk, 0) + overlap
+        if first < end:
+            _shift(runs, first, 1)
+            _shift(runs, end, -1)
+
+    def remove(self, pid, start_addr, end_addr):
+        edges, runs = self._edges[pid], self._runs[pid]
+        pieces, first, end = _split(start_addr, end_addr)
+        for chunk, overlap in pieces:
+            _shift(edges, chunk, -overlap)
+        if first < end:
+            _shift(runs, first, -1)
+            _shift(runs, end, 1)
+        if not edges and not runs:
+            del self._edges[pid]
+            del self._runs[pid]
+
+    def merge(self, snapshots):
+        """Replace the chunks of the PIDs of snapshots ({pid: snapshot(pid)}), e.g. reported by pipeline workers."""
+        for pid, (edges, runs) in snapshots.items():
+            if edges or runs:
+                self._edges[pid], self._runs[pid] = edges, runs
+            else:
+                self._edges.pop(pid, None)
+                self._runs.pop(pid, None)
+
+    def snapshot(self, pid=None):
+        """Copy of the (edges, runs) of pid, or of all the PIDs added up."""
+        if pid is not None:
+            return dict(self._edges.get(pid, {})), dict(self._runs.get(pid, {}))
+        merged = {}, {}
+        for pid in list(self._edges):
+            for total, counts in zip(merged, (self._edges.get(pid, {}), self._runs.get(pid, {}))):
+                for chunk, count in list(counts.items()):
+                    _shift(total, chunk, count)
+        return merged
+
+
+def _shift(counts, chunk, delta):
+    """Add delta to counts[chunk], dropping the chunks back at zero."""
+    count = counts.get(chunk, 0) + delta
+    if count:
+        counts[chunk] = count
+    else:
+        del counts[chunk]
+
+
+def _split(start_addr, end_addr):
+    """
+    The (chunk index, bytes) pairs of the chunks partially covered by [start_addr,
+    end_addr), and the [first, end) chunk indices of those it covers fully.
+    """
+    first, end = (start_addr + HEATMAP_CHUNK_SIZE - 1) >> HEATMAP_CHUNK_SHIFT, end_addr >> HEATMAP_CHUNK_SHIFT
+    if first > end:
+        # Within a single chunk
+        return [(start_addr >> HEATMAP_CHUNK_SHIFT, end_addr - start_addr)], first, first
+    pieces = []
+    if start_addr < first << HEATMAP_CHUNK_SHIFT:
+        pieces.append((start_addr >> HEATMAP_CHUNK_SHIFT, (first << HEATMAP_CHUNK_SHIFT) - start_addr))
+    if end_addr > end << HEATMAP_CHUNK_SHIFT:
+        pieces.append((end, end_addr - (end << HEATMAP_CHUNK_SHIFT)))
+    return pieces, first, end
+
+
+def gap_width(gap):
+    """Displayed width, in chunks, of a gap of that many empty chunks: linear when small, logarithmic when large."""
+    return min(gap, 1 + math.log2(gap)) if gap > 0 else 0
+
+
+def heatmap_bins(chunks, bins):
+    """
+    Lay the occupied chunks of an AddressHeatmap snapshot out along a line, with the
+    gaps between them compressed by gap_width, and cut it into bins of equal width.
+
+    Returns the address at each bin boundary (bins + 1 of them), the fraction of each
+    bin occupied by regions, and the [start, end) address ranges of the gaps shown at
+    less than half their size.
+    """
+    edges, runs = chunks
+    if not edges and not runs:
+        return {"addresses": [], "occupancy": [], "gaps": []}
+
+    # Segments of the line: (width, first address, last address, occupied bytes). A run
+    # of fully covered chunks is a single segment, however many chunks it spans.
+    segments = []
+    boundaries = sorted({*runs, *edges, *(chunk + 1 for chunk in edges)})
+    covering = 0  # regions covering the chunks from boundary onwards fully
+    gap_start = None
+    for boundary, next_boundary in zip(boundaries, boundaries[1:]):
+        covering += runs.get(boundary, 0)
+        occupied_bytes = covering * (next_boundary - boundary) * HEATMAP_CHUNK_SIZE + edges.get(boundary, 0)
+        if not occupied_bytes:
+            if gap_start is None:
+                gap_start = boundary
+            continue
+        if gap_start is not None:
+            gap = boundary - gap_start
+            segments.append((gap_width(gap), gap_start << HEATMAP_CHUNK_SHIFT, boundary << HEATMAP_CHUNK_SHIFT, 0))
+            gap_start = None
+        segments.append((next_boundary - boundary, boundary << HEATMAP_CHUNK_SHIFT,
+                         next_boundary << HEATMAP_CHUNK_SHIFT, occupied_bytes))
+
+    length = sum(width for width, _, _, _ in segments)
+    bin_width = length / bins
+    occupied = [0.0] * bins
+    addresses = [0] * (bins + 1)
+    gaps = []
+
+    position = 0.0
+    next_boundary = 0  # index of the next bin boundary to place
+    for width, start, end, occupied_bytes in segments:
+        segment_end = position + width
+        if end - start > 2 * width * HEATMAP_CHUNK_SIZE:
+            gaps.append([start, end])
+
+        # Bin boundaries inside the segment, mapped linearly onto its addresses
+        while next_boundary <= bins and next_boundary * bin_width <= segment_end:
+            offset = (next_boundary * bin_width - position) / width
+            addresses[next_boundary] = start + int(max(offset, 0) * (end - start))
+            next_boundary += 1
+
+        # Spread the occupied bytes over the bins the segment covers
+        if occupied_bytes:
+            density = occupied_bytes / width
+            first_bin = min(int(position / bin_width), bins - 1)
+            last_bin = min(int(segment_end / bin_width), bins - 1)
+            for index in range(first_bin, last_bin + 1):
+                overlap = min(segment_end, (index + 1) * bin_width) - max(position, index * bin_width)
+                if overlap > 0:
+                    occupied[index] += density * overlap
+        position = segment_end
+
+    while next_boundary <= bins:
+        addresses[next_boundary] = segments[-1][2]
+        next_boundary += 1
+
+    capacity = bin_width * HEATMAP_CHUNK_SIZE
+    return {
+        "addresses": addresses,
+        "occupancy": [round(min(bytes / capacity, 1.0), 3) for bytes in occupied],
+        "gaps": gaps,
+    }
+
+
+def heatmap_request(heatmap, lock, request):
+    """{"pid": pid or null for all, "bins": count}, the chunks are copied under lock (the one updating heatmap)."""
+    pid = request.get("pid")
+    pid = int(pid) if pid is not None else None
+    bins = min(max(int(request.get("bins", HEATMAP_DEFAULT_BINS)), 1), HEATMAP_MAX_BINS)
+    with lock:
+        chunks = heatmap.snapshot(pid)
+    return {"pid": pid, "bins": bins, **heatmap_bins(chunks, bins)}
@@ -0,0 +1,239 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATS_INTERVAL = 1  # seconds between "stats" messages
+TIMING_SAMPLE_INTERVAL = 16  # one event (or batch of events) in this many is timed, counters are exact
+
+# Names of the ring-buffer event types, see bpf.c
+EVENT_TYPES = {
+    2: "mmap",
+    4: "mremap",
+    5: "munmap",
+    7: "brk",
+    8: "clone_enter",
+    9: "clone_exit",
+    10: "clone3_enter",
+    11: "clone3_exit",
+    12: "vfork_enter",
+    13: "vfork_exit",
+    14: "process_exit",
+}
+MAX_EVENT_TYPE = max(EVENT_TYPES)
+
+# Indices of the per-CPU `stats` array of bpf.c
+KERNEL_COUNTERS = [
+    "ringbuf_drops",  # events dropped because the ring buffer was full
+    "unmatched_exits",  # syscall exits of tracked threads without the arguments of their enter
+    "unmatched_enters",  # syscall enters whose previous enter never saw its exit
+    "args_map_full",  # syscall enters whose arguments could not be stored
+    "faults_map_full",  # page faults that could not be counted, the page_faults map was full
+    "stack_ids_failed",  # user stacks of --stacks that could not be captured
+]
+
+# Stages timed for the sampled events (and every message or reconciliation), in nanoseconds
+STAGES = [
+    "decode",  # ring-buffer callback, excluding the tracker update
+    "tracker_update",  # tracker method applying an event, including the wait for the lock
+    "lock_hold",  # time the tracker lock is held, by any thread
+    "serialize",  # encoding of a batch of messages, per message
+    "send",  # broadcast of a batch to the clients, per message
+    "reconcile",  # comparison of the regions of a process with /proc/<pid>/maps, see usage/maps.py
+]
+
+
+class Histogram:
+    """Log2 histogram of durations in nanoseconds: bucket i counts values below 2**i."""
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns, count=1):
+        self.buckets[ns.bit_length()] += count
+        self.count += count
+        self.total += ns * count
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, raw):
+        for i, count in enumerate(raw["buckets"]):
+            self.buckets[i] += count
+        self.count += raw["count"]
+        self.total += raw["total"]
+        self.max = max(self.max, raw["max"])
+
+    def raw(self):
+        return {"buckets": list(self.buckets), "count": self.count, "total": self.total, "max": self.max}
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of the values."""
+        threshold = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count > 0 and seen >= threshold:
+                return min(1 << i, self.max)
+        return 0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count / 1000, 2) if self.count else 0,
+            "p50_us": round(self.percentile(0.5) / 1000, 2),
+            "p99_us": round(self.percentile(0.99) / 1000, 2),
+            "max_us": round(self.max / 1000, 2),
+        }
+
+
+class Stats:
+    """
+    Counters and stage timings of this process.
+
+    Updates are plain Python arithmetic without a lock: a concurrent update may
+    rarely be lost, which is fine for statistics. Other sources (the kernel counters,
+    the pipeline workers) are merged in when a snapshot is taken.
+
+    Timing every event would slow the tracer down noticeably, so only the sampled
+    events are timed: `timing` is set while one is processed, and tells the tracker
+    to time its update.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = [0] * (MAX_EVENT_TYPE + 1)
+        self.unknown_events = 0
+        self.counters = {
+            "unmatched_clone_exits": 0,  # clone exits whose enter was not seen
+            "event_cache_replayed": 0,  # events of new children applied once their clone exit was seen
+            "event_cache_expired": 0,  # buffered events of PIDs that were never tracked
+            "event_cache_dropped": 0,  # events not buffered because the event cache was full
+            "pipeline_ring_full": 0,  # waits of the polling thread for a worker to catch up
+            "residency_pages": 0,  # pages whose pagemap entry was read by the residency sampler
+            "reconcile_added": 0,  # ranges mapped by a process that the tracker missed
+            "reconcile_removed": 0,  # ranges the tracker kept after the process unmapped them
+            "page_faults": 0,  # page faults drained from the kernel, see usage/faults.py
+            "page_faults_untracked": 0,  # of which in a 2 MB bucket without any tracked region
+            "server_batches_failed": 0,  # batches of events that could not be sent, see Server._flush_loop
+        }
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.tracker_update_ns = 0  # running total, to exclude the tracker from the decode stage
+        self.timing = False
+        self._sample_countdown = TIMING_SAMPLE_INTERVAL
+
+        self._kernel_counters = None
+        self._remote = {}  # raw stats of other processes, e.g. the pipeline workers
+
+    def sample(self):
+        """Whether the next event should be timed."""
+        self._sample_countdown -= 1
+        if self._sample_countdown > 0:
+            return False
+        self._sample_countdown = TIMING_SAMPLE_INTERVAL
+        return True
+
+    def count_event(self, type, count=1):
+        if type in EVENT_TYPES:
+            self.events[type] += count
+        else:
+            self.unknown_events += count
+
+    def set_kernel_counters(self, read):
+        """read() returns the totals of the BPF counters, in the order of KERNEL_COUNTERS."""
+        self._kernel_counters = read
+
+    def set_remote(self, source, raw):
+        """Replace the latest raw stats received from another process."""
+        self._remote[source] = raw
+
+    def raw(self):
+        return {
+            "events": list(self.events),
+            "unknown_events": self.unknown_events,
+            "counters": dict(self.counters),
+            "stages": {stage: histogram.raw() for stage, histogram in self.stages.items()},
+        }
+
+    def snapshot(self):
+        events = list(self.events)
+        unknown_events = self.unknown_events
+        counters = dict(self.counters)
+        stages = {stage: Histogram() for stage in STAGES}
+        for stage, histogram in self.stages.items():
+            stages[stage].merge(histogram.raw())
+
+        for raw in list(self._remote.values()):
+            for type, count in enumerate(raw["events"]):
+                events[type] += count
+            unknown_events += raw["unknown_events"]
+            for name, count in raw["counters"].items():
+                counters[name] = counters.get(name, 0) + count
+            for stage, histogram in raw["stages"].items():
+                stages[stage].merge(histogram)
+
+        kernel = {name: 0 for name in KERNEL_COUNTERS}
+        if self._kernel_counters is not None:
+            kernel = dict(zip(KERNEL_COUNTERS, self._kernel_counters()))
+
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "events": {name: events[type] for type, name in EVENT_TYPES.items()},
+            "unknown_events": unknown_events,
+            "kernel": kernel,
+            "counters": counters,
+            "stages": {stage: histogram.summary() for stage, histogram in stages.items()},
+        }
+
+
+# Stats of this process, updated by the tracer handlers, the tracker and the server
+stats = Stats()
+
+
+@contextmanager
+def timed_hold(lock):
+    """Hold lock, recording how long in the lock_hold stage."""
+    with lock:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            stats.stages["lock_hold"].record(time.perf_counter_ns() - start)
+
+
+def format_text(snapshot, prefix="smv"):
+    """Plain-text exposition of a snapshot, one `name{labels} value` line per metric."""
+    lines = [f"{prefix}_uptime_seconds {snapshot['uptime_s']}"]
+    for name, count in snapshot["events"].items():
+        lines.append(f'{prefix}_events_total{{type="{name}"}} {count}')
+    lines.append(f"{prefix}_unknown_events_total {snapshot['unknown_events']}")
+    for name, count in snapshot["kernel"].items():
+        lines.append(f"{prefix}_kernel_{name}_total {count}")
+    for name, count in snapshot["counters"].items():
+        lines.append(f"{prefix}_{name}_total {count}")
+    for stage, summary in snapshot["stages"].items():
+        for field, value in summary.items():
+            lines.append(f'{prefix}_stage_{field}{{stage="{stage}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class _TextHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = format_text(stats.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_text_endpoint(port):
+    """Serve the stats as plain text on localhost, returns the port actually used."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _TextHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
@@ -0,0 +1,493 @@
+import multiprocessing
+import struct
+import threading
+import time
+from collections import deque
+from functools import partial
+from ctypes import addressof, c_char, c_void_p, cast, memmove, string_at, POINTER
+from multiprocessing.shared_memory import SharedMemory
+
+from tracers.common import Event
+from tracers.events import forget_process, handle_event
+from tracers.tracked_pids import AllPids
+from utils.aggregates import activity_request, merge_summaries
+from utils.analytics import Analytics
+from utils.callsites import CallSites
+from utils.heatmap import AddressHeatmap, heatmap_request
+from utils.instrumentation import STATS_INTERVAL, stats
+from utils.timeline import TimelinePoints
+from utils.tracker import MemoryTracker
+from usage.maps import reconcile_pid
+
+RING_CAPACITY = 8 << 20  # bytes of raw records per worker
+WORKER_WAIT_TIMEOUT = 0.1  # seconds a worker waits for records before checking again
+SNAPSHOT_TIMEOUT = 5  # seconds live_regions() waits for the regions of the workers
+
+# Event types handled by the workers, the clone events stay on the polling thread since
+# they update the tracked PID set. See bpf.c.
+MEMORY_EVENT_TYPES = {2, 4, 5, 7}
+PROCESS_EXIT_EVENT_TYPE = 14  # handled by both: untracked here, the regions dropped by the worker
+WORKER_EVENT_TYPES = MEMORY_EVENT_TYPES | {PROCESS_EXIT_EVENT_TYPE}
+
+# Records the pipeline itself sends to the workers, using event types bpf.c never emits
+CONTROL_RECORD = struct.Struct("<QQQ")  # type, pid, value
+CONTROL_TIME_BASE = 1 << 32  # value: kernel timestamp used as time 0
+CONTROL_CLEAR_PID = (1 << 32) + 1  # pid: process whose allocations are dropped
+CONTROL_RECONCILE_PID = (1 << 32) + 2  # pid: process whose allocations are compared with /proc/<pid>/maps
+CONTROL_SNAPSHOT = (1 << 32) + 3  # pid: serial of a request for the live regions
+
+RING_HEADER = struct.Struct("<QQ")  # bytes written, bytes read
+RECORD_LENGTH = struct.Struct("<I")
+WRAP_MARKER = 0xffffffff
+
+
+class SharedRing:
+    """
+    Single-producer single-consumer ring of length-prefixed records in shared memory.
+
+    The header holds the total number of bytes written and read. Records never wrap
+    around the end of the buffer: the remaining space is skipped instead. The producer
+    publishes its position before signalling the consumer through a semaphore, which
+    orders the writes to the buffer before the reads of the consumer.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY, name=None):
+        if name is None:
+            self._shm = SharedMemory(create=True, size=RING_HEADER.size + capacity)
+        else:
+            # Spawned workers share the resource tracker of the creating process, which
+            # unlinks the segment
+            self._shm = SharedMemory(name=name)
+        self.name = self._shm.name
+        self.capacity = capacity
+        self._buffer = self._shm.buf
+        self._data = addressof(c_char.from_buffer(self._buffer)) + RING_HEADER.size
+        self._written, self._read = RING_HEADER.unpack_from(self._buffer, 0)
+        self._published = self._written
+
+    def _reserve(self, length):
+        """Return the buffer offset of length free bytes, or -1 if the ring is full."""
+        position = self._written % self.capacity
+        if position + length > self.capacity:
+            skipped = self.capacity - position
+            if self._written + skipped + length - self._read_position() > self.capacity:
+                return -1
+            if skipped >= RECORD_LENGTH.size:
+                RECORD_LENGTH.pack_into(self._buffer, RING_HEADER.size + position, WRAP_MARKER)
+            self._written += skipped
+            position = 0
+        elif self._written + length - self._read_position() > self.capacity:
+            return -1
+        return position
+
+    def _read_position(self):
+        return RING_HEADER.unpack_from(self._buffer, 0)[1]
+
+    def write(self, raw_data, size):
+        """Copy a record into the ring. Returns False if the ring is full."""
+        position = self._reserve(RECORD_LENGTH.size + size)
+        if position < 0:
+            return False
+        RECORD_LENGTH.pack_into(self._buffer, RING_HEADER.size + position, size)
+        memmove(self._data + position + RECORD_LENGTH.size, raw_data, size)
+        self._written += RECORD_LENGTH.size + size
+        return True
+
+    def publish(self):
+        """Make the written records visible to the consumer. Returns whether there were any."""
+        if self._written == self._published:
+            return False
+        struct.pack_into("<Q", self._buffer, 0, self._written)
+        self._published = self._written
+        return True
+
+    def read_all(self, callback):
+        """Call callback(address, size) for every published record, then release their space."""
+        written = RING_HEADER.unpack_from(self._buffer, 0)[0]
+        read = self._read
+        while read < written:
+            position = read % self.capacity
+            if self.capacity - position < RECORD_LENGTH.size:
+                read += self.capacity - position
+                continue
+            length = RECORD_LENGTH.unpack_from(self._buffer, RING_HEADER.size + position)[0]
+            if length == WRAP_MARKER:
+                read += self.capacity - position
+                continue
+            callback(self._data + position + RECORD_LENGTH.size, length)
+            read += RECORD_LENGTH.size + length
+        self._read = read
+        struct.pack_into("<Q", self._buffer, 8, read)
+
+    def close(self, unlink=False):
+        self._buffer.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+class DeltaPublisher:
+    """Server stand-in for the trackers of the workers, sending their messages to the main process."""
+
+    def __init__(self, queue, worker):
+        self._queue = queue
+        self._worker = worker
+        self._messages = []
+
+    def notify_clients_threadsafe(self, event_message, save_event=True):
+        self._messages.append((event_message, save_event))
+
+    def flush(self):
+        if self._messages:
+            self._queue.put((self._worker, self._messages))
+            self._messages = []
+
+
+def _worker_main(index, workers, ring_name, ring_capacity, ready, deltas, page_size, activity, analytics):
+    ring = SharedRing(ring_capacity, name=ring_name)
+    publisher = DeltaPublisher(deltas, index)
+    tracker = MemoryTracker(page_size, server=publisher, first_id=index, id_step=workers, activity=activity,
+                            analytics=analytics)
+    # The worker owns the heatmap and the history of its PIDs, reported to the main process
+    tracker.heatmap = AddressHeatmap()
+    tracker.timeline = TimelinePoints()
+    # Only the events of tracked PIDs are sent to the workers
+    tracked_pids = AllPids()
+
+    def handle_record(address, size):
+        type = cast(c_void_p(address), POINTER(Event)).contents.type
+        if type == CONTROL_TIME_BASE:
+            tracker.set_start_time_kernel(CONTROL_RECORD.unpack(string_at(address, size))[2])
+        elif type == CONTROL_CLEAR_PID:
+            tracker.clear_allocations_for_pid(CONTROL_RECORD.unpack(string_at(address, size))[1])
+        elif type == CONTROL_RECONCILE_PID:
+            reconcile_pid(tracker, CONTROL_RECORD.unpack(string_at(address, size))[1])
+        elif type == CONTROL_SNAPSHOT:
+            # In order with the messages of the events before it, see Pipeline._forward_deltas
+            publisher.notify_clients_threadsafe({"type": "worker_regions", "worker": index,
+                                                 "serial": CONTROL_RECORD.unpack(string_at(address, size))[1],
+                                                 "regions": tracker.live_regions()})
+        else:
+            handle_event(0, c_void_p(address), size, tracker, tracked_pids)
+
+    changed = set()  # PIDs whose regions changed since the last heatmap report
+    next_stats = time.monotonic()
+    while True:
+        ready.acquire(timeout=WORKER_WAIT_TIMEOUT)
+        ring.read_all(handle_record)
+        report = time.monotonic() >= next_stats
+        if report:
+            # The totals of the current bucket so far, merged with the rest of it later
+            tracker.timeline.flush_pending()
+        points = tracker.timeline.take()
+        if points:
+            publisher.notify_clients_threadsafe({"type": "worker_timeline", "worker": index, "points": points})
+            for _, pids, _ in points:
+                changed.update(pids)
+        if report:
+            # Merged into the stats of the main process, see Pipeline._forward_deltas
+            publisher.notify_clients_threadsafe({"type": "worker_stats", "worker": index, "stats": stats.raw()})
+            publisher.notify_clients_threadsafe({"type": "worker_summary", "worker": index,
+                                                 "aggregates": tracker.aggregates.snapshot()})
+            if changed:
+                publisher.notify_clients_threadsafe({"type": "worker_heatmap", "worker": index, "pids": {
+                    pid: tracker.heatmap.snapshot(pid) for pid in changed}})
+                changed = set()
+            if tracker.call_sites.sites:
+                publisher.notify_clients_threadsafe({"type": "worker_call_sites",
+                                                     "sites": tracker.call_sites_snapshot()})
+            if tracker.analytics is not None and tracker.analytics.processes:
+                processes, holes = tracker.analytics_snapshot()
+                publisher.notify_clients_threadsafe({"type": "worker_analytics", "processes": processes,
+                                                     "holes": holes})
+            if tracker.activity is not None:
+                publisher.notify_clients_threadsafe({"type": "worker_activity", "worker": index,
+                                                     "threads": tracker.activity_rows("threads"),
+                                                     "comms": tracker.activity_rows("comms")})
+            next_stats = time.monotonic() + STATS_INTERVAL
+        publisher.flush()
+
+
+class _SnapshotRequest:
+    """Live regions requested from all the workers, see Pipeline._request_snapshot."""
+
+    def __init__(self, keyframe):
+        self.keyframe = keyframe
+        self.regions = {}  # pid -> RegionSet, of the workers that replied
+        self.workers = set()  # workers that replied
+        self.held = []  # (worker, message, save_event) sent by those workers since, for a keyframe
+        self.done = threading.Event()
+
+
+class Pipeline:
+    """
+    Decodes and applies ring-buffer events in worker processes.
+
+    The polling thread only copies the raw records of tracked PIDs into a shared-memory
+    ring per worker, choosing the worker from the PID so that the events of a process
+    stay in order. Each worker runs the tracer handlers with its own MemoryTracker
+    and sends the resulting messages back, where they are forwarded to the server.
+    Clone events are still handled on the polling thread since they decide which
+    PIDs are tracked.
+
+    The workers own the regions, aggregates, heatmap and timeline of their PIDs: the
+    main process does no per-event work besides forwarding the messages. It merges
+    the reports the workers send every STATS_INTERVAL (totals, heatmap of the PIDs
+    that changed, call sites...) and their timeline points, and asks them for their
+    regions when it needs them, for a keyframe or the residency and fault samplers.
+    """
+
+    def __init__(self, workers, tracker: MemoryTracker, tracked_pids, event_cache=None, ring_capacity=RING_CAPACITY):
+        self.tracker = tracker
+        self.tracked_pids = tracked_pids
+        self.event_cache = event_cache
+        if event_cache is not None:
+            # The buffered events of new children are decoded by their worker too
+            event_cache.forward = self.dispatch
+        self._time_base_sent = False
+        self._control_records = deque()  # (worker, record) filled from other threads, written by the polling thread
+
+        # Reports of the workers, merged to serve the summaries and requests of the server
+        self._reports_lock = threading.Lock()
+        self._summaries = {}  # worker -> Aggregates snapshot of its last report
+        self._heatmap = AddressHeatmap()  # merged from the workers, which own the heatmap of their PIDs
+        self._call_sites = CallSites()  # merged from the workers, which own the call sites of their PIDs
+        self._activity = {}  # worker -> (threads, comms) rows of its last report
+        # Merged from the workers, like the call sites
+        self._analytics = Analytics() if tracker.analytics is not None else None
+        self._holes = {}  # pid -> largest hole of the last report of its worker
+        self._snapshots = {}  # serial -> _SnapshotRequest waiting for some workers
+        self._snapshot_serial = 0
+        self._keyframe = None  # _SnapshotRequest of the keyframe in progress
+        tracker.server.keyframe_provider = self.publish_keyframe
+        tracker.server.summary_provider = self.publish_summary
+        tracker.server.request_handlers["heatmap"] = partial(heatmap_request, self._heatmap, self._reports_lock)
+        if tracker.activity is not None:
+            tracker.server.request_handlers["activity"] = partial(activity_request, self.activity_rows)
+
+        context = multiprocessing.get_context("spawn")
+        self._deltas = context.Queue()
+        self._rings = []
+        self._ready = []
+        self._processes = []
+        for index in range(workers):
+            ring = SharedRing(ring_capacity)
+            ready = context.Semaphore(0)
+            process = context.Process(
+                target=_worker_main,
+                args=(index, workers, ring.name, ring.capacity, ready, self._deltas, tracker.page_size,
+                      tracker.activity is not None, tracker.analytics is not None),
+                daemon=True,
+            )
+            process.start()
+            self._rings.append(ring)
+            self._ready.append(ready)
+            self._processes.append(process)
+
+        self._forward_thread = threading.Thread(target=self._forward_deltas, daemon=True)
+        self._forward_thread.start()
+
+    def dispatch(self, cpu, raw_data, size):
+        """Ring-buffer callback."""
+        event = cast(raw_data, POINTER(Event)).contents
+        pid = event.pid_and_tid >> 32
+        if event.type not in WORKER_EVENT_TYPES or pid not in self.tracked_pids:
+            # Clone events, and events of untracked PIDs that may need to be cached
+            handle_event(cpu, raw_data, size, self.tracker, self.tracked_pids, self.event_cache)
+            return
+
+        if not self._time_base_sent:
+            self._send_time_base(event.timestamp)
+        self._write(pid % len(self._rings), raw_data, size)
+        if event.type == PROCESS_EXIT_EVENT_TYPE:
+            # After the write, so that the worker drops the regions after applying the events before the exit
+            forget_process(pid, self.tracked_pids, self.event_cache)
+
+    def _send_time_base(self, ts):
+        self.tracker.set_start_time_kernel(ts)
+        record = CONTROL_RECORD.pack(CONTROL_TIME_BASE, 0, ts)
+        for index in range(len(self._rings)):
+            self._write(index, record, len(record))
+        self._time_base_sent = True
+
+    def _write(self, index, raw_data, size):
+        ring = self._rings[index]
+        while not ring.write(raw_data, size):
+            # Ring full: let the worker catch up, this pushes back on the kernel ring buffer
+            stats.counters["pipeline_ring_full"] += 1
+            self.flush()
+            time.sleep(0.001)
+
+    def flush(self):
+        """Make the copied records visible to the workers, called after each ring-buffer poll."""
+        while self._control_records:
+            index, record = self._control_records.popleft()
+            if not self._time_base_sent:
+                # Reconciling before any event, the kernel timestamps use the monotonic clock
+                self._send_time_base(time.monotonic_ns())
+            if not self._rings[index].write(record, len(record)):
+                self._control_records.appendleft((index, record))  # retried on the next flush
+                break
+
+        for ring, ready in zip(self._rings, self._ready):
+            if ring.publish():
+                ready.release()
+
+    def _control(self, type, pid):
+        self._control_records.append((pid % len(self._rings), CONTROL_RECORD.pack(type, pid, 0)))
+
+    def clear_allocations_for_pid(self, pid):
+        """Drop the allocations of an exited process. Can be called from any thread."""
+        self._control(CONTROL_CLEAR_PID, pid)
+
+    def reconcile_pid(self, pid):
+        """Have the worker of pid reconcile its allocations, see usage/maps.py. Can be called from any thread."""
+        self._control(CONTROL_RECONCILE_PID, pid)
+
+    def _request_snapshot(self, keyframe):
+        """Ask every worker for its live regions, called under the reports lock."""
+        self._snapshot_serial += 1
+        request = self._snapshots[self._snapshot_serial] = _SnapshotRequest(keyframe)
+        record = CONTROL_RECORD.pack(CONTROL_SNAPSHOT, self._snapshot_serial, 0)
+        for index in range(len(self._rings)):
+            self._control_records.append((index, record))
+        return self._snapshot_serial, request
+
+    def send_usage(self, rss, vm):
+        self.tracker.send_usage(rss, vm)
+
+    def live_regions(self):
+        """
+        Snapshot of the live regions of all workers, {pid: RegionSet}. Waits for the
+        workers to reply, after the next ring-buffer poll.
+        """
+        with self._reports_lock:
+            serial, request = self._request_snapshot(keyframe=False)
+        if not request.done.wait(SNAPSHOT_TIMEOUT):
+            stats.counters["pipeline_snapshot_timeouts"] += 1
+        with self._reports_lock:
+            self._snapshots.pop(serial, None)
+            return request.regions
+
+    def send_residency(self, regions):
+        self.tracker.send_residency(regions)
+
+    def send_faults(self, faults):
+        self.tracker.send_faults(faults)
+
+    def call_sites_snapshot(self):
+        """Call sites of all workers, up to their last report (every STATS_INTERVAL)."""
+        with self._reports_lock:
+            return self._call_sites.snapshot()
+
+    def send_call_sites(self, rows):
+        self.tracker.send_call_sites(rows)
+
+    def analytics_snapshot(self):
+        """Analytics of all workers, up to their last report (every STATS_INTERVAL)."""
+        with self._reports_lock:
+            live = {row["pid"] for summary in self._summaries.values() for row in summary["processes"]}
+            processes = self._analytics.snapshot(live)
+            for pid in self._holes.keys() - self._analytics.processes.keys():
+                del self._holes[pid]
+            return processes, dict(self._holes)
+
+    def send_analytics(self, rows):
+        self.tracker.send_analytics(rows)
+
+    def activity_rows(self, view):
+        """
+        Activity rows of all workers, up to their last report (every STATS_INTERVAL). The
+        threads of a PID all belong to one worker, the commands are summed.
+        """
+        with self._reports_lock:
+            reports = list(self._activity.values())
+        if view == "threads":
+            return {key: values for threads, _ in reports for key, values in threads.items()}
+        rows = {}
+        for _, comms in reports:
+            for comm, values in comms.items():
+                rows[comm] = tuple(map(sum, zip(rows[comm], values))) if comm in rows else values
+        return rows
+
+    def _forward_deltas(self):
+        while True:
+            worker, messages = self._deltas.get()
+            with self._reports_lock:
+                for message, save_event in messages:
+                    keyframe = self._keyframe
+                    if keyframe is not None and worker in keyframe.workers:
+                        # Sent after the regions of its worker in the keyframe, so forwarded after the keyframe
+                        keyframe.held.append((worker, message, save_event))
+                    else:
+                        self._forward(worker, message, save_event)
+
+    def _forward(self, worker, message, save_event):
+        type = message["type"]
+        if type == "worker_stats":
+            stats.set_remote(("worker", worker), message["stats"])
+        elif type == "worker_timeline":
+            if self.tracker.timeline is not None:
+                self.tracker.timeline.merge(worker, message["points"])
+        elif type == "worker_summary":
+            self._summaries[worker] = message["aggregates"]
+        elif type == "worker_heatmap":
+            self._heatmap.merge(message["pids"])
+        elif type == "worker_call_sites":
+            self._call_sites.merge(message["sites"])
+        elif type == "worker_analytics":
+            self._analytics.merge(message["processes"])
+            self._holes.update(message["holes"])
+        elif type == "worker_activity":
+            self._activity[worker] = (message["threads"], message["comms"])
+        elif type == "worker_regions":
+            self._snapshot_received(worker, message["serial"], message["regions"])
+        else:
+            if type == "pid_exit" and self._analytics is not None:
+                self._analytics.forget(message["pid"])
+                self._holes.pop(message["pid"], None)
+            self.tracker.server.notify_clients_threadsafe(message, save_event)
+
+    def _snapshot_received(self, worker, serial, regions):
+        request = self._snapshots.get(serial)
+        if request is None:
+            return  # Timed out
+        request.regions.update(regions)
+        request.workers.add(worker)
+        if len(request.workers) < len(self._rings):
+            return
+        del self._snapshots[serial]
+        request.done.set()
+        if request.keyframe:
+            self._keyframe = None
+            time = self.tracker._get_current_time()
+            snapshot = request.regions
+            self.tracker.server.notify_keyframe(time, lambda: [
+                self.tracker._add_allocation_message(region, pid, time)
+                for pid, regions in snapshot.items()
+                for region in regions
+            ])
+            for held in request.held:
+                self._forward(*held)
+
+    def publish_keyframe(self):
+        """Ask the workers for their regions, the keyframe is sent once they all replied."""
+        with self._reports_lock:
+            if self._keyframe is None:
+                self._keyframe = self._request_snapshot(keyframe=True)[1]
+
+    def publish_summary(self):
+        """Totals of all workers, up to their last report (every STATS_INTERVAL)."""
+        with self._reports_lock:
+            summary = merge_summaries(list(self._summaries.values()))
+        self.tracker.server.notify_clients_threadsafe({
+            "type": "summary",
+            "time": self.tracker._get_current_time(),
+            **summary,
+        }, save_event=False)
+
+    def close(self):
+        for process in self._processes:
+            process.terminate()
+        for ring in self._rings:
+            ring.close(unlink=True)
@@ -0,0 +1,81 @@
+import json
+import struct
+
+# Websocket subprotocols, offered by the client at connect time. Clients that offer
+# neither (or only JSON) receive JSON text frames.
+BINARY_PROTOCOL = "smv.binary.v1"
+JSON_PROTOCOL = "smv.json"
+
+# Binary frames are a sequence of little-endian records, each starting with a tag byte.
+# Addresses and times are full 64-bit values, commands are indices into a string table
+# whose entries are sent once per connection, before the first record using them.
+TAG_COMM = 0
+TAG_ADD = 1
+TAG_REMOVE = 2
+TAG_USAGE = 3
+TAG_TIME = 4
+TAG_JSON = 255  # any other message, as a JSON document
+
+COMM_RECORD = struct.Struct("<BIB")  # tag, comm index, length, followed by utf-8 bytes
+ADD_RECORD = struct.Struct("<BqQIIQQQ")  # tag, time, id, pid, comm index, start, end, pages
+REMOVE_RECORD = struct.Struct("<BqQI")  # tag, time, id, pid
+USAGE_RECORD = struct.Struct("<BqQQ")  # tag, time, rss, vm
+TIME_RECORD = struct.Struct("<Bq")  # tag, time
+JSON_RECORD = struct.Struct("<BI")  # tag, length, followed by utf-8 JSON
+
+
+def select_subprotocol(connection, subprotocols):
+    if BINARY_PROTOCOL in subprotocols:
+        return BINARY_PROTOCOL
+    if JSON_PROTOCOL in subprotocols:
+        return JSON_PROTOCOL
+    return None
+
+
+class BinaryEncoder:
+    """
+    Encodes messages into binary frames. The command table is shared by all the
+    connections, each connection only tracks how many entries it has received.
+    """
+
+    def __init__(self):
+        self._comms = []
+        self._comm_indices = {}
+        self._comm_records = []
+
+    def comm_count(self):
+        return len(self._comms)
+
+    def comm_records(self, start):
+        """Records defining the table entries from index start onwards."""
+        return b"".join(self._comm_records[start:])
+
+    def _intern(self, comm):
+        index = self._comm_indices.get(comm)
+        if index is None:
+            index = len(self._comms)
+            encoded = comm.encode("utf-8")[:255]
+            self._comms.append(comm)
+            self._comm_indices[comm] = index
+            self._comm_records.append(COMM_RECORD.pack(TAG_COMM, index, len(encoded)) + encoded)
+        return index
+
+    def encode(self, messages):
+        records = []
+        for message in messages:
+            type = message["type"]
+            if type == "add":
+                allocation = message["allocation"]
+                records.append(ADD_RECORD.pack(
+                    TAG_ADD, message["time"], allocation["id"], allocation["pid"], self._intern(allocation["comm"]),
+                    allocation["startAddr"], allocation["endAddr"], allocation["pages"]))
+            elif type == "remove":
+                records.append(REMOVE_RECORD.pack(TAG_REMOVE, message["time"], message["id"], message["pid"]))
+            elif type == "usage":
+                records.append(USAGE_RECORD.pack(TAG_USAGE, message["time"], message["rss"], message["vm"]))
+            elif type == "time":
+                records.append(TIME_RECORD.pack(TAG_TIME, message["time"]))
+            else:
+                encoded = json.dumps(message).encode("utf-8")
+                records.append(JSON_RECORD.pack(TAG_JSON, len(encoded)) + encoded)
+        return b"".join(records)
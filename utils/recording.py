@@ -0,0 +1,153 @@
+import json
+import os
+import struct
+import time
+from ctypes import create_string_buffer, string_at
+
+# Trace files hold the raw ring-buffer records, exactly as emitted by bpf.c:
+#
+#   header:  magic, version, metadata length, JSON metadata (tracker PID, tracked PIDs...)
+#   chunks:  chunk header, then the records, each prefixed by its size
+#   index:   one entry per chunk, followed by a fixed-size trailer pointing at it
+#
+# The index is written when the recording is closed. A file without it (e.g. the
+# tracer was killed) can still be replayed by scanning the chunks.
+MAGIC = b"SMVTRACE"
+CHUNK_MAGIC = b"CHNK"
+INDEX_MAGIC = b"SMVINDEX"
+VERSION = 2  # 2 added the stack_id of the mmap, mremap and brk records
+
+HEADER = struct.Struct("<8sII")  # magic, version, metadata length
+CHUNK_HEADER = struct.Struct("<4sIIQQ")  # magic, record count, payload length, first and last timestamp
+RECORD_SIZE = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<QQQ")  # chunk offset, first and last timestamp
+TRAILER = struct.Struct("<QI8s")  # index offset, number of chunks, magic
+TIMESTAMP = struct.Struct("<Q")  # offset 16 in every record, see the Event struct
+TIMESTAMP_OFFSET = 16
+
+CHUNK_SIZE = 1 << 20  # bytes of records buffered before a chunk is written
+
+
+class TraceWriter:
+    def __init__(self, path, metadata):
+        self._file = open(path, "wb")
+        encoded = json.dumps(metadata).encode("utf-8")
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(encoded)) + encoded)
+
+        self._index = []
+        self._buffer = bytearray()
+        self._count = 0
+        self._first_ts = 0
+        self._last_ts = 0
+
+    def record(self, raw_data, size):
+        """Append a ring-buffer record. raw_data is only valid during the callback, so it is copied."""
+        data = string_at(raw_data, size)
+        ts = TIMESTAMP.unpack_from(data, TIMESTAMP_OFFSET)[0]
+        if self._count == 0:
+            self._first_ts = ts
+        self._last_ts = max(self._last_ts, ts)
+        self._count += 1
+
+        self._buffer += RECORD_SIZE.pack(size)
+        self._buffer += data
+        if len(self._buffer) >= CHUNK_SIZE:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if self._count == 0:
+            return
+        self._index.append((self._file.tell(), self._first_ts, self._last_ts))
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._count, len(self._buffer), self._first_ts, self._last_ts))
+        self._file.write(self._buffer)
+        self._buffer = bytearray()
+        self._count = 0
+        self._last_ts = 0
+
+    def close(self):
+        self._flush_chunk()
+        index_offset = self._file.tell()
+        for entry in self._index:
+            self._file.write(INDEX_ENTRY.pack(*entry))
+        self._file.write(TRAILER.pack(index_offset, len(self._index), INDEX_MAGIC))
+        self._file.close()
+
+
+class TraceReader:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        magic, version, metadata_length = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} trace file")
+        self.metadata = json.loads(self._file.read(metadata_length))
+        self._data_offset = self._file.tell()
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """Return the (offset, first_ts, last_ts) chunk index, scanning the chunks if it is missing."""
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size - self._data_offset >= TRAILER.size:
+            self._file.seek(file_size - TRAILER.size)
+            index_offset, count, magic = TRAILER.unpack(self._file.read(TRAILER.size))
+            if magic == INDEX_MAGIC:
+                self._file.seek(index_offset)
+                data = self._file.read(count * INDEX_ENTRY.size)
+                return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+
+        index = []
+        offset = self._data_offset
+        while offset + CHUNK_HEADER.size <= file_size:
+            self._file.seek(offset)
+            magic, _, length, first_ts, last_ts = CHUNK_HEADER.unpack(self._file.read(CHUNK_HEADER.size))
+            if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + length > file_size:
+                break  # truncated chunk or index
+            index.append((offset, first_ts, last_ts))
+            offset += CHUNK_HEADER.size + length
+        return index
+
+    def time_range(self):
+        if not self.index:
+            return 0, 0
+        return self.index[0][1], max(last_ts for _, _, last_ts in self.index)
+
+    def records(self, start_ts=0):
+        """Yield the raw records in order, skipping the chunks that end before start_ts."""
+        for offset, _, last_ts in self.index:
+            if last_ts < start_ts:
+                continue
+            self._file.seek(offset)
+            _, count, length, _, _ = CHUNK_HEADER.unpack(self._file.read(CHUNK_HEADER.size))
+            payload = self._file.read(length)
+            position = 0
+            for _ in range(count):
+                size = RECORD_SIZE.unpack_from(payload, position)[0]
+                position += RECORD_SIZE.size
+                yield payload[position:position + size]
+                position += size
+
+    def close(self):
+        self._file.close()
+
+
+def replay(reader: TraceReader, speed, callback, before_sleep=None):
+    """
+    Feed the records of a trace to a ring-buffer callback, callback(cpu, raw_data, size).
+
+    With a speed of 1 the records are paced like the original trace, 2 replays twice
+    as fast, and 0 replays as fast as possible. before_sleep is called whenever the
+    replay waits for the next record, like the end of a ring-buffer poll.
+    """
+    first_ts = None
+    start = time.monotonic()
+    for data in reader.records():
+        if speed > 0:
+            ts = TIMESTAMP.unpack_from(data, TIMESTAMP_OFFSET)[0]
+            if first_ts is None:
+                first_ts = ts
+            delay = start + (ts - first_ts) / 1e9 / speed - time.monotonic()
+            if delay > 0:
+                if before_sleep is not None:
+                    before_sleep()
+                time.sleep(delay)
+
+        callback(0, create_string_buffer(data, len(data)), len(data))
@@ -0,0 +1,157 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from operator import sub
+
+# stack is the id of the user stack that allocated the region (see bpf.c), or -1, and
+# tid the thread that mapped it, or 0 when unknown (e.g. found by a reconciliation)
+Region = namedtuple("Region", ["id", "start_addr", "end_addr", "comm", "stack", "tid"], defaults=[-1, 0])
+
+# Storage cost of one region: three 8-byte columns (id, start, end), a 4-byte index
+# into the command table, a 4-byte stack id and a 4-byte thread id. Arrays
+# over-allocate by about 1/16 when growing.
+BYTES_PER_REGION = 3 * 8 + 4 + 4 + 4
+
+
+class CommTable:
+    """Interned process names, shared by all the region sets of a tracker."""
+
+    def __init__(self):
+        self._names = []
+        self._indices = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, index):
+        return self._names[index]
+
+    def intern(self, comm):
+        index = self._indices.get(comm)
+        if index is None:
+            index = len(self._names)
+            self._names.append(comm)
+            self._indices[comm] = index
+        return index
+
+
+class RegionSet:
+    """
+    Sorted, non-overlapping set of address ranges for a single process.
+
+    Regions are kept in parallel typed arrays ordered by start address, so lookups
+    are a bisect on the start/end columns and only the regions touched by a request
+    are visited. Since the ranges never overlap, the end addresses are sorted too.
+    Each region costs BYTES_PER_REGION bytes, sizes and page counts are derived.
+    """
+
+    def __init__(self, comms: CommTable):
+        self.comms = comms
+        self._ids = array("Q")
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._comms = array("I")
+        self._stacks = array("i")
+        self._tids = array("I")
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        names = self.comms
+        for i in range(len(self._starts)):
+            yield Region(self._ids[i], self._starts[i], self._ends[i], names[self._comms[i]], self._stacks[i],
+                         self._tids[i])
+
+    def __getitem__(self, index):
+        return Region(self._ids[index], self._starts[index], self._ends[index], self.comms[self._comms[index]],
+                      self._stacks[index], self._tids[index])
+
+    def copy(self):
+        """Return a snapshot of the region set, sharing the (append-only) command table."""
+        snapshot = RegionSet(self.comms)
+        snapshot._ids = self._ids[:]
+        snapshot._starts = self._starts[:]
+        snapshot._ends = self._ends[:]
+        snapshot._comms = self._comms[:]
+        snapshot._stacks = self._stacks[:]
+        snapshot._tids = self._tids[:]
+        return snapshot
+
+    def nbytes(self):
+        """Memory used by the region columns, including over-allocated capacity."""
+        columns = (self._ids, self._starts, self._ends, self._comms, self._stacks, self._tids)
+        return sum(sys.getsizeof(column) for column in columns)
+
+    def total_size(self):
+        return sum(self._ends) - sum(self._starts)
+
+    def total_pages(self, page_size):
+        return sum((end - start + page_size - 1) // page_size for start, end in zip(self._starts, self._ends))
+
+    def ids(self):
+        """Return the ids of the regions, in address order."""
+        return self._ids[:]
+
+    def ranges(self):
+        """Return the (start_addr, end_addr) pairs of the regions, in order."""
+        return list(zip(self._starts, self._ends))
+
+    def overlapping(self, start_addr, end_addr):
+        """Return the index range [lo, hi) of the regions intersecting [start_addr, end_addr)."""
+        lo = bisect_right(self._ends, start_addr)
+        hi = bisect_left(self._starts, end_addr, lo)
+        return lo, hi
+
+    def neighbours(self, lo, hi):
+        """Return the end of the region before index lo and the start of the region at hi, or None."""
+        return (self._ends[lo - 1] if lo > 0 else None,
+                self._starts[hi] if hi < len(self._starts) else None)
+
+    def largest_gap(self, floor=0):
+        """Return (start_addr, size) of the largest gap between regions ending at or above floor, or None."""
+        i = bisect_left(self._ends, floor)
+        if len(self._starts) - i < 2:
+            return None
+        gaps = list(map(sub, self._starts[i + 1:], self._ends[i:-1]))
+        size = max(gaps)
+        return self._ends[i + gaps.index(size)], size
+
+    def index_of_start(self, start_addr):
+        """Return the index of the region starting exactly at start_addr, or -1."""
+        i = bisect_left(self._starts, start_addr)
+        if i < len(self._starts) and self._starts[i] == start_addr:
+            return i
+        return -1
+
+    def replace(self, lo, hi, regions):
+        """Replace the regions in [lo, hi) with the given (already sorted) regions."""
+        self._ids[lo:hi] = array("Q", [r.id for r in regions])
+        self._starts[lo:hi] = array("Q", [r.start_addr for r in regions])
+        self._ends[lo:hi] = array("Q", [r.end_addr for r in regions])
+        self._comms[lo:hi] = array("I", [self.comms.intern(r.comm) for r in regions])
+        self._stacks[lo:hi] = array("i", [r.stack for r in regions])
+        self._tids[lo:hi] = array("I", [r.tid for r in regions])
+
+
+def range_difference(ranges, others):
+    """
+    Return the parts of ranges not covered by others, both sorted lists of disjoint
+    (start, end) pairs, with a single merge pass over the two lists.
+    """
+    difference = []
+    j = 0
+    for start, end in ranges:
+        # The ranges are sorted, so the others ending before this one end before the next ones too
+        while j < len(others) and others[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(others) and others[k][0] < end:
+            if others[k][0] > start:
+                difference.append((start, others[k][0]))
+            start = max(start, others[k][1])
+            k += 1
+        if start < end:
+            difference.append((start, end))
+    return difference
@@ -2,54 +2,281 @@ import asyncio
 import websockets
 import threading
 import json
+import time
+import traceback
+from collections import deque
+from utils.instrumentation import STATS_INTERVAL, stats
+from utils.protocol import BINARY_PROTOCOL, JSON_PROTOCOL, BinaryEncoder, select_subprotocol
+from utils.timeline import TIMELINE_DEFAULT_POINTS, Timeline
+
+BATCH_INTERVAL_MS = 50  # Maximum time an event waits before being sent
+BATCH_MAX_EVENTS = 1000  # Number of pending events that triggers an early send
+KEYFRAME_INTERVAL = 10  # seconds between snapshots of the live allocations
+HISTORY_RETENTION = 300  # seconds of events replayed to new clients
+SUMMARY_INTERVAL = 1  # seconds between "summary" messages
+
+
+class HistorySegment:
+    """A keyframe (snapshot of the live allocations) and the events that followed it."""
+
+    def __init__(self, time, build_keyframe):
+        self.time = time
+        self._build_keyframe = build_keyframe
+        self._keyframe = None
+        self.tail = []
+
+    def keyframe(self):
+        if self._keyframe is None:
+            self._keyframe = self._build_keyframe()
+            self._build_keyframe = None
+        return self._keyframe
+
 
 class Server:
-    def __init__(self):
+    def __init__(self, batch_interval_ms=BATCH_INTERVAL_MS, batch_max_events=BATCH_MAX_EVENTS,
+                 keyframe_interval=KEYFRAME_INTERVAL, history_retention=HISTORY_RETENTION):
         self.connected_clients = set()
         self._event_loop = None
-        self._events = []
         self._server = None
 
+        # Clients using the binary protocol, with the number of commands they received
+        self._binary_clients = {}
+        self._encoder = BinaryEncoder()
+
+        # Called periodically from a worker thread, expected to call notify_keyframe
+        self.keyframe_provider = None
+        # Called periodically from a worker thread while clients are connected, sends a summary message
+        self.summary_provider = None
+        self.keyframe_interval = keyframe_interval
+        self.history_retention_ns = int(history_retention * 1_000_000_000)
+        self._history = deque([HistorySegment(0, list)])
+
+        # Filled by the tracker, queried by the clients, and the lock under which the tracker touches it
+        self.timeline = Timeline()
+        self.timeline_lock = threading.Lock()
+        # Requests the clients can send, by type: handler(request) returns the reply, run on a worker thread
+        self.request_handlers = {"timeline": self._timeline_request}
+
+        self.batch_interval = batch_interval_ms / 1000
+        self.batch_max_events = batch_max_events
+        self._pending = []  # (event_message, save_event) tuples, filled from any thread
+        self._pending_lock = threading.Lock()
+        self._flush_requested = False
+        self._flush_event = None
+
     def notify_clients_threadsafe(self, event_message, save_event=True):
         if self._event_loop is None:
             print("Warning: Event loop is not running. Cannot notify clients.")
             return
 
-        asyncio.run_coroutine_threadsafe(self._notify_clients(event_message, save_event), self._event_loop)
+        with self._pending_lock:
+            self._pending.append((event_message, save_event))
+            wake_up = len(self._pending) >= self.batch_max_events and not self._flush_requested
+            if wake_up:
+                self._flush_requested = True
+
+        if wake_up:
+            self._event_loop.call_soon_threadsafe(self._flush_event.set)
+
+    def notify_keyframe(self, time, build_keyframe):
+        """
+        Start a new history segment. Must be called in order with the events, i.e.
+        while holding the lock the events are produced under. build_keyframe returns
+        the add messages of the allocations live at that point.
+        """
+        self.notify_clients_threadsafe({"type": "keyframe", "time": time, "build": build_keyframe}, save_event=False)
+
+    def _take_batch(self):
+        """
+        Take the pending events, dropping the allocations that were added and removed
+        within the same batch since clients would never see them.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            self._flush_requested = False
+
+        added = {}
+        for i, (message, _) in enumerate(pending):
+            if message["type"] == "keyframe":
+                # The keyframe holds the allocations added before it
+                added.clear()
+            elif message["type"] == "add":
+                added[(message["allocation"]["pid"], message["allocation"]["id"])] = i
+            elif message["type"] == "remove":
+                add_index = added.pop((message["pid"], message["id"]), None)
+                if add_index is not None:
+                    pending[add_index] = None
+                    pending[i] = None
+            elif message["type"] == "pid_exit":
+                # The exit removes the allocations of the process added in this batch too
+                for key in [key for key in added if key[0] == message["pid"]]:
+                    pending[added.pop(key)] = None
+
+        return [event for event in pending if event is not None]
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.batch_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            batch = self._take_batch()
+            try:
+                self._notify_clients(batch)
+            except Exception:
+                # A message that cannot be encoded must not stop the events for the rest of the run
+                stats.counters["server_batches_failed"] += 1
+                print(f"Warning: dropped a batch of {len(batch)} events")
+                traceback.print_exc()
+
+    async def _keyframe_loop(self):
+        while True:
+            await asyncio.sleep(self.keyframe_interval)
+            if self.keyframe_provider is not None:
+                await self._event_loop.run_in_executor(None, self.keyframe_provider)
+
+    async def _summary_loop(self):
+        while True:
+            await asyncio.sleep(SUMMARY_INTERVAL)
+            if self.summary_provider is not None and self.connected_clients:
+                await self._event_loop.run_in_executor(None, self.summary_provider)
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            if self.connected_clients:
+                # Reading the kernel counters blocks on BPF syscalls
+                snapshot = await self._event_loop.run_in_executor(None, stats.snapshot)
+                self.notify_clients_threadsafe({"type": "stats", "stats": snapshot}, save_event=False)
+
+    def _save_events(self, batch):
+        for message, save_event in batch:
+            if message["type"] == "keyframe":
+                self._history.append(HistorySegment(message["time"], message["build"]))
+            elif save_event:
+                self._history[-1].tail.append(message)
+
+        # Keep the newest segment that starts before the retention window
+        window_start = self._history[-1].time - self.history_retention_ns
+        while len(self._history) > 1 and self._history[1].time <= window_start:
+            self._history.popleft()
+
+    def _catchup_messages(self):
+        messages = list(self._history[0].keyframe())
+        for segment in self._history:
+            messages.extend(segment.tail)
+        return messages
+
+    def _notify_clients(self, batch):
+        if not batch:
+            return
+
+        self._save_events(batch)
 
-    async def _notify_clients(self, event_message, save_event=True):
-        if save_event:
-            self._events.append(event_message)
+        messages = [message for message, _ in batch if message["type"] != "keyframe"]
+        if not self.connected_clients or not messages:
+            return
 
-        if self.connected_clients:
-            for client in self.connected_clients:
-                await client.send(json.dumps(event_message))
+        serialize_ns = send_ns = 0
+        json_clients = [client for client in self.connected_clients if client not in self._binary_clients]
+        if json_clients:
+            start = time.perf_counter_ns()
+            frame = json.dumps({
+                "type": "batch",
+                "messages": messages,
+            })
+            sent = time.perf_counter_ns()
+            websockets.broadcast(json_clients, frame)
+            serialize_ns += sent - start
+            send_ns += time.perf_counter_ns() - sent
+
+        if self._binary_clients:
+            start = time.perf_counter_ns()
+            frame = self._encoder.encode(messages)
+            sent = time.perf_counter_ns()
+            for client in self._binary_clients:
+                websockets.broadcast([client], self._binary_frame(client, frame))
+            serialize_ns += sent - start
+            send_ns += time.perf_counter_ns() - sent
+
+        stats.stages["serialize"].record(serialize_ns // len(messages), len(messages))
+        stats.stages["send"].record(send_ns // len(messages), len(messages))
+
+    def _binary_frame(self, client, frame):
+        """Prefix a frame with the command table entries the client has not received yet."""
+        comms_sent = self._binary_clients[client]
+        self._binary_clients[client] = self._encoder.comm_count()
+        return self._encoder.comm_records(comms_sent) + frame
 
     async def _handler(self, websocket):
+        if websocket.subprotocol == BINARY_PROTOCOL:
+            self._binary_clients[websocket] = 0
+            catchup = self._binary_frame(websocket, self._encoder.encode(self._catchup_messages()))
+        else:
+            catchup = json.dumps({
+                "type": "catchup",
+                "messages": self._catchup_messages(),
+            })
         self.connected_clients.add(websocket)
 
-        await websocket.send(json.dumps({
-            "type": "catchup",
-            "messages": self._events,
-        }))
-
         try:
+            await websocket.send(catchup)
             async for message in websocket:
-                print(f"Received: {message}")
+                await self._handle_request(websocket, message)
         except websockets.exceptions.ConnectionClosedError:
             pass
         finally:
             self.connected_clients.remove(websocket)
+            self._binary_clients.pop(websocket, None)
+
+    async def _handle_request(self, websocket, message):
+        """Reply to a request of a client, a JSON object with a type and an id echoed in the reply."""
+        request = None
+        try:
+            request = json.loads(message)
+            handler = self.request_handlers.get(request.get("type"))
+            if handler is None:
+                raise ValueError(f"unknown request type {request.get('type')!r}")
+            reply = await self._event_loop.run_in_executor(None, handler, request)
+            reply = {"type": request["type"], "id": request.get("id"), **reply}
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            reply = {"type": "error", "id": request.get("id") if isinstance(request, dict) else None, "error": str(e)}
+
+        if websocket in self._binary_clients:
+            await websocket.send(self._encoder.encode([reply]))
+        else:
+            await websocket.send(json.dumps(reply))
+
+    def _timeline_request(self, request):
+        """{"start": ns, "end": ns, "points": buckets, "pids": [pid, ...]}, at the resolution matching points."""
+        start, end = int(request.get("start", 0)), int(request["end"])
+        points = max(int(request.get("points", TIMELINE_DEFAULT_POINTS)), 1)
+        pids = [int(pid) for pid in request.get("pids", [])]
+        with self.timeline_lock:
+            self.timeline.flush_pending()
+        return self.timeline.query(start, end, points, pids)
 
     async def _run(self):
+        self._flush_event = asyncio.Event()
         self._event_loop = asyncio.get_event_loop()
-        async with websockets.serve(self._handler, host='0.0.0.0', port=0) as server:
+        flush_task = asyncio.create_task(self._flush_loop())
+        keyframe_task = asyncio.create_task(self._keyframe_loop())
+        stats_task = asyncio.create_task(self._stats_loop())
+        summary_task = asyncio.create_task(self._summary_loop())
+        async with websockets.serve(self._handler, host='0.0.0.0', port=0,
+                                    subprotocols=[BINARY_PROTOCOL, JSON_PROTOCOL],
+                                    select_subprotocol=select_subprotocol) as server:
             self._server = server
             await server.serve_forever()
+        flush_task.cancel()
+        keyframe_task.cancel()
+        stats_task.cancel()
+        summary_task.cancel()
 
     def _start(self):
         asyncio.run(self._run())
 
     def start_on_separate_thread(self):
         server_thread = threading.Thread(target=self._start, daemon=True)
-        server_thread.start()
\ No newline at end of file
+        server_thread.start()
@@ -0,0 +1,179 @@
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+
+SYMBOL_CACHE_SIZE = 65_536  # (pid, address) pairs kept symbolized
+STACK_FRAMES = 8  # innermost frames of a stack that are symbolized
+
+# ELF64 little-endian structures, see elf(5)
+ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+PROGRAM_HEADER = struct.Struct("<IIQQQQQQ")
+SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+SYMBOL = struct.Struct("<IBBHQQ")
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+STT_FUNC = 2
+
+
+class ElfSymbols:
+    """
+    Function symbols of an ELF64 binary, from its .symtab and .dynsym, sorted by
+    address. Raises ValueError for other files.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            (ident, _, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum,
+             _) = ELF_HEADER.unpack_from(data, 0)
+            if ident[:4] != b"\x7fELF" or ident[4] != 2 or ident[5] != 1:
+                raise ValueError(f"{path} is not a 64-bit little-endian ELF file")
+
+            # (file offset, virtual address, size) of the loaded segments
+            self.loads = []
+            for i in range(phnum):
+                type, _, offset, vaddr, _, filesz, _, _ = PROGRAM_HEADER.unpack_from(data, phoff + i * phentsize)
+                if type == PT_LOAD:
+                    self.loads.append((offset, vaddr, filesz))
+
+            sections = [SECTION_HEADER.unpack_from(data, shoff + i * shentsize) for i in range(shnum)]
+            symbols = {}
+            for _, type, _, _, offset, size, link, _, _, entsize in sections:
+                if type not in (SHT_SYMTAB, SHT_DYNSYM) or entsize == 0:
+                    continue
+                strings_offset = sections[link][4]
+                for position in range(offset, offset + size, entsize):
+                    name, info, _, shndx, value, symbol_size = SYMBOL.unpack_from(data, position)
+                    if info & 0xf != STT_FUNC or value == 0 or shndx == 0:
+                        continue
+                    start = strings_offset + name
+                    symbols[value] = (symbol_size, data[start:data.find(b"\0", start)].decode("utf-8", "replace"))
+
+        self._addresses = sorted(symbols)
+        self._symbols = [symbols[address] for address in self._addresses]
+
+    def vaddr(self, file_offset):
+        """Virtual address of a file offset, through the loaded segment containing it."""
+        for offset, vaddr, size in self.loads:
+            if offset <= file_offset < offset + size:
+                return file_offset - offset + vaddr
+        return None
+
+    def lookup(self, vaddr):
+        """Return (name, offset) of the function containing vaddr, or None."""
+        i = bisect_right(self._addresses, vaddr) - 1
+        if i < 0:
+            return None
+        size, name = self._symbols[i]
+        offset = vaddr - self._addresses[i]
+        if size and offset >= size:
+            return None
+        return name, offset
+
+
+class Symbolizer:
+    """
+    Resolves the user stacks captured by bpf.c into function names.
+
+    Only called for the stacks that are displayed, never for each event. The frames of
+    each stack id are read from the stack_traces map once, the symbols of each binary
+    are loaded once, and the resolved (pid, address) pairs are kept in an LRU cache.
+    The mappings of a process are re-read when an address falls outside of them.
+    """
+
+    def __init__(self, stack_traces, cache_size=SYMBOL_CACHE_SIZE, frames=STACK_FRAMES):
+        self.stack_traces = stack_traces
+        self.cache_size = cache_size
+        self.max_frames = frames
+        self._stacks = {}  # stack id -> addresses, the map entries are never replaced
+        self._cache = OrderedDict()  # (pid, address) -> name, least recently used first
+        self._mappings = {}  # pid -> sorted [(start, end, file offset, path)]
+        self._binaries = {}  # (device, inode) -> ElfSymbols, or None if unreadable
+
+    def frames(self, pid, stack):
+        addresses = self._stacks.get(stack)
+        if addresses is None:
+            try:
+                addresses = list(self.stack_traces.walk(stack))[:self.max_frames]
+            except KeyError:
+                addresses = []
+            self._stacks[stack] = addresses
+        return [self.symbolize(pid, address) for address in addresses]
+
+    def symbolize(self, pid, address):
+        key = (pid, address)
+        name = self._cache.get(key)
+        if name is not None:
+            self._cache.move_to_end(key)
+            return name
+
+        name = self._resolve(pid, address)
+        self._cache[key] = name
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return name
+
+    def _resolve(self, pid, address):
+        mapping = self._find_mapping(pid, address)
+        if mapping is None:
+            return hex(address)
+        start, _, file_offset, path = mapping
+        binary = os.path.basename(path)
+
+        symbols = self._load(pid, path)
+        vaddr = symbols.vaddr(address - start + file_offset) if symbols is not None else None
+        symbol = symbols.lookup(vaddr) if vaddr is not None else None
+        if symbol is None:
+            return f"{hex(address)} ({binary})"
+        name, offset = symbol
+        return f"{name}+{hex(offset)} ({binary})"
+
+    def _find_mapping(self, pid, address):
+        for refresh in (False, True):
+            mappings = self._mappings.get(pid)
+            if mappings is None or refresh:
+                try:
+                    mappings = self._mappings[pid] = _read_file_mappings(pid)
+                except OSError:
+                    # The process exited
+                    self._mappings.pop(pid, None)
+                    return None
+            i = bisect_right(mappings, (address, float("inf"))) - 1
+            if i >= 0 and address < mappings[i][1]:
+                return mappings[i]
+        return None
+
+    def _load(self, pid, path):
+        # Through the root of the process, which may be in another mount namespace
+        for candidate in (f"/proc/{pid}/root{path}", path):
+            try:
+                stat = os.stat(candidate)
+                break
+            except OSError:
+                continue
+        else:
+            return None
+
+        key = (stat.st_dev, stat.st_ino)
+        if key not in self._binaries:
+            try:
+                self._binaries[key] = ElfSymbols(candidate)
+            except (OSError, ValueError, struct.error):
+                self._binaries[key] = None
+        return self._binaries[key]
+
+
+def _read_file_mappings(pid):
+    """Sorted (start, end, file offset, path) of the file-backed mappings of pid."""
+    mappings = []
+    with open(f"/proc/{pid}/maps", "rb") as file:
+        for line in file:
+            fields = line.split(None, 5)
+            if len(fields) < 6 or not fields[5].startswith(b"/"):
+                continue
+            start, _, end = fields[0].partition(b"-")
+            path = fields[5].rstrip(b"\n").decode("utf-8", "replace")
+            mappings.append((int(start, 16), int(end, 16), int(fields[2], 16), path))
+    return mappings
@@ -0,0 +1,232 @@
+import threading
+from array import array
+from bisect import bisect_right
+
+# Bucket widths of the timeline, finest first, in nanoseconds
+TIMELINE_RESOLUTIONS = [10_000_000, 100_000_000, 1_000_000_000, 10_000_000_000]
+TIMELINE_MAX_BUCKETS = 65_536  # kept per series and resolution, about 11 minutes at 10 ms and 7 days at 10 s
+TIMELINE_DEFAULT_POINTS = 1_000  # buckets returned by a query that does not give its number of points
+
+
+class Series:
+    """
+    Values sampled over time (e.g. the bytes and regions of a process), at every
+    resolution of TIMELINE_RESOLUTIONS.
+
+    Each bucket holds the last value recorded in it and the peak value. Only the finest
+    resolution is updated by record(): when one of its buckets closes, it is folded into
+    the next resolution, and so on. A query at a coarse resolution folds in the buckets
+    still open at the finer ones, so recording costs the same whatever the number of
+    resolutions.
+    """
+
+    def __init__(self, fields, resolutions=TIMELINE_RESOLUTIONS, max_buckets=TIMELINE_MAX_BUCKETS):
+        self.fields = fields
+        self.resolutions = resolutions
+        self.max_buckets = max_buckets
+        self._indices = [array("q") for _ in resolutions]  # time // resolution of each bucket
+        self._lasts = [[array("q") for _ in fields] for _ in resolutions]
+        self._peaks = [[array("q") for _ in fields] for _ in resolutions]
+
+    def record(self, time, values):
+        self._put(0, time // self.resolutions[0], values, values)
+
+    def _put(self, level, index, lasts, peaks):
+        indices = self._indices[level]
+        level_lasts = self._lasts[level]
+        level_peaks = self._peaks[level]
+
+        # Times from several sources (e.g. pipeline workers) may be slightly out of order
+        if indices and indices[-1] >= index:
+            for column, value in zip(level_lasts, lasts):
+                column[-1] = value
+            for column, value in zip(level_peaks, peaks):
+                if value > column[-1]:
+                    column[-1] = value
+            return
+
+        if indices and level + 1 < len(self.resolutions):
+            self._put(level + 1, indices[-1] * self.resolutions[level] // self.resolutions[level + 1],
+                      [column[-1] for column in level_lasts], [column[-1] for column in level_peaks])
+
+        indices.append(index)
+        for column, value in zip(level_lasts, lasts):
+            column.append(value)
+        for column, value in zip(level_peaks, peaks):
+            column.append(value)
+
+        if len(indices) > 2 * self.max_buckets:
+            # Trimmed in bulk, not on every append
+            excess = len(indices) - self.max_buckets
+            for column in [indices] + level_lasts + level_peaks:
+                del column[:excess]
+
+    def query(self, level, start, end):
+        """
+        Buckets of the given resolution between the times start and end, including the
+        bucket before start which holds the value at start. Returns the bucket start
+        times, and for each field its last and peak values.
+        """
+        resolution = self.resolutions[level]
+        first, last = start // resolution, end // resolution
+        indices = self._indices[level]
+        lo = max(bisect_right(indices, first) - 1, 0)
+        hi = bisect_right(indices, last)
+
+        result_indices = indices[lo:hi].tolist()
+        result_lasts = [column[lo:hi].tolist() for column in self._lasts[level]]
+        result_peaks = [column[lo:hi].tolist() for column in self._peaks[level]]
+
+        # The last bucket of each finer resolution is not folded into this one yet, oldest first
+        for finer in range(level - 1, -1, -1):
+            if not self._indices[finer]:
+                continue
+            index = self._indices[finer][-1] * self.resolutions[finer] // resolution
+            if index > last:
+                continue
+            lasts = [column[-1] for column in self._lasts[finer]]
+            peaks = [column[-1] for column in self._peaks[finer]]
+            if result_indices and result_indices[-1] >= index:
+                for column, value in zip(result_lasts, lasts):
+                    column[-1] = value
+                for column, value in zip(result_peaks, peaks):
+                    column[-1] = max(column[-1], value)
+            else:
+                result_indices.append(index)
+                for column, value in zip(result_lasts, lasts):
+                    column.append(value)
+                for column, value in zip(result_peaks, peaks):
+                    column.append(value)
+
+        # Only keep one bucket at or before start
+        skip = 0
+        while skip + 1 < len(result_indices) and result_indices[skip + 1] <= first:
+            skip += 1
+
+        series = {"time": [index * resolution for index in result_indices[skip:]]}
+        for field, lasts, peaks in zip(self.fields, result_lasts, result_peaks):
+            series[field] = lasts[skip:]
+            series[field + "_max"] = peaks[skip:]
+        return series
+
+
+class Timeline:
+    """
+    Multi-resolution history of the committed bytes and regions (in total and per
+    PID) and of the memory usage, so that clients can fetch any time range at the
+    resolution of their viewport instead of replaying every event.
+
+    The regions change far more often than the finest resolution, so the tracker only
+    marks the PIDs it changes with touch(). Their totals are read from the aggregates
+    once per finest bucket, when the next bucket starts or a query comes in (see
+    flush_pending): the finest buckets hold the totals at their end, the peaks of the
+    coarser ones are the peaks of those.
+    """
+
+    def __init__(self, resolutions=TIMELINE_RESOLUTIONS, max_buckets=TIMELINE_MAX_BUCKETS):
+        self.resolutions = resolutions
+        self.max_buckets = max_buckets
+        self._total = Series(("bytes", "regions"), resolutions, max_buckets)
+        self._pids = {}
+        self._usage = Series(("rss", "vm"), resolutions, max_buckets)
+        self._lock = threading.Lock()
+
+        self._bucket = None  # finest bucket of the pending changes
+        self._dirty = set()  # PIDs changed in that bucket
+        self._aggregates = None
+        self._source_totals = {}  # source -> its last (bytes, regions) total, see merge()
+
+    def touch(self, time, pid, aggregates):
+        """
+        Note that the regions of pid change at time. Called before aggregates (see
+        utils/aggregates.py) is updated, under the lock that protects it.
+        """
+        bucket = time // self.resolutions[0]
+        if bucket != self._bucket:
+            # Nothing of the new bucket is applied yet, the aggregates hold the end of the previous one
+            if self._dirty:
+                self._flush()
+            self._bucket = bucket
+            self._aggregates = aggregates
+        self._dirty.add(pid)
+
+    def _flush(self):
+        pids = list(self._dirty)
+        self._dirty.difference_update(pids)
+        aggregates = self._aggregates
+        values = {}
+        for pid in pids:
+            totals = aggregates.pids.get(pid)
+            values[pid] = (totals.bytes, totals.regions) if totals is not None else (0, 0)
+        self._record(self._bucket * self.resolutions[0], values, (aggregates.total.bytes, aggregates.total.regions))
+
+    def _record(self, time, pids, total):
+        """Record the (bytes, regions) of the given PIDs and of the total at time."""
+        with self._lock:
+            for pid, values in pids.items():
+                series = self._pids.get(pid)
+                if series is None:
+                    series = self._pids[pid] = Series(("bytes", "regions"), self.resolutions, self.max_buckets)
+                series.record(time, values)
+            self._total.record(time, total)
+
+    def merge(self, source, points):
+        """
+        Record the points taken from the TimelinePoints of another process (e.g. a
+        pipeline worker). Its PIDs are its own, its totals are added to the last ones of
+        the other sources.
+        """
+        for time, pids, total in points:
+            self._source_totals[source] = total
+            self._record(time, pids, tuple(map(sum, zip(*self._source_totals.values()))))
+
+    def flush_pending(self):
+        """
+        Record the totals of the current bucket so far, merged with the rest of it later.
+        Must be called under the lock of touch(), so that it never sees aggregates that a
+        touched PID has not been applied to yet.
+        """
+        if self._dirty:
+            self._flush()
+
+    def record_usage(self, time, rss, vm):
+        with self._lock:
+            self._usage.record(time, (rss, vm))
+
+    def resolution_for(self, start, end, points):
+        """Index of the finest resolution returning at most points buckets between start and end."""
+        for level, resolution in enumerate(self.resolutions):
+            if (end - start) // resolution < points:
+                return level
+        return len(self.resolutions) - 1
+
+    def query(self, start, end, points=TIMELINE_DEFAULT_POINTS, pids=()):
+        """Series between start and end at the resolution matching points, call flush_pending first."""
+        level = self.resolution_for(start, end, points)
+        with self._lock:
+            return {
+                "resolution": self.resolutions[level],
+                "total": self._total.query(level, start, end),
+                "usage": self._usage.query(level, start, end),
+                "processes": {pid: self._pids[pid].query(level, start, end) for pid in pids if pid in self._pids},
+            }
+
+
+class TimelinePoints(Timeline):
+    """
+    Timeline of a pipeline worker. The totals recorded once per finest bucket are kept
+    as points for take(), sent to the main process whose Timeline merges those of all
+    the workers, instead of being stored in series.
+    """
+
+    def __init__(self, resolutions=TIMELINE_RESOLUTIONS):
+        super().__init__(resolutions, 0)
+        self._points = []
+
+    def _record(self, time, pids, total):
+        self._points.append((time, pids, total))
+
+    def take(self):
+        """Remove and return the (time, {pid: (bytes, regions)}, (bytes, regions)) points recorded so far."""
+        points, self._points = self._points, []
+        return points
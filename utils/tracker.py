@@ -1,101 +1,138 @@
 import threading
 from collections import defaultdict
+from functools import partial
 import math
 import time
-from utils.server import Server
+from utils.aggregates import Aggregates, ThreadActivity, activity_request
+from utils.analytics import Analytics
+from utils.callsites import CallSites
+from utils.heatmap import AddressHeatmap, heatmap_request
+from utils.instrumentation import stats, timed_hold
+from utils.server import SUMMARY_INTERVAL, Server
+from utils.regions import CommTable, Region, RegionSet, range_difference
 from tracers.common import WITH_LOGGER
 
-SUMMARY_INTERVAL = 1  # seconds
-
-
 class MemoryTracker:
-    def __init__(self, page_size):
+    def __init__(self, page_size, server=None, first_id=0, id_step=1, activity=False, analytics=False,
+                 server_options=None):
+        """
+        By default the tracker starts its own websocket server, with the keyword arguments
+        of Server in server_options (e.g. its history retention). Trackers running in
+        pipeline workers publish through the given server stand-in instead, and use
+        interleaved allocation ids (first_id, first_id + id_step, ...) so they never collide.
+        The activity of the threads and commands and the fragmentation and churn histograms
+        are only kept when asked for, see --activity and --analytics.
+        """
         self.page_size = page_size
-        self.allocations = defaultdict(list)
-        self.program_breaks = defaultdict(lambda: 0)  # Current program break per PID
+        self.comms = CommTable()  # Process names shared by all regions
+        self.allocations = defaultdict(lambda: RegionSet(self.comms))
+        self.aggregates = Aggregates(page_size)  # Running totals of the regions in self.allocations
+        self.call_sites = CallSites()  # Running totals of the regions with a stack, see --stacks
+        self.activity = ThreadActivity() if activity else None  # Running totals and rates per thread and per command
+        self.analytics = Analytics() if analytics else None  # Fragmentation and churn histograms per PID
+        self.program_breaks = defaultdict(dict)  # Current program break per PID and TID
         self.lock = threading.Lock()  # Lock for thread safety
 
         self.start_time = time.time_ns()
         self.start_time_kernel = 0
-        self.seq_num = 0
-
-        self.server = Server()
-        self.server.start_on_separate_thread()
-
-    def add_allocation(self, pid, ts, start_addr, size, comm):
-        with self.lock:  # Ensure thread-safe access
-            self._add_allocation(pid, ts, start_addr, size, comm)
-
-    def _add_allocation(self, pid, ts, start_addr, size, comm):
+        self.seq_num = first_id
+        self.id_step = id_step
+
+        if server is None:
+            server = Server(**(server_options or {}))
+            server.keyframe_provider = self.publish_keyframe
+            server.summary_provider = self.publish_summary
+            server.start_on_separate_thread()
+        self.server = server
+        # Multi-resolution history of the totals, kept by the websocket server (the pipeline workers, whose server is
+        # a stand-in, keep TimelinePoints instead, see utils/pipeline.py)
+        self.timeline = server.timeline if isinstance(server, Server) else None
+        if self.timeline is not None:
+            server.timeline_lock = self.lock
+        # Occupancy of the address spaces, served to the clients on request
+        self.heatmap = None
+        if isinstance(server, Server):
+            self.heatmap = AddressHeatmap()
+            server.request_handlers["heatmap"] = partial(heatmap_request, self.heatmap, self.lock)
+            if self.activity is not None:
+                server.request_handlers["activity"] = partial(activity_request, self.activity_rows)
+
+    def add_allocation(self, pid, ts, start_addr, size, comm, stack=-1, tid=0):
+        """tid is the thread making the system call, 0 when the allocation does not come from one."""
+        self._update(self._add_allocation, pid, ts, start_addr, size, comm, stack, tid)
+
+    def _add_allocation(self, pid, ts, start_addr, size, comm, stack=-1, tid=0):
         end_addr = start_addr + size
-        num_pages = math.ceil(size / self.page_size)
-
         allocation_id = self._get_new_seq_id()
-        allocation = {
-            "id": allocation_id,
-            "start_addr": start_addr,
-            "end_addr": end_addr,
-            "size": size,
-            "pages": num_pages,
-            "comm": comm,
-        }
+        regions = self.allocations[pid]
+
+        # If the new allocation overlaps with an existing one, skip adding it
+        lo, hi = regions.overlapping(start_addr, end_addr)
+        if lo < hi:
+            return
 
-        allocations = self.allocations[pid]
-        # Find the right position to insert while maintaining sorted order
-        inserted = False
-        for i, existing in enumerate(allocations):
-            # If the new allocation overlaps with an existing one, skip adding it
-            if not (end_addr <= existing["start_addr"] or start_addr >= existing["end_addr"]):
-                return
-
-            # Insert if it should come before the current entry
-            if end_addr <= existing["start_addr"]:
-                allocations.insert(i, allocation)
-                inserted = True
-                break
-
-        # If not inserted, it should go at the end
-        if not inserted:
-            allocations.append(allocation)
-
-        # Merge adjacent or overlapping allocations to coalesce memory ranges
         time = self._get_relative_time(ts)
-        self._merge_allocations(pid, time)
-
-        # Get the new allocation
-        new_allocation = next((alloc for alloc in allocations if alloc["id"] == allocation_id), None)
-        if not new_allocation:
-            raise "Can't find the allocation that was just added"
-        self._send_add_allocation(new_allocation, pid, time)
-
-    def _merge_allocations(self, pid, time):
-        """Merge adjacent or overlapping allocations for a process."""
-        allocations = self.allocations[pid]
-        merged = []
-
-        for alloc in sorted(allocations, key=lambda x: x["start_addr"]):
-            if not merged or merged[-1]["end_addr"] < alloc["start_addr"]:
-                # No overlap, add to merged list
-                merged.append(alloc)
-            else:
-                # Overlap or adjacent, merge with the last entry
-                old_id = min(merged[-1]["id"], alloc["id"])
-                new_id = max(merged[-1]["id"], alloc["id"])
-
-                self._send_remove_allocation(old_id, pid, time)
-
-                merged[-1]["id"] = new_id
-                merged[-1]["end_addr"] = max(merged[-1]["end_addr"], alloc["end_addr"])
-                merged[-1]["size"] = merged[-1]["end_addr"] - merged[-1]["start_addr"]
-                merged[-1]["pages"] = math.ceil(merged[-1]["size"] / self.page_size)
-
-        self.allocations[pid] = merged
-
-    def remove_allocation(self, pid, ts, start_addr, size):
-        with self.lock:  # Ensure thread-safe access
-            self._remove_allocation(pid, ts, start_addr, size)
-
-    def _remove_allocation(self, pid, ts, start_addr, size):
+        allocation = Region(allocation_id, start_addr, end_addr, comm, stack, tid)
+        if stack >= 0:
+            self.call_sites.allocated(pid, stack, size)
+        if tid:
+            if self.activity is not None:
+                self.activity.mapped(pid, tid, comm, size, time)
+            if self.analytics is not None:
+                self.analytics.mapped(pid, size)
+
+        # Merge adjacent allocations to coalesce memory ranges
+        allocation, lo, hi = self._merge_allocations(pid, regions, allocation, lo, hi, time)
+        self._replace_regions(pid, regions, lo, hi, [allocation], time)
+
+        self._send_add_allocation(allocation, pid, time)
+
+    def _merge_allocations(self, pid, regions, allocation, lo, hi, time):
+        """
+        Coalesce a new allocation with its direct neighbours.
+
+        The merged region keeps the id of the new allocation and the command and thread
+        of the leftmost region. Regions allocated from different stacks are not merged, so
+        that each call site keeps its bytes. Returns the merged region and the index
+        range it replaces.
+        """
+        if lo > 0:
+            left = regions[lo - 1]
+            if left.end_addr == allocation.start_addr and left.stack == allocation.stack:
+                self._send_remove_allocation(left.id, pid, time)
+                allocation = allocation._replace(start_addr=left.start_addr, comm=left.comm, tid=left.tid)
+                lo -= 1
+
+        if hi < len(regions):
+            right = regions[hi]
+            if right.start_addr == allocation.end_addr and right.stack == allocation.stack:
+                self._send_remove_allocation(right.id, pid, time)
+                allocation = allocation._replace(end_addr=right.end_addr)
+                hi += 1
+
+        return allocation, lo, hi
+
+    def remove_allocation(self, pid, ts, start_addr, size, tid=0, comm=None):
+        """tid and comm are those of the thread making the system call, if any."""
+        self._update(self._remove_allocation, pid, ts, start_addr, size, tid, comm)
+
+    def _update(self, method, *args):
+        """Call method under the lock, timing it if the current event is sampled."""
+        if not stats.timing:
+            with self.lock:  # Ensure thread-safe access
+                method(*args)
+            return
+
+        start = time.perf_counter_ns()
+        with self.lock:
+            acquired = time.perf_counter_ns()
+            method(*args)
+            released = time.perf_counter_ns()
+        stats.stages["lock_hold"].record(released - acquired)
+        stats.stages["tracker_update"].record(released - start)
+        stats.tracker_update_ns += released - start
+
+    def _remove_allocation(self, pid, ts, start_addr, size, tid=0, comm=None):
         """Handle partial and complete unmap requests."""
         if pid not in self.allocations:
             if WITH_LOGGER:
@@ -104,115 +141,189 @@ class MemoryTracker:
             return
 
         time = self._get_relative_time(ts)
+        regions = self.allocations[pid]
+
+        # if size == 0 remove the whole allocation starting at start_addr
+        if size == 0:
+            lo = regions.index_of_start(start_addr)
+            hi = lo + 1 if lo >= 0 else lo
+            unmap_end_addr = regions[lo].end_addr if lo >= 0 else start_addr
+        else:
+            unmap_end_addr = start_addr + size
+            lo, hi = regions.overlapping(start_addr, unmap_end_addr)
+
+        if lo == hi:
+            if WITH_LOGGER:
+                print(f"[WARN] PID {pid}: Unmap request doesn't match any tracked allocation "
+                      f"Start Address: {hex(start_addr)} | Size: {size}")
+            return
 
-        # if size == 0 remove the whole allocation
-        allocations = self.allocations[pid]
-        new_allocations = []
-        unmap_end_addr = start_addr + size
-        unmapped = False
-
-        for alloc in allocations:
-            # No overlap, keep the allocation as-is
-            if alloc['start_addr'] == start_addr and size == 0:
-                unmapped = True
-                continue
-
-            if alloc["end_addr"] <= start_addr or alloc["start_addr"] >= unmap_end_addr:
-                new_allocations.append(alloc)
-                continue
-
-            # Partial overlap: split the allocation
-            if alloc["start_addr"] < start_addr and alloc["end_addr"] > unmap_end_addr:
-                self._send_remove_allocation(alloc["id"], pid, time)
-
-                # Split into two parts
-                new_alloc_left = {
-                    "id": self._get_new_seq_id(),
-                    "start_addr": alloc["start_addr"],
-                    "end_addr": start_addr,
-                    "size": start_addr - alloc["start_addr"],
-                    "pages": math.ceil((start_addr - alloc["start_addr"]) / self.page_size),
-                    "comm": alloc["comm"],
-                }
-                new_allocations.append(new_alloc_left)
-                self._send_add_allocation(new_alloc_left, pid, time)
-
-                new_alloc_right = {
-                    "id": self._get_new_seq_id(),
-                    "start_addr": unmap_end_addr,
-                    "end_addr": alloc["end_addr"],
-                    "size": alloc["end_addr"] - unmap_end_addr,
-                    "pages": math.ceil((alloc["end_addr"] - unmap_end_addr) / self.page_size),
-                    "comm": alloc["comm"],
-                }
-                new_allocations.append(new_alloc_right)
-                self._send_add_allocation(new_alloc_right, pid, time)
-
-                unmapped = True
-
-            # Start of allocation overlaps
-            elif alloc["start_addr"] < start_addr < alloc["end_addr"]:
-                self._send_remove_allocation(alloc["id"], pid, time)
-
-                new_alloc = {
-                    "id": self._get_new_seq_id(),
-                    "start_addr": alloc["start_addr"],
-                    "end_addr": start_addr,
-                    "size": start_addr - alloc["start_addr"],
-                    "pages": math.ceil((start_addr - alloc["start_addr"]) / self.page_size),
-                    "comm": alloc["comm"],
-                }
-                new_allocations.append(new_alloc)
+        if comm is None:
+            # Before the regions are replaced, the unmap may remove the last ones
+            comm = regions[lo].comm
+
+        remaining = []
+        unmapped = 0
+        for alloc in [regions[i] for i in range(lo, hi)]:
+            self._send_remove_allocation(alloc.id, pid, time)
+            overlap = min(alloc.end_addr, unmap_end_addr) - max(alloc.start_addr, start_addr)
+            unmapped += overlap
+            if alloc.stack >= 0:
+                self.call_sites.freed(pid, alloc.stack, overlap)
+
+            # Keep the part of the allocation before the unmapped range
+            if alloc.start_addr < start_addr:
+                new_alloc = Region(self._get_new_seq_id(), alloc.start_addr, start_addr, alloc.comm, alloc.stack,
+                                   alloc.tid)
+                remaining.append(new_alloc)
                 self._send_add_allocation(new_alloc, pid, time)
 
-                unmapped = True
-
-            # End of allocation overlaps
-            elif alloc["start_addr"] < unmap_end_addr < alloc["end_addr"]:
-                self._send_remove_allocation(alloc["id"], pid, time)
-
-                new_alloc = {
-                    "id": self._get_new_seq_id(),
-                    "start_addr": unmap_end_addr,
-                    "end_addr": alloc["end_addr"],
-                    "size": alloc["end_addr"] - unmap_end_addr,
-                    "pages": math.ceil((alloc["end_addr"] - unmap_end_addr) / self.page_size),
-                    "comm": alloc["comm"],
-                }
-                new_allocations.append(new_alloc)
+            # Keep the part of the allocation after the unmapped range
+            if alloc.end_addr > unmap_end_addr:
+                new_alloc = Region(self._get_new_seq_id(), unmap_end_addr, alloc.end_addr, alloc.comm, alloc.stack,
+                                   alloc.tid)
+                remaining.append(new_alloc)
                 self._send_add_allocation(new_alloc, pid, time)
 
-                unmapped = True
+        self._replace_regions(pid, regions, lo, hi, remaining, time)
+        if tid:
+            if self.activity is not None:
+                self.activity.unmapped(pid, tid, comm, unmapped, time)
+            if self.analytics is not None:
+                self.analytics.unmapped(pid, unmapped)
+
+    def _replace_regions(self, pid, regions, lo, hi, new_regions, time):
+        """
+        Replace regions[lo:hi], keeping the aggregates, call sites, activity, analytics,
+        timeline and heatmap up to date.
+        """
+        if self.timeline is not None:
+            self.timeline.touch(time, pid, self.aggregates)
+        heatmap, activity = self.heatmap, self.activity
+        removed = [regions[i] for i in range(lo, hi)]
+        if self.analytics is not None:
+            before, after = regions.neighbours(lo, hi)
+            self.analytics.replace(pid, before, removed, new_regions, after, time)
+        for region in removed:
+            self.aggregates.remove(pid, region.comm, region.end_addr - region.start_addr)
+            if activity is not None:
+                activity.remove(pid, region.tid, region.comm, region.end_addr - region.start_addr)
+            if region.stack >= 0:
+                self.call_sites.remove(pid, region.stack, region.end_addr - region.start_addr)
+            if heatmap is not None:
+                heatmap.remove(pid, region.start_addr, region.end_addr)
+        for region in new_regions:
+            self.aggregates.add(pid, region.comm, region.end_addr - region.start_addr)
+            if activity is not None:
+                activity.add(pid, region.tid, region.comm, region.end_addr - region.start_addr)
+            if region.stack >= 0:
+                self.call_sites.add(pid, region.stack, region.end_addr - region.start_addr)
+            if heatmap is not None:
+                heatmap.add(pid, region.start_addr, region.end_addr)
+        regions.replace(lo, hi, new_regions)
+
+    def publish_keyframe(self):
+        """
+        Send the set of live allocations to the server, which uses it as the starting
+        point of the history replayed to new clients.
+
+        Only the compact region columns are copied under the lock, the messages are
+        built when a client actually needs them.
+        """
+        with timed_hold(self.lock):
+            time = self._get_current_time()
+            snapshot = {pid: regions.copy() for pid, regions in self.allocations.items() if len(regions) > 0}
+            self.server.notify_keyframe(time, lambda: [
+                self._add_allocation_message(allocation, pid, time)
+                for pid, regions in snapshot.items()
+                for allocation in regions
+            ])
 
-            # Fully overlaps, remove the allocation
-            else:
-                self._send_remove_allocation(alloc["id"], pid, time)
-                unmapped = True
+    def send_usage(self, rss, vm):
+        time = self._get_current_time()
+        if self.timeline is not None:
+            self.timeline.record_usage(time, rss, vm)
+        self._send_usage(time, rss, vm)
+
+    def live_regions(self):
+        """Snapshot of the live regions, {pid: RegionSet}."""
+        with timed_hold(self.lock):
+            return {pid: regions.copy() for pid, regions in self.allocations.items() if len(regions) > 0}
+
+    def send_residency(self, regions):
+        """Send the resident pages of the sampled regions, see usage/residency.py."""
+        self.server.notify_clients_threadsafe({
+            "type": "residency",
+            "time": self._get_current_time(),
+            "regions": regions,
+        }, save_event=False)
 
-        if not unmapped:
-            if WITH_LOGGER:
-                print(f"[WARN] PID {pid}: Unmap request doesn't match any tracked allocation "
-                      f"Start Address: {hex(start_addr)} | Size: {size}")
+    def activity_rows(self, view):
+        """Rows of the "threads" or "comms" view of the activity, see utils/aggregates.py."""
+        with timed_hold(self.lock):
+            return self.activity.rows(view, self._get_current_time())
+
+    def analytics_snapshot(self):
+        """
+        Analytics with their churn since the previous snapshot, see utils/analytics.py,
+        and the largest hole above the program break of each process.
+        """
+        with timed_hold(self.lock):
+            processes = self.analytics.snapshot(
+                {pid for pid, regions in self.allocations.items() if len(regions) > 0})
+            floors = {}
+            for pid, breaks in self.program_breaks.items():
+                floors[pid] = max(breaks.values(), default=0)
+            snapshot = {pid: self.allocations[pid].copy() for pid in processes if pid in self.allocations}
+        # The gaps are compared outside of the lock
+        holes = {pid: regions.largest_gap(floors.get(pid, 0)) for pid, regions in snapshot.items()}
+        return processes, holes
+
+    def send_analytics(self, rows):
+        self.server.notify_clients_threadsafe({
+            "type": "analytics",
+            "time": self._get_current_time(),
+            "processes": rows,
+        }, save_event=False)
 
-        self.allocations[pid] = new_allocations
+    def call_sites_snapshot(self):
+        """Call sites with their churn since the previous snapshot, see utils/callsites.py."""
+        with timed_hold(self.lock):
+            return self.call_sites.snapshot()
 
-    def send_usage(self, rss, vm):
-        self._send_usage(self._get_current_time(), rss, vm)
+    def send_call_sites(self, rows):
+        self.server.notify_clients_threadsafe({
+            "type": "callsites",
+            "time": self._get_current_time(),
+            "sites": rows,
+        }, save_event=False)
 
-    def _send_add_allocation(self, allocation, pid, time):
+    def send_faults(self, faults):
+        """Send the page faults of the regions and processes, see usage/faults.py."""
         self.server.notify_clients_threadsafe({
+            "type": "faults",
+            "time": self._get_current_time(),
+            **faults,
+        }, save_event=False)
+
+    def _send_add_allocation(self, allocation, pid, time):
+        self.server.notify_clients_threadsafe(self._add_allocation_message(allocation, pid, time))
+
+    def _add_allocation_message(self, allocation, pid, time):
+        size = allocation.end_addr - allocation.start_addr
+        return {
             "type": "add",
             "time": time,
             "allocation": {
-                "id": allocation["id"],
+                "id": allocation.id,
                 "pid": pid,
-                "startAddr": allocation["start_addr"],
-                "endAddr": allocation["end_addr"],
-                "size": allocation["size"],
-                "pages": allocation["pages"],
-                "comm": allocation["comm"],
+                "startAddr": allocation.start_addr,
+                "endAddr": allocation.end_addr,
+                "size": size,
+                "pages": self._get_num_pages(size),
+                "comm": allocation.comm,
             }
-        })
+        }
 
     def _send_remove_allocation(self, id, pid, time):
         self.server.notify_clients_threadsafe({
@@ -232,77 +343,153 @@ class MemoryTracker:
 
     def _get_new_seq_id(self):
         new_value = self.seq_num
-        self.seq_num += 1
+        self.seq_num += self.id_step
         return new_value
 
+    def _get_num_pages(self, size):
+        return math.ceil(size / self.page_size)
+
     def _get_current_time(self):
         return time.time_ns() - self.start_time
 
+    def set_start_time_kernel(self, ts):
+        """Use ts as time 0 instead of the first event seen, to share a time base between trackers."""
+        if self.start_time_kernel == 0:
+            self._get_relative_time(ts)
+
     def _get_relative_time(self, ts):
         if self.start_time_kernel == 0:
             self.start_time_kernel = ts
             self.start_time = time.time_ns()
         return ts - self.start_time_kernel
 
-    def handle_brk(self, pid, ts, tid, new_brk, comm):
+    def handle_brk(self, pid, ts, tid, new_brk, comm, stack=-1):
         """Handle a brk syscall and update the program break."""
-        key = (pid, tid)  # Unique key for process and thread
-        with self.lock:  # Ensure thread-safe access
-            old_brk = self.program_breaks.get(key, 0)
-
-            # If no previous `brk` observed for this TID, initialize
-            if old_brk == 0:
-                self.program_breaks[key] = new_brk
-                if WITH_LOGGER:
-                    print(f"[INFO] Initialized heap tracking for PID {pid}, TID {tid} with base {hex(new_brk)}")
-                return
-
-            # Update the program break
-            self.program_breaks[key] = new_brk
-
-            # Adjust allocations based on the change in the program break
-            if new_brk > old_brk:
-                # Memory region expanded
-                self._add_allocation(pid, ts, old_brk, new_brk - old_brk, comm)
-            elif new_brk < old_brk:
-                # Memory region shrunk
-                self._remove_allocation(pid, ts, new_brk, old_brk - new_brk)
+        self._update(self._handle_brk, pid, ts, tid, new_brk, comm, stack)
+
+    def _handle_brk(self, pid, ts, tid, new_brk, comm, stack=-1):
+        breaks = self.program_breaks[pid]
+        old_brk = breaks.get(tid, 0)
+
+        # If no previous `brk` observed for this TID, initialize
+        if old_brk == 0:
+            breaks[tid] = new_brk
+            if WITH_LOGGER:
+                print(f"[INFO] Initialized heap tracking for PID {pid}, TID {tid} with base {hex(new_brk)}")
+            return
+
+        # Update the program break
+        breaks[tid] = new_brk
+
+        # Adjust allocations based on the change in the program break
+        if new_brk > old_brk:
+            # Memory region expanded
+            self._add_allocation(pid, ts, old_brk, new_brk - old_brk, comm, stack, tid)
+        elif new_brk < old_brk:
+            # Memory region shrunk
+            self._remove_allocation(pid, ts, new_brk, old_brk - new_brk, tid, comm)
+
+    def remove_process(self, pid, ts):
+        """Drop everything known about an exited process, see trace_process_exit in bpf.c."""
+        self._update(self._remove_process, pid, ts)
+
+    def _remove_process(self, pid, ts):
+        """
+        Drop the regions of pid at once, with a single "pid_exit" message instead of a
+        "remove" per region. The totals are still updated region by region, but without
+        any search in or shift of the region set, which is discarded whole.
+        """
+        self.program_breaks.pop(pid, None)
+        regions = self.allocations.pop(pid, None)
+        if regions is not None and len(regions) > 0:
+            time = self._get_relative_time(ts)
+            self._replace_regions(pid, regions, 0, len(regions), [], time)
+            self.server.notify_clients_threadsafe({
+                "type": "pid_exit",
+                "time": time,
+                "pid": pid,
+            })
+        if self.activity is not None:
+            self.activity.forget(pid)
+        if self.analytics is not None:
+            self.analytics.forget(pid)
 
     def clear_allocations_for_pid(self, pid):
+        """Drop the regions of a process found to have exited without its exit event, e.g. by fetch_usage_loop."""
         ts = time.time_ns() - self.start_time + self.start_time_kernel
-        with self.lock:
-            if pid in self.allocations:
-                for alloc in self.allocations[pid]:
-                    self._remove_allocation(pid, ts, alloc["start_addr"], alloc["size"])
+        self.remove_process(pid, ts)
+
+    def reconcile(self, pid, read_mappings):
+        """
+        Correct the regions of pid to match the actual address space of the process,
+        e.g. after attaching to it or losing events.
+
+        read_mappings() returns the sorted, coalesced (start, end) ranges mapped by the
+        process and its command name. It is called without the lock, since reading the
+        maps of a large process takes a while, so the ranges changed by the events applied
+        meanwhile are left alone: only the ranges missing both before and after the read
+        are added, and only those tracked both before and after are removed. Returns the
+        number of ranges added and removed.
+        """
+        with timed_hold(self.lock):
+            before = self.allocations[pid].ranges() if pid in self.allocations else []
+        mappings, comm = read_mappings()
+
+        with timed_hold(self.lock):
+            if pid not in self.allocations and not mappings:
+                return 0, 0
+
+            after = self.allocations[pid].ranges()
+            missing = range_difference(range_difference(mappings, before), after)
+            unchanged = range_difference(before, range_difference(before, after))
+            stale = range_difference(unchanged, mappings)
+
+            # Kernel timestamps use the monotonic clock
+            ts = time.monotonic_ns()
+            for start, end in stale:
+                self._remove_allocation(pid, ts, start, end - start)
+            for start, end in missing:
+                self._add_allocation(pid, ts, start, end - start, comm)
+            return len(missing), len(stale)
 
     def summarize_allocations_loop(self):
         while True:
             self.summarize_allocations()
             time.sleep(SUMMARY_INTERVAL)
 
+    def publish_summary(self):
+        """Send the running totals to the clients."""
+        with timed_hold(self.lock):
+            summary = self.aggregates.snapshot()
+        self.server.notify_clients_threadsafe({
+            "type": "summary",
+            "time": self._get_current_time(),
+            **summary,
+        }, save_event=False)
+
     def summarize_allocations(self):
         self.server.notify_clients_threadsafe({
             "type": "time",
             "time": self._get_current_time(),
         }, save_event=False)
 
-        with self.lock:  # Ensure thread-safe read access
-            print("\n[Supmmary of Virtual Memory allocations]")
-            for pid, allocations in self.allocations.items():
-                total_size = sum(a["size"] for a in allocations)
-                total_pages = sum(a["pages"] for a in allocations)
-                print(
-                    f"PID: {pid} | Total Allocations: {len(allocations)} | Total Size (B): {total_size:<10} | Total Pages: {total_pages:<5}")
-                for alloc in allocations:
-                    print(f"    Address Range: {hex(alloc['start_addr']):} - {hex(alloc['end_addr']):<30} | "
-                          f"Size (B): {alloc['size']:<10} | Pages: {alloc['pages']:<10} | Command: {alloc['comm']}")
-            print("\n---")
-            print("Number of observed Processes: ", len(set(self.allocations.keys())))
-            size = sum(sum(a["size"] for a in allocations) for allocations in self.allocations.values())
-            formatted_size = "{:.2f}".format(size / 1024 / 1024)
-            print("Number of observed Allocations: ",
-                  sum(len(allocations) for allocations in self.allocations.values()))
-            print("Total Allocated Virtual Memory: ", formatted_size, "MB")
-            formatted_pg_size = "{}".format(int(self.page_size / 1024))
-            print("Total Allocated Pages (" + formatted_pg_size + " KB): ",
-                  sum(sum(a["pages"] for a in allocations) for allocations in self.allocations.values()))
+        # Only the totals are copied under the lock, the output is formatted without it
+        with timed_hold(self.lock):
+            summary = self.aggregates.snapshot()
+        print_summary(summary, self.page_size)
+
+
+def print_summary(summary, page_size):
+    print("\n[Summary of Virtual Memory allocations]")
+    for process in sorted(summary["processes"], key=lambda process: process["pid"]):
+        print(f"PID: {process['pid']} | Total Allocations: {process['regions']} | "
+              f"Total Size (B): {process['bytes']:<10} | Total Pages: {process['pages']:<5}")
+    for command in sorted(summary["commands"], key=lambda command: -command["bytes"]):
+        print(f"    Command: {command['comm']:<16} | Allocations: {command['regions']:<6} | "
+              f"Size (B): {command['bytes']:<10} | Pages: {command['pages']:<10}")
+    print("\n---")
+    total = summary["total"]
+    print("Number of observed Processes: ", len(summary["processes"]))
+    print("Number of observed Allocations: ", total["regions"])
+    print("Total Allocated Virtual Memory: ", "{:.2f}".format(total["bytes"] / 1024 / 1024), "MB")
+    print("Total Allocated Pages (" + "{}".format(int(page_size / 1024)) + " KB): ", total["pages"])